@@ -0,0 +1,82 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+
+Compare the threaded and async replay download engines on the same chunk
+list, served by a local mock CDN.
+
+Usage:
+    python benchmarks/bench_engines.py [--chunks N] [--size BYTES] [--latency SECONDS] [--jobs N ...]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mockserver import DEFAULT_CHUNK_SIZE, DEFAULT_LATENCY, DEFAULT_NUM_CHUNKS, MockServer
+from pyriscope import processor
+
+
+def run(server, engine, jobs, stream):
+    with tempfile.TemporaryDirectory() as work_dir:
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            start = time.perf_counter()
+            options = processor.Options()
+            options.engine = engine
+            options.jobs = jobs
+            options.stream = stream
+            # Start every run from its own job limits instead of the first run's.
+            processor.controllers.clear()
+            processor.session_pool.resize(jobs)
+            with contextlib.redirect_stdout(io.StringIO()):
+                headers = {'Cookie': processor.cookie_header(server.access_public())}
+                complete = processor.download_replay("bench", server.download_list(), headers, "bench", options)
+            elapsed = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+    return complete, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pyriscope download engines.")
+    parser.add_argument('--chunks', type=int, default=DEFAULT_NUM_CHUNKS)
+    parser.add_argument('--size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY)
+    parser.add_argument('--jobs', type=int, nargs='+', default=[processor.DEFAULT_DL_THREADS, 32, 100])
+    parser.add_argument('--stream', action='store_true', help="Use --stream mode.")
+    args = parser.parse_args()
+
+    engines = [processor.ENGINE_THREADS]
+    try:
+        import aiohttp
+        engines.append(processor.ENGINE_ASYNC)
+    except ImportError:
+        print("aiohttp not found: Skipping async engine.")
+
+    server = MockServer(args.chunks, args.size, args.latency).start()
+    total_mb = args.chunks * len(server.chunk(0)) / (1024 * 1024)
+    print("{} chunks x {} bytes, {}s latency".format(args.chunks, args.size, args.latency))
+    print("{:<10}{:>6}{:>10}{:>10}".format("engine", "jobs", "seconds", "MB/s"))
+    try:
+        for engine in engines:
+            for jobs in args.jobs:
+                complete, elapsed = run(server, engine, jobs, args.stream)
+                print("{:<10}{:>6}{:>10.2f}{:>10.1f}{}".format(
+                    engine, jobs, elapsed, total_mb / elapsed, "" if complete else "  (incomplete)"))
+    finally:
+        server.stop()
+        processor.session_pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+
+Run pyriscope end to end, through processor.process, against a local mock
+of the Periscope API and replay CDN, across thread counts and chunk sizes.
+Each run happens in a fresh process so its peak memory can be measured.
+
+Usage:
+    python benchmarks/bench_process.py [--chunks N] [--sizes BYTES ...] [--jobs N ...] [--latency SECONDS]
+                                       [--bandwidth BYTES] [--error-rate FRACTION] [--stall-rate FRACTION]
+                                       [--no-ranges] [--engine ENGINE] [--repeat N] [-- extra pyriscope options]
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mockserver import API_PATH, DEFAULT_LATENCY, DEFAULT_NUM_CHUNKS, REPLAY_KEY, MockServer
+
+
+# Contants.
+BROADCAST_URL = "https://www.periscope.tv/w/1LyxBeXmWObJN"
+DEFAULT_SIZES = [64 * 1024, 256 * 1024, 1024 * 1024]
+DEFAULT_JOBS = [2, 6, 16]
+
+
+# Functions.
+def child(args):
+    # Runs inside the measured process: a single pyriscope invocation.
+    from pyriscope import processor
+
+    try:
+        processor.process(args)
+        code = 0
+    except SystemExit as e:
+        code = e.code
+    end = time.time()
+
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak *= 1024
+    sys.__stderr__.write(json.dumps({'end': end, 'peak': peak, 'code': code}) + "\n")
+
+
+def run(server, jobs, engine, extra_args):
+    server.reset()
+    with tempfile.TemporaryDirectory() as work_dir:
+        env = dict(os.environ, PYRISCOPE_API_URL=server.api_url, PYRISCOPE_CACHE_DIR=work_dir)
+        command = [sys.executable, os.path.abspath(__file__), '--child', BROADCAST_URL, '-n', "bench",
+                   '-j', str(jobs), '-e', engine, '--no-cache', '--progress', 'none'] + extra_args
+        # Start-up, including interpreter and imports, counts from here.
+        start = time.time()
+        process = subprocess.run(command, cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        lines = process.stderr.decode('utf-8', 'replace').strip().splitlines()
+        try:
+            result = json.loads(lines[-1])
+        except (IndexError, ValueError):
+            raise RuntimeError("Benchmark run failed:\n{}".format("\n".join(lines)))
+
+        output = os.path.join(work_dir, "bench.ts")
+        result['start'] = start
+        result['size'] = os.path.getsize(output) if os.path.exists(output) else 0
+
+    result['phases'] = phases(server.requests, result['start'], result['end'])
+    result['errors'] = server.num_errors
+    return result
+
+
+def phases(requests, start, end):
+    # Splits the run at the mock server's view of it: process start-up until the first
+    # API call, API calls and playlist, chunk downloads, then assembly/exit.
+    api = [t for t, path in requests if path.startswith(API_PATH) or path.endswith(".m3u8")]
+    chunks = [t for t, path in requests if path.startswith("/{}/chunk_".format(REPLAY_KEY))]
+    if not api or not chunks:
+        return {'startup': end - start, 'api': 0.0, 'download': 0.0, 'finish': 0.0}
+    return {'startup': api[0] - start, 'api': chunks[0] - api[0], 'download': chunks[-1] - chunks[0],
+            'finish': end - chunks[-1]}
+
+
+def main():
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2:])
+        return
+
+    argv = sys.argv[1:]
+    extra_args = []
+    if '--' in argv:
+        argv, extra_args = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+
+    parser = argparse.ArgumentParser(description="Benchmark pyriscope end to end against a mock Periscope.")
+    parser.add_argument('--chunks', type=int, default=DEFAULT_NUM_CHUNKS)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--jobs', type=int, nargs='+', default=DEFAULT_JOBS)
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY)
+    parser.add_argument('--bandwidth', type=int, default=None, help="Bytes per second per connection.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of chunk requests that fail.")
+    parser.add_argument('--stall-rate', type=float, default=0.0,
+                        help="Fraction of chunk requests that stall for --stall-time seconds.")
+    parser.add_argument('--stall-time', type=float, default=5.0)
+    parser.add_argument('--no-ranges', action='store_true', help="Serve chunks whole, ignoring Range headers.")
+    parser.add_argument('--engine', default="threads")
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    print("{} chunks, {}s latency, {} bandwidth, {:.0%} errors, {:.0%} stalls, {} engine{}".format(
+        args.chunks, args.latency, args.bandwidth or "unlimited", args.error_rate, args.stall_rate, args.engine,
+        ", options: " + " ".join(extra_args) if extra_args else ""))
+    print("{:>9}{:>6}{:>9}{:>8}{:>9}{:>9}{:>10}{:>8}{:>9}{:>8}".format(
+        "size", "jobs", "seconds", "MB/s", "startup", "api", "download", "finish", "peak MB", "errors"))
+
+    for size in args.sizes:
+        server = MockServer(args.chunks, size, args.latency, bandwidth=args.bandwidth,
+                            error_rate=args.error_rate, stall_rate=args.stall_rate,
+                            stall_time=args.stall_time, ranges=not args.no_ranges).start()
+        total_mb = args.chunks * len(server.chunk(0)) / (1024 * 1024)
+        try:
+            for jobs in args.jobs:
+                for _ in range(args.repeat):
+                    result = run(server, jobs, args.engine, extra_args)
+                    elapsed = result['end'] - result['start']
+                    phase = result['phases']
+                    status = ""
+                    if result['code'] != 0 or result['size'] != args.chunks * len(server.chunk(0)):
+                        status = "  (exit {}, {} bytes)".format(result['code'], result['size'])
+                    print("{:>9}{:>6}{:>9.2f}{:>8.1f}{:>9.2f}{:>9.2f}{:>10.2f}{:>8.2f}{:>9.1f}{:>8}{}".format(
+                        size, jobs, elapsed, total_mb / elapsed, phase['startup'], phase['api'],
+                        phase['download'], phase['finish'], result['peak'] / (1024 * 1024), result['errors'],
+                        status))
+        finally:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+
+Measure how long pyriscope takes to start, over a bare interpreter, on the
+help path and on the replay path (until its first API request reaches a
+local mock of the Periscope API). Exits with status 1 when a path is over
+its budget, so the numbers can be tracked from CI.
+
+Usage:
+    python benchmarks/bench_startup.py [--repeat N] [--imports N]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mockserver import MockServer
+
+
+# Contants.
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BROADCAST_URL = "https://www.periscope.tv/w/1LyxBeXmWObJN"
+# Seconds over `python -c pass`, with warm bytecode caches.
+BUDGETS = {'help': 0.10, 'replay': 0.25}
+
+
+# Functions.
+def spawn(args, work_dir, env=None):
+    command = [sys.executable] + args
+    env = dict(env or os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    subprocess.run(command, cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return start, time.perf_counter()
+
+
+def interpreter(work_dir):
+    start, end = spawn(['-c', 'pass'], work_dir)
+    return end - start
+
+
+def help_path(work_dir):
+    start, end = spawn(['-m', 'pyriscope', '--help'], work_dir)
+    return end - start
+
+
+def replay_path(work_dir, server):
+    # Up to the first API request: imports, argument parsing and set-up.
+    server.reset()
+    env = dict(os.environ, PYRISCOPE_API_URL=server.api_url, PYRISCOPE_CACHE_DIR=work_dir)
+    start = time.time()
+    spawn(['-m', 'pyriscope', BROADCAST_URL, '-n', "startup", '--no-cache', '--progress', 'none'], work_dir, env)
+    return server.requests[0][0] - start
+
+
+def slowest_imports(work_dir, count):
+    # Cumulative -X importtime of the help path, top-level imports only.
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'pyriscope', '--help'], cwd=work_dir,
+                             env=dict(os.environ, PYTHONPATH=ROOT), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    imports = []
+    for line in process.stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pyriscope start-up time.")
+    parser.add_argument('--repeat', type=int, default=9)
+    parser.add_argument('--imports', type=int, default=8, help="Show this many of the slowest imports.")
+    args = parser.parse_args()
+
+    # Write bytecode first, so compiling doesn't count against start-up.
+    subprocess.run([sys.executable, '-m', 'compileall', '-q', os.path.join(ROOT, 'pyriscope')])
+
+    server = MockServer(num_chunks=1, chunk_size=188, latency=0.0).start()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            runs = {'interpreter': [], 'help': [], 'replay': []}
+            for _ in range(args.repeat):
+                runs['interpreter'].append(interpreter(work_dir))
+                runs['help'].append(help_path(work_dir))
+                runs['replay'].append(replay_path(work_dir, server))
+            imports = slowest_imports(work_dir, args.imports)
+    finally:
+        server.stop()
+
+    baseline = statistics.median(runs['interpreter'])
+    print("{:<12}{:>10}{:>10}{:>10}{:>10}".format("path", "median", "over", "budget", "status"))
+    print("{:<12}{:>10.3f}".format("interpreter", baseline))
+    over_budget = False
+    for path in ('help', 'replay'):
+        median = statistics.median(runs[path])
+        status = "ok" if median - baseline <= BUDGETS[path] else "OVER"
+        over_budget = over_budget or status == "OVER"
+        print("{:<12}{:>10.3f}{:>10.3f}{:>10.3f}{:>10}".format(path, median, median - baseline, BUDGETS[path], status))
+
+    print("\nSlowest imports on the help path (ms, cumulative):")
+    for cumulative, name in imports:
+        print("{:>10.1f}  {}".format(cumulative / 1000, name))
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import hashlib
+import json
+import random
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlparse
+
+
+# Contants.
+DEFAULT_NUM_CHUNKS = 200
+DEFAULT_CHUNK_SIZE = 256 * 1024
+DEFAULT_LATENCY = 0.05
+REPLAY_KEY = "replay"
+API_PATH = "/api/v2"
+COOKIES = [{'Name': "CloudFront-Policy", 'Value': "bench-policy"},
+           {'Name': "CloudFront-Signature", 'Value': "bench-signature"},
+           {'Name': "CloudFront-Key-Pair-Id", 'Value': "bench-key"}]
+SEND_BLOCK_SIZE = 16 * 1024
+RANGE_PATTERN = re.compile(r'^bytes=(\d+)-(\d*)$')
+TS_PACKET_SIZE = 188
+
+
+# Classes.
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type, bandwidth=None, stall=0.0, ranges=False):
+        status = 200
+        content_range = None
+        match = RANGE_PATTERN.match(self.headers.get('Range', "")) if ranges else None
+        if match is not None:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) + 1 if match.group(2) else len(body), len(body))
+            if start >= end:
+                self.send_error(416)
+                return
+            status = 206
+            content_range = "bytes {}-{}/{}".format(start, end - 1, len(body))
+            body = body[start:end]
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if content_range is not None:
+            self.send_header("Content-Range", content_range)
+        self.end_headers()
+        if stall:
+            # A straggler: the start of the body, then nothing for a while.
+            self.wfile.write(body[:SEND_BLOCK_SIZE])
+            self.wfile.flush()
+            time.sleep(stall)
+            body = body[SEND_BLOCK_SIZE:]
+        if bandwidth is None:
+            self.wfile.write(body)
+            return
+
+        # Trickle the body out at bandwidth bytes per second.
+        start = time.monotonic()
+        for offset in range(0, len(body), SEND_BLOCK_SIZE):
+            self.wfile.write(body[offset:offset + SEND_BLOCK_SIZE])
+            delay = start + (offset + SEND_BLOCK_SIZE) / bandwidth - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def send_json(self, body):
+        self.send_body(json.dumps(body).encode(), "application/json")
+
+    def send_conditional_json(self, body):
+        # 304 when the client already has this body, going by its ETag.
+        body = json.dumps(body, sort_keys=True).encode()
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.server.num_not_modified += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+
+        path = self.path.split('?')[0]
+        query = parse_qs(urlparse(self.path).query)
+        server.record(path)
+        if path == "{}/getBroadcastPublic".format(API_PATH):
+            self.send_json(server.broadcast_public(query.get('broadcast_id', [None])[0]))
+        elif path == "{}/getAccessPublic".format(API_PATH):
+            self.send_json(server.access_public())
+        elif path == "{}/getUserBroadcastsPublic".format(API_PATH):
+            self.send_conditional_json(server.user_broadcasts(query.get('username', [""])[0]))
+        elif path == "{}/getBroadcastsPublic".format(API_PATH):
+            self.send_conditional_json(server.broadcasts_by_id(query.get('broadcast_ids', [""])[0].split(',')))
+        elif not path.startswith("/{}/".format(REPLAY_KEY)):
+            self.send_error(404)
+        elif not server.has_cookies(self.headers.get('Cookie', "")):
+            self.send_error(403)
+        elif path == "/{}/playlist.m3u8".format(REPLAY_KEY):
+            self.send_body(server.playlist(), "application/vnd.apple.mpegurl")
+        elif path.startswith("/{}/chunk_".format(REPLAY_KEY)) and path.endswith(".ts"):
+            index = path[len("/{}/chunk_".format(REPLAY_KEY)):-3]
+            if not index.isdigit() or int(index) >= server.num_chunks:
+                self.send_error(404)
+            elif server.inject_error():
+                self.send_error(503)
+            else:
+                self.send_body(server.chunk(int(index)), "video/mp2t", server.bandwidth, server.inject_stall(),
+                               server.ranges)
+        else:
+            self.send_error(404)
+
+
+class MockServer(ThreadingHTTPServer):
+    # Local stand-in for the Periscope API and replay CDN: getBroadcastPublic,
+    # getAccessPublic, a playlist and num_chunks chunks of chunk_size bytes.
+    # Broadcasts added with set_broadcast are also listed by
+    # getUserBroadcastsPublic and getBroadcastsPublic, which answer
+    # If-None-Match with a 304, and every one of them serves the same replay.
+    # Every response is delayed by latency seconds, chunk bodies are sent at
+    # bandwidth bytes per second per connection, error_rate of the chunk
+    # requests fail with a 503, and stall_rate of them stop for stall_time
+    # seconds partway through. Chunks are served in byte ranges unless
+    # ranges is False.
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, num_chunks=DEFAULT_NUM_CHUNKS, chunk_size=DEFAULT_CHUNK_SIZE, latency=DEFAULT_LATENCY,
+                 port=0, bandwidth=None, error_rate=0.0, seed=0, stall_rate=0.0, stall_time=5.0,
+                 ranges=True):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), MockHandler)
+        self.num_chunks = num_chunks
+        self.chunk_size = chunk_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall_time = stall_time
+        self.ranges = ranges
+        self.random = random.Random(seed)
+        self.num_errors = 0
+        self.num_stalls = 0
+        self.num_not_modified = 0
+        self.requests = []
+        self.broadcasts = {}
+        self.lock = Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    @property
+    def api_url(self):
+        return self.url + API_PATH
+
+    def record(self, path):
+        # Wall clock, so a client in another process can line its phases up.
+        with self.lock:
+            self.requests.append((time.time(), path))
+
+    def reset(self):
+        with self.lock:
+            self.requests = []
+            self.num_errors = 0
+            self.num_stalls = 0
+            self.num_not_modified = 0
+
+    def inject_error(self):
+        with self.lock:
+            if self.random.random() < self.error_rate:
+                self.num_errors += 1
+                return True
+        return False
+
+    def inject_stall(self):
+        with self.lock:
+            if self.random.random() < self.stall_rate:
+                self.num_stalls += 1
+                return self.stall_time
+        return 0.0
+
+    def has_cookies(self, header):
+        return all("{}={}".format(cookie['Name'], cookie['Value']) in header for cookie in COOKIES)
+
+    def set_broadcast(self, broadcast_id, username, state, available_for_replay=False):
+        with self.lock:
+            self.broadcasts[broadcast_id] = {'id': broadcast_id, 'username': username, 'state': state,
+                                             'available_for_replay': available_for_replay,
+                                             'start': "2017-01-01T00:00:00.000000000Z"}
+
+    def user_broadcasts(self, username):
+        with self.lock:
+            return {'broadcasts': [dict(broadcast) for broadcast in self.broadcasts.values()
+                                   if broadcast['username'] == username]}
+
+    def broadcasts_by_id(self, broadcast_ids):
+        with self.lock:
+            return {'broadcasts': [dict(self.broadcasts[broadcast_id]) for broadcast_id in broadcast_ids
+                                   if broadcast_id in self.broadcasts]}
+
+    def broadcast_public(self, broadcast_id=None):
+        with self.lock:
+            if broadcast_id in self.broadcasts:
+                return {'broadcast': dict(self.broadcasts[broadcast_id])}
+        return {'broadcast': {'id': REPLAY_KEY, 'state': "ENDED", 'available_for_replay': True,
+                              'username': "bench", 'start': "2017-01-01T00:00:00.000000000Z"}}
+
+    def access_public(self):
+        # Live broadcasts get the replay playlist as their stream.
+        playlist_url = "{}/{}/playlist.m3u8".format(self.url, REPLAY_KEY)
+        return {'replay_url': playlist_url, 'hls_url': playlist_url, 'cookies': COOKIES}
+
+    def playlist(self):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:3", "#EXT-X-MEDIA-SEQUENCE:0"]
+        for index in range(self.num_chunks):
+            lines.append("#EXTINF:3.000,")
+            lines.append("chunk_{}.ts".format(index))
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines).encode()
+
+    def chunk(self, index):
+        # Deterministic MPEG-TS packets, so downloads pass pyriscope's packet
+        # checks and can be compared byte for byte. chunk_size is rounded
+        # down to whole packets.
+        payload = (index.to_bytes(4, 'big') * 46)[:TS_PACKET_SIZE - 4]
+        packets = []
+        for number in range(max(self.chunk_size // TS_PACKET_SIZE, 1)):
+            header = bytes([0x47, 0x01, 0x00, 0x10 | (number % 16)])
+            packets.append(header + payload)
+        return b''.join(packets)
+
+    def download_list(self):
+        return [{'url': "{}/{}/chunk_{}.ts".format(self.url, REPLAY_KEY, index),
+                 'file_name': "chunk_{}.ts".format(index)}
+                for index in range(self.num_chunks)]
+
+    def start(self):
+        self.thread = Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,31 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+from requests.adapters import HTTPAdapter
+
+
+# Classes.
+class CountingAdapter(HTTPAdapter):
+    # HTTPAdapter that counts requests sent and TCP connections opened.
+    def __init__(self, counts, **kwargs):
+        self.counts = counts
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        counts = self.counts
+        pool_classes = {}
+        for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items():
+            class CountingConnection(pool_cls.ConnectionCls):
+                def connect(self):
+                    counts.add_connection()
+                    return super().connect()
+            pool_classes[scheme] = type(pool_cls.__name__, (pool_cls,), {'ConnectionCls': CountingConnection})
+        self.poolmanager.pool_classes_by_scheme = pool_classes
+
+    def send(self, request, **kwargs):
+        self.counts.add_request()
+        return HTTPAdapter.send(self, request, **kwargs)
@@ -0,0 +1,181 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import asyncio
+import os
+
+import aiohttp
+
+from pyriscope import processor
+from pyriscope.integrity import TsValidator
+from pyriscope.playlist import uri_file_name
+from pyriscope.processor import (ReplayDeleted, TasksInfo, check_chunk_packets, check_chunk_size, read_stored_chunk,
+                                 session_pool, stdoutnl)
+
+
+# Contants.
+RETRY_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+CHUNK_TIMEOUT = aiohttp.ClientTimeout(sock_connect=processor.CHUNK_TIMEOUT[0], sock_read=processor.CHUNK_TIMEOUT[1])
+
+
+# Classes.
+class AsyncPool:
+    # Same interface as processor.ThreadPool, but the tasks are coroutines run
+    # by num_jobs concurrent workers on a single event loop.
+    def __init__(self, name, num_jobs, num_tasks, retry_policy=None):
+        self.tasks        = []
+        self.tasks_info   = TasksInfo(name, num_tasks)
+        self.num_jobs     = num_jobs
+        self.retry_policy = retry_policy
+        self.cancelled    = False
+
+    def add_task(self, func, *args, **kwargs):
+        self.tasks.append((func, args, kwargs))
+
+    def is_complete(self):
+        return self.tasks_info.is_complete()
+
+    async def run_with_retries(self, session, func, args, kwargs, tid=None):
+        attempt = 1
+        while True:
+            try:
+                start = asyncio.get_running_loop().time()
+                if tid is not None:
+                    with processor.tracer.span(uri_file_name(args[0]), 'chunk', tid, url=args[0]) as span:
+                        num_bytes = await func(session, *args, **kwargs)
+                        span.set(bytes=num_bytes or 0)
+                else:
+                    num_bytes = await func(session, *args, **kwargs)
+                processor.metrics.record_chunk(asyncio.get_running_loop().time() - start, num_bytes or 0)
+                return num_bytes
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.retry_policy is None or not self.retry_policy.should_retry(e, attempt, RETRY_ERRORS):
+                    raise
+                # may renew cookies over HTTP, keep that off the event loop
+                delay = await asyncio.get_running_loop().run_in_executor(
+                    None, self.retry_policy.prepare_retry, e, attempt)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def worker(self, session, tasks, number):
+        # Workers share the event loop's thread, so each gets its own timeline in the trace.
+        tid = None
+        if processor.tracer is not None:
+            tid = processor.tracer.virtual_thread("{} async worker {}".format(self.tasks_info.name, number))
+        for func, args, kwargs in tasks:
+            try:
+                num_bytes = await self.run_with_retries(session, func, args, kwargs, tid)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                processor.show_error("AsyncPool Task Exception: {}".format(e))
+                self.tasks_info.task_failed(args)
+                self.tasks_info.task_done(False)
+                continue
+
+            self.tasks_info.task_done(True, num_bytes)
+
+    async def run(self):
+        connector = aiohttp.TCPConnector(limit=self.num_jobs)
+        async with aiohttp.ClientSession(connector=connector, trace_configs=[connection_counter()]) as session:
+            # All workers pull from one iterator, so chunks start in list order.
+            tasks = iter(self.tasks)
+            await asyncio.gather(*(self.worker(session, tasks, number) for number in range(self.num_jobs)))
+
+    def wait_completion(self):
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            self.cancelled = True
+            stdoutnl('Cancelling download...')
+
+        if not self.cancelled and not self.tasks_info.is_complete():
+            stdoutnl('Replay became unavailable before download finished.')
+
+
+# Functions.
+def connection_counter():
+    # Feeds the aiohttp request/connection events into the shared SessionPool counts.
+    async def on_request_start(session, context, params):
+        context.counts = session_pool.counts_for(str(params.url))
+        context.counts.add_request()
+
+    async def on_connection_create_end(session, context, params):
+        context.counts.add_connection()
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    return trace_config
+
+
+async def consume(throttle, num_bytes):
+    # The limiter blocks, so wait for it off the event loop.
+    if throttle is not None:
+        await asyncio.get_running_loop().run_in_executor(None, throttle.consume, num_bytes)
+
+
+async def download_chunk(session, url, headers, path, journal=None, throttle=None, manifest=None, store=None):
+    size = 0
+    validator = TsValidator()
+    # Never write through a hard link into the chunk store.
+    if os.path.exists(path):
+        os.remove(path)
+    # Another task may renew the shared cookies while this request runs.
+    cookie = headers.get('Cookie')
+    async with session.get(url, headers=headers, timeout=CHUNK_TIMEOUT) as data:
+        if processor.tracer is not None:
+            processor.tracer.note(status=data.status)
+        if data.status >= 400:
+            raise ReplayDeleted('Unable to download chunk {}.'.format(url), data.status, cookie)
+        with open(path, 'wb') as handle:
+            async for block in data.content.iter_chunked(4096):
+                await consume(throttle, len(block))
+                handle.write(block)
+                validator.feed(block)
+                size += len(block)
+        check_chunk_size(url, data, size)
+        check_chunk_packets(url, validator)
+
+    if journal is not None:
+        journal.record_download(os.path.basename(path), url, size, data.headers.get('ETag'), validator.report())
+    if manifest is not None:
+        manifest.add(os.path.basename(path), url, validator.report())
+    if store is not None:
+        store.add_file(os.path.basename(path), path, validator.report())
+    return size
+
+
+async def download_chunk_to_buffer(session, url, headers, index, reorder_buffer, throttle=None, store=None):
+    if store is not None and read_stored_chunk(url, index, reorder_buffer, store):
+        return 0
+
+    validator = TsValidator()
+    # Another task may renew the shared cookies while this request runs.
+    cookie = headers.get('Cookie')
+    async with session.get(url, headers=headers, timeout=CHUNK_TIMEOUT) as data:
+        if processor.tracer is not None:
+            processor.tracer.note(status=data.status)
+        if data.status >= 400:
+            raise ReplayDeleted('Unable to download chunk {}.'.format(url), data.status, cookie)
+        if throttle is None:
+            content = await data.read()
+        else:
+            blocks = []
+            async for block in data.content.iter_chunked(4096):
+                await consume(throttle, len(block))
+                blocks.append(block)
+            content = b''.join(blocks)
+        validator.feed(content)
+        check_chunk_size(url, data, len(content))
+        check_chunk_packets(url, validator)
+
+    if store is not None:
+        store.add_data(uri_file_name(url), content, validator.report())
+    reorder_buffer.put(index, content, (uri_file_name(url), url, validator.report()))
+    return len(content)
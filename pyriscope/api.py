@@ -0,0 +1,205 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import copy
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+
+from pyriscope import processor
+from pyriscope.processor import (RESULT_DOWNLOADED, BroadcastNotFound, DownloadFailed, InvalidOptions, InvalidURL,
+                                 Options, PyriscopeError, ReplayUnavailable)
+
+
+# Contants.
+DEFAULT_PARALLEL = 4
+
+
+# Classes.
+class IncompleteDownload(DownloadFailed):
+    # Some replay chunks couldn't be downloaded. What was saved is in download.
+    def __init__(self, message, url=None, download=None):
+        DownloadFailed.__init__(self, message, url)
+        self.download = download
+
+
+class ConversionFailed(PyriscopeError):
+    # The download finished, but ffmpeg didn't. The .ts is kept in download.
+    def __init__(self, message, url=None, download=None):
+        PyriscopeError.__init__(self, message, url)
+        self.download = download
+
+
+class Broadcast:
+    # A broadcast found by resolve(), with its getBroadcastPublic response.
+    def __init__(self, url_parts, broadcast_public):
+        info = broadcast_public['broadcast']
+        self.url_parts            = url_parts
+        self.broadcast_public     = broadcast_public
+        self.url                  = url_parts['url']
+        self.key                  = processor.get_broadcast_key(url_parts)
+        self.id                   = info.get('id')
+        self.state                = info.get('state')
+        self.username             = info.get('username')
+        self.start                = info.get('start')
+        self.available_for_replay = bool(info.get('available_for_replay'))
+
+    @property
+    def is_live(self):
+        return self.state == 'RUNNING'
+
+
+class Download:
+    # Where a broadcast was saved, the .mp4 once converted.
+    def __init__(self, broadcast, result, path):
+        self.broadcast  = broadcast
+        self.result     = result
+        self.path       = path
+        self.conversion = None
+
+    @property
+    def complete(self):
+        return self.result == RESULT_DOWNLOADED
+
+
+class Client:
+    # Downloads broadcasts from inside another program. Nothing is printed and
+    # nothing exits: failures are raised as PyriscopeError. Up to parallel
+    # downloads run at once in the background, sharing one set of chunk
+    # workers, the HTTP connections, the metadata cache and the chunk store.
+    # settings are other Options shared by the whole run, such as split_size,
+    # trace_file or metrics_file, set up the same way as on the command line.
+    def __init__(self, parallel=DEFAULT_PARALLEL, jobs=None, limit_rate=None, store_size=processor.DEFAULT_STORE_SIZE,
+                 quiet=True, **settings):
+        self.parallel  = parallel
+        self.jobs      = jobs
+        shared = Options()
+        if quiet:
+            processor.console = False
+            shared.progress = processor.PROGRESS_NONE
+        processor.configure(self.options(shared, limit_rate=limit_rate, store_size=store_size, **settings))
+
+        self.executor  = ThreadPoolExecutor(max_workers=parallel)
+        self.scheduler = None
+        if parallel > 1:
+            self.scheduler = processor.ChunkScheduler(jobs or processor.DEFAULT_DL_THREADS)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def resolve(self, url):
+        url_parts = processor.dissect_url(url)
+        try:
+            broadcast_public = processor.get_broadcast_public(url_parts, {'User-Agent': processor.DEFAULT_UA})
+            return Broadcast(url_parts, broadcast_public)
+        except PyriscopeError:
+            raise
+        except Exception as e:
+            raise PyriscopeError("Unable to get broadcast information: {}".format(e), url_parts['url']) from e
+
+    def options(self, options=None, progress=None, **settings):
+        # A checked copy of options, or of the defaults, with settings applied.
+        options = copy.copy(options) if options is not None else Options()
+        options.req_headers = dict(options.req_headers)
+        for key, value in settings.items():
+            if not hasattr(options, key) or key.startswith('_'):
+                raise InvalidOptions("Unknown option: {}".format(key))
+            setattr(options, key, value)
+        if options.jobs is None:
+            options.jobs = self.jobs
+        options.parallel = self.parallel
+        if progress is not None:
+            options.on_progress = progress
+        processor.check_options(options)
+        return options
+
+    def download(self, broadcast, options=None, progress=None, **settings):
+        # Starts downloading a Broadcast or URL and returns a Future of its
+        # Download, done once any conversion is too. progress is called from
+        # download threads with a dict after every chunk.
+        options = self.options(options, progress, **settings)
+        future = Future()
+        self.executor.submit(self._download, future, broadcast, options)
+        return future
+
+    def _download(self, future, broadcast, options):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            if not isinstance(broadcast, Broadcast):
+                broadcast = self.resolve(broadcast)
+            conversions = []
+            result, path = processor.process_broadcast(broadcast.url_parts, options, self.scheduler,
+                                                       conversions.append, broadcast.broadcast_public)
+        except PyriscopeError as e:
+            future.set_exception(e)
+            return
+        except Exception as e:
+            error = DownloadFailed(str(e) or type(e).__name__, getattr(broadcast, 'url', broadcast))
+            error.__cause__ = e
+            future.set_exception(error)
+            return
+
+        download = Download(broadcast, result, path)
+        if not conversions:
+            self._finish(future, download)
+            return
+        download.conversion = conversions[0]
+        download.conversion.add_done_callback(lambda conversion: self._converted(future, download))
+
+    def _converted(self, future, download):
+        try:
+            ok, errors = download.conversion.result()
+        except Exception as e:
+            ok, errors = False, str(e)
+        if not ok:
+            future.set_exception(ConversionFailed("Converting to .mp4 failed: {}".format(errors),
+                                                  download.broadcast.url, download))
+            return
+        download.path = "{}.mp4".format(os.path.splitext(download.path)[0])
+        self._finish(future, download)
+
+    def _finish(self, future, download):
+        if not download.complete:
+            future.set_exception(IncompleteDownload("Replay partially downloaded", download.broadcast.url, download))
+            return
+        future.set_result(download)
+
+    def close(self):
+        # Waits for the downloads and conversions already started.
+        self.executor.shutdown()
+        if self.scheduler is not None:
+            self.scheduler.shutdown()
+        processor.conversion_pool.wait()
+        if processor.metrics_exporter is not None:
+            processor.metrics_exporter.close()
+        if processor.tracer is not None:
+            processor.tracer.write()
+
+
+# Shared by resolve() and download().
+default_client = None
+default_client_lock = Lock()
+
+
+# Functions.
+def get_client():
+    global default_client
+    with default_client_lock:
+        if default_client is None:
+            default_client = Client()
+        return default_client
+
+
+def resolve(url):
+    return get_client().resolve(url)
+
+
+def download(broadcast, options=None, progress=None, **settings):
+    return get_client().download(broadcast, options, progress, **settings)
@@ -0,0 +1,395 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import copy
+import json
+import os
+import re
+import sys
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Thread
+
+from pyriscope.processor import (DEFAULT_DL_THREADS, RESULT_DOWNLOADED, RESULT_FAILED, RESULT_RECORDING, URL_PATTERN,
+                                 ChunkScheduler, PyriscopeError, conversion_pool, dissect_url, parse_priority,
+                                 run_broadcast, stdoutnl)
+
+
+# Contants.
+STATE_QUEUED = "queued"
+STATE_DOWNLOADING = "downloading"
+STATE_RECORDING = "recording"
+STATE_CONVERTING = "converting"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+ACTIVE_STATES = (STATE_DOWNLOADING, STATE_RECORDING, STATE_CONVERTING)
+
+
+# Classes.
+class JobQueue:
+    # Every URL handed to the daemon and the state of its job. Each change
+    # appends the job to a log, one JSON object per line with the last line
+    # of a job winning, so a restarted daemon carries on. The log is
+    # rewritten with one line per job when it is opened, and again whenever
+    # it grows to COMPACT_RATIO times that.
+    COMPACT_RATIO = 4
+    MIN_COMPACT_LINES = 1000
+
+    def __init__(self, path):
+        self.path      = path
+        self.jobs      = []
+        self.by_url    = {}
+        self.queued    = deque()
+        self.log       = None
+        self.num_lines = 0
+        self.closed    = False
+        self.cond      = Condition()
+        self._load()
+        self._compact()
+
+    def _load(self):
+        try:
+            with open(self.path) as handle:
+                text = handle.read()
+        except OSError:
+            text = ""
+
+        jobs = {}
+        try:
+            # Saved as one document by an older version.
+            for job in json.loads(text)['jobs']:
+                jobs[job['id']] = job
+        except (ValueError, KeyError, TypeError):
+            for line in text.splitlines():
+                try:
+                    job = json.loads(line)
+                except ValueError:
+                    # Torn write from an interrupted run.
+                    break
+                jobs[job['id']] = job
+
+        self.jobs = sorted(jobs.values(), key=lambda job: job['id'])
+        for job in self.jobs:
+            # Cut off by the last shutdown; the chunk journal lets it resume.
+            if job['state'] in ACTIVE_STATES:
+                job['state'] = STATE_QUEUED
+            if job['state'] == STATE_QUEUED:
+                self.queued.append(job)
+            self.by_url[job['url']] = job
+        self.next_id = max([job['id'] for job in self.jobs] + [0]) + 1
+
+    def _compact(self):
+        if self.log is not None:
+            self.log.close()
+        temp_path = "{}.{}".format(self.path, os.getpid())
+        with open(temp_path, 'w') as handle:
+            handle.write("".join(json.dumps(job) + "\n" for job in self.jobs))
+        os.replace(temp_path, self.path)
+        self.log       = open(self.path, 'a')
+        self.num_lines = len(self.jobs)
+
+    def _save(self, jobs):
+        self.log.write("".join(json.dumps(job) + "\n" for job in jobs))
+        self.log.flush()
+        self.num_lines += len(jobs)
+        if self.num_lines > max(JobQueue.MIN_COMPACT_LINES, JobQueue.COMPACT_RATIO * len(self.jobs)):
+            self._compact()
+
+    @staticmethod
+    def parse(line):
+        # A line is a URL, optionally followed by its --priority weight.
+        # (url, priority), or None if the line is invalid.
+        parts = line.split()
+        match = re.search(URL_PATTERN, parts[0]) if parts else None
+        priority = parse_priority(parts[1]) if len(parts) > 1 else None
+        if match is None or (len(parts) > 1 and priority is None):
+            return None
+        return match.group(0), priority
+
+    def add(self, line):
+        return self.add_all([line])[0]
+
+    def add_all(self, lines):
+        # The job of every line, or None for an invalid one. However many
+        # lines there are, the changes are saved with one write.
+        entries = [JobQueue.parse(line) for line in lines]
+        jobs = []
+        changed = []
+        with self.cond:
+            for entry in entries:
+                if entry is None:
+                    jobs.append(None)
+                    continue
+                url, priority = entry
+                job = self.by_url.get(url)
+                if job is None:
+                    job = {'id': self.next_id, 'url': url, 'priority': priority, 'state': STATE_QUEUED, 'detail': "",
+                           'added': time.time(), 'updated': time.time()}
+                    self.next_id += 1
+                    self.jobs.append(job)
+                    self.by_url[url] = job
+                    self.queued.append(job)
+                    changed.append(job)
+                else:
+                    if priority is not None:
+                        job['priority'] = priority
+                        changed.append(job)
+                    # Failed jobs get another go, anything else is already handled.
+                    if job['state'] == STATE_FAILED:
+                        self._set(job, STATE_QUEUED, "")
+                        changed.append(job)
+                jobs.append(job)
+            if changed:
+                self._save(changed)
+                self.cond.notify_all()
+        return jobs
+
+    def _set(self, job, state, detail=None):
+        if state == STATE_QUEUED and job['state'] != STATE_QUEUED:
+            self.queued.append(job)
+        job['state'] = state
+        if detail is not None:
+            job['detail'] = detail
+        job['updated'] = time.time()
+
+    def set_state(self, job, state, detail=None):
+        with self.cond:
+            self._set(job, state, detail)
+            self._save([job])
+            self.cond.notify_all()
+
+    def next_job(self):
+        # Blocks until a job is queued, returns None once the input is closed
+        # and nothing is left to do.
+        with self.cond:
+            while True:
+                while self.queued:
+                    job = self.queued.popleft()
+                    if job['state'] == STATE_QUEUED:
+                        self._set(job, STATE_DOWNLOADING)
+                        self._save([job])
+                        return job
+                if self.closed:
+                    return None
+                self.cond.wait(timeout=0.5)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def snapshot(self):
+        with self.cond:
+            return [dict(job) for job in self.jobs]
+
+    def counts(self):
+        counts = {}
+        for job in self.snapshot():
+            counts[job['state']] = counts.get(job['state'], 0) + 1
+        return counts
+
+
+class JobRunner(Thread):
+    def __init__(self, queue, options, scheduler, results):
+        Thread.__init__(self, daemon=True)
+        self.queue      = queue
+        self.options    = options
+        self.scheduler  = scheduler
+        self.results    = results
+        self.recordings = []
+        self.start()
+
+    def run(self):
+        while True:
+            job = self.queue.next_job()
+            if job is None:
+                break
+
+            stdoutnl("Job {}: {}".format(job['id'], job['url']))
+            options = self.options
+            if job.get('priority') is not None:
+                options = copy.copy(self.options)
+                options.priority = job['priority']
+
+            conversions = []
+            result, detail = run_broadcast(dissect_url(job['url']), options, self.scheduler, conversions.append,
+                                           self.recordings.append)
+            if result == RESULT_RECORDING:
+                # Live streams record in the background while the next job runs.
+                self.queue.set_state(job, STATE_RECORDING, detail)
+                self.recordings[-1].add_done_callback(
+                    lambda future, job=job: self.recorded(job, future, conversions))
+                continue
+            self.done(job, result, detail, conversions)
+
+        # The run isn't over until the live streams are.
+        for future in self.recordings:
+            future.exception()
+
+    def done(self, job, result, detail, conversions):
+        self.results.append((result, detail))
+        if result == RESULT_DOWNLOADED and conversions:
+            # The conversion runs in the background while the next job downloads.
+            self.queue.set_state(job, STATE_CONVERTING, detail)
+            conversions[0].add_done_callback(lambda future, job=job: self.converted(job, future))
+        elif result == RESULT_DOWNLOADED:
+            self.queue.set_state(job, STATE_DONE, detail)
+        else:
+            self.queue.set_state(job, STATE_FAILED, "{}: {}".format(result, detail))
+
+    def recorded(self, job, future, conversions):
+        try:
+            result, detail = future.result()
+        except PyriscopeError as e:
+            result, detail = RESULT_FAILED, "{}.".format(e)
+        self.done(job, result, detail, conversions)
+
+    def converted(self, job, future):
+        ok, errors = future.result()
+        if ok:
+            self.queue.set_state(job, STATE_DONE, "{}.mp4".format(job['detail'][:-3]))
+        else:
+            self.queue.set_state(job, STATE_FAILED, "Conversion failed: {}".format(errors))
+
+
+class ControlHandler(BaseHTTPRequestHandler):
+    # GET /jobs lists the queue, POST /jobs queues the URLs in the body.
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, code, body):
+        body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == "/jobs":
+            self.send_json(200, {'jobs': self.server.queue.snapshot(), 'counts': self.server.queue.counts()})
+        else:
+            self.send_json(404, {'error': "Not found."})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != "/jobs":
+            self.send_json(404, {'error': "Not found."})
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        lines = self.rfile.read(length).decode('utf-8', 'replace').splitlines()
+        jobs = self.server.queue.add_all([line for line in lines if line.strip()])
+        added = [dict(job) for job in jobs if job is not None]
+        if len(added) < len(jobs):
+            self.send_json(400, {'error': "Invalid URL.", 'jobs': added})
+        else:
+            self.send_json(201, {'jobs': added})
+
+
+# Functions.
+def add_lines(queue, lines):
+    lines = [line.strip() for line in lines]
+    lines = [line for line in lines if line and not line.startswith('#')]
+    for line, job in zip(lines, queue.add_all(lines)):
+        if job is None:
+            print("\nError: Invalid URL: {}".format(line))
+
+
+def read_stdin(queue):
+    # Line by line, so each URL is queued as soon as it is read.
+    for line in sys.stdin:
+        add_lines(queue, [line])
+
+
+def start_server(queue, port):
+    try:
+        server = ThreadingHTTPServer(('127.0.0.1', port), ControlHandler)
+    except OSError as e:
+        print("\nError: Unable to listen on port {}: {}".format(port, e))
+        sys.exit(1)
+    server.daemon_threads = True
+    server.queue = queue
+    Thread(target=server.serve_forever, daemon=True).start()
+    stdoutnl("Accepting URLs on http://127.0.0.1:{}/jobs".format(port))
+    return server
+
+
+def run(url_parts_list, options):
+    queue = JobQueue(options.queue_file)
+    add_lines(queue, [url_parts['url'] for url_parts in url_parts_list])
+
+    reader = None
+    if options.batch == '-':
+        reader = Thread(target=read_stdin, args=(queue,), daemon=True)
+        reader.start()
+    elif options.batch:
+        try:
+            with open(options.batch) as handle:
+                add_lines(queue, handle)
+        except OSError as e:
+            print("\nError: Unable to read {}: {}".format(options.batch, e))
+            sys.exit(1)
+
+    server = None
+    if options.serve_port:
+        server = start_server(queue, options.serve_port)
+
+    watcher = None
+    if options.watch_file:
+        from pyriscope.watch import Watcher, read_targets
+        try:
+            users, broadcast_ids = read_targets(options.watch_file)
+        except OSError as e:
+            print("\nError: Unable to read {}: {}".format(options.watch_file, e))
+            sys.exit(1)
+        watcher = Watcher(queue, users, broadcast_ids, options.poll_interval, options.req_headers)
+        watcher.start()
+        stdoutnl("Watching {} users and {} broadcasts.".format(len(users), len(broadcast_ids)))
+
+    scheduler = None
+    if options.parallel > 1:
+        scheduler = ChunkScheduler(options.jobs or DEFAULT_DL_THREADS)
+
+    results = []
+    runners = [JobRunner(queue, options, scheduler, results) for _ in range(options.parallel)]
+
+    try:
+        while reader is not None and reader.is_alive():
+            reader.join(timeout=0.5)
+        while watcher is not None and watcher.is_alive():
+            watcher.join(timeout=0.5)
+        # Without a control socket, the run ends once the input is used up
+        # and nothing is left to watch.
+        if server is None:
+            queue.close()
+        while runners:
+            runners = [runner for runner in runners if runner.is_alive()]
+            for runner in runners:
+                runner.join(timeout=0.5)
+    except KeyboardInterrupt:
+        stdoutnl("Stopping. Unfinished jobs stay queued in {}.".format(options.queue_file))
+        if watcher is not None:
+            watcher.stop()
+        if 'pyriscope.supervisor' in sys.modules:
+            # Keep what the live recordings captured so far.
+            from pyriscope.supervisor import live_supervisor
+            live_supervisor.stop()
+            for runner in runners:
+                runner.join(timeout=5)
+
+    if scheduler is not None:
+        scheduler.shutdown()
+    conversion_pool.wait()
+    if server is not None:
+        server.shutdown()
+
+    if watcher is not None:
+        stdoutnl("Watch: {} checks, {} unchanged, {} broadcasts queued.".format(
+            watcher.num_requests, watcher.num_not_modified, watcher.num_queued))
+    counts = queue.counts()
+    stdoutnl("Jobs: {}.".format(", ".join("{} {}".format(counts[state], state) for state in sorted(counts))))
+    return results
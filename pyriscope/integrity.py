@@ -0,0 +1,204 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import hashlib
+import json
+import os
+import time
+from threading import Lock
+
+
+# Contants.
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+TS_NULL_PID = 0x1FFF
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+# Classes.
+class TsValidator:
+    # Checks an MPEG-TS chunk block by block as it downloads: every packet
+    # starts with the sync byte and each PID's continuity counter steps by
+    # one. The SHA-256 of the chunk is computed in the same pass.
+    def __init__(self):
+        self.sha256      = hashlib.sha256()
+        self.size        = 0
+        self.packets     = 0
+        self.sync_errors = 0
+        self.cc_errors   = 0
+        self.counters    = {}
+        self.remainder   = b''
+
+    def feed(self, block):
+        self.sha256.update(block)
+        self.size += len(block)
+
+        data = self.remainder + block if self.remainder else block
+        end = len(data) - len(data) % TS_PACKET_SIZE
+        self.remainder = data[end:]
+        if end == 0:
+            return
+
+        num_packets = end // TS_PACKET_SIZE
+        self.packets += num_packets
+        # A slice of every 188th byte checks all sync bytes at C speed.
+        syncs = data[0:end:TS_PACKET_SIZE]
+        if syncs.count(TS_SYNC_BYTE) != num_packets:
+            self.sync_errors += num_packets - syncs.count(TS_SYNC_BYTE)
+            return
+        for offset in range(0, end, TS_PACKET_SIZE):
+            self._check_continuity(data, offset)
+
+    def _check_continuity(self, data, offset):
+        pid = ((data[offset + 1] & 0x1F) << 8) | data[offset + 2]
+        control = (data[offset + 3] >> 4) & 0x3
+        counter = data[offset + 3] & 0xF
+        if pid == TS_NULL_PID or not control & 0x1:
+            # No payload, so the counter doesn't advance.
+            return
+        if control & 0x2 and data[offset + 4] > 0 and data[offset + 5] & 0x80:
+            # The discontinuity indicator allows the counter to jump.
+            self.counters[pid] = counter
+            return
+
+        last = self.counters.get(pid)
+        # A repeat of the last counter is a legal duplicate packet.
+        if last is not None and counter != (last + 1) % 16 and counter != last:
+            self.cc_errors += 1
+        self.counters[pid] = counter
+
+    def is_valid(self):
+        return self.sync_errors == 0 and not self.remainder
+
+    def error(self):
+        if self.sync_errors:
+            return "{} of {} packets without a sync byte".format(self.sync_errors, self.packets)
+        if self.remainder:
+            return "{} bytes after the last whole packet".format(len(self.remainder))
+        return ""
+
+    def report(self):
+        return {'size': self.size, 'sha256': self.sha256.hexdigest(), 'packets': self.packets,
+                'sync_errors': self.sync_errors, 'cc_errors': self.cc_errors}
+
+
+class Manifest:
+    # Integrity report of one broadcast, written next to its output: every
+    # chunk's size, checksum and packet checks, the chunks that are missing,
+    # and the checksum of the whole output.
+    def __init__(self, name, key, file_names, output=None):
+        self.path       = "{}{}".format(name, MANIFEST_SUFFIX)
+        self.key        = key
+        self.output     = output or "{}.ts".format(name)
+        self.file_names = file_names
+        self.chunks     = {}
+        self.output_sha = None
+        self.error      = None
+        self.lock       = Lock()
+
+    @staticmethod
+    def completed_output(name, key):
+        # The output of an earlier download of key with no chunks missing, if
+        # it is still there and the same size.
+        try:
+            with open("{}{}".format(name, MANIFEST_SUFFIX)) as handle:
+                body = json.load(handle)
+        except (OSError, ValueError):
+            return None
+        output = body.get('output')
+        if body.get('broadcast') != key or body.get('missing') or body.get('error') or not output:
+            return None
+        if not os.path.isfile(output) or os.path.getsize(output) != body.get('size'):
+            return None
+        return output
+
+    def add(self, file_name, url, report):
+        with self.lock:
+            self.chunks[file_name] = dict(report, url=url)
+
+    def add_known(self, file_name, size):
+        # A chunk finished by an earlier run, which was not checked again.
+        with self.lock:
+            self.chunks.setdefault(file_name, {'size': size, 'resumed': True})
+
+    def set_output(self, sha256):
+        self.output_sha = sha256
+
+    def fail(self, error):
+        # The chunks are all there, but making the output from them failed.
+        self.error = error
+
+    def missing(self):
+        return [file_name for file_name in self.file_names if file_name not in self.chunks]
+
+    def write(self):
+        with self.lock:
+            chunks = [dict(self.chunks[file_name], file_name=file_name)
+                      for file_name in self.file_names if file_name in self.chunks]
+            body = {'broadcast': self.key, 'output': self.output, 'created': time.time(),
+                    'size': os.path.getsize(self.output) if os.path.exists(self.output) else 0,
+                    'sha256': self.output_sha, 'num_chunks': len(self.file_names), 'missing': self.missing(),
+                    'cc_errors': sum(chunk.get('cc_errors', 0) for chunk in chunks), 'chunks': chunks}
+            if self.error is not None:
+                body['error'] = self.error
+
+        temp_path = "{}.{}".format(self.path, os.getpid())
+        with open(temp_path, 'w') as handle:
+            json.dump(body, handle, indent=1)
+        os.replace(temp_path, self.path)
+
+
+class OrderedFeed:
+    # Feeds a TsValidator the blocks of a chunk fetched in ranges, in order,
+    # while the ranges download side by side. A block that arrives ahead of
+    # the next offset is held until the blocks before it are in.
+    def __init__(self, validator):
+        self.validator = validator
+        self.position  = 0
+        self.pending   = {}
+        self.lock      = Lock()
+
+    def feed(self, start, block):
+        with self.lock:
+            if start != self.position:
+                self.pending[start] = block
+                return
+            while block is not None:
+                self.validator.feed(block)
+                self.position += len(block)
+                block = self.pending.pop(self.position, None)
+
+
+class HashingWriter:
+    # Wraps an output handle so the whole output is hashed as it is written.
+    def __init__(self, handle, sha256=None):
+        self.handle = handle
+        self.sha256 = sha256 or hashlib.sha256()
+
+    def write(self, data):
+        self.handle.write(data)
+        self.sha256.update(data)
+
+    def flush(self):
+        self.handle.flush()
+
+    def close(self):
+        self.handle.close()
+
+
+# Functions.
+def hash_prefix(path, length):
+    # Hash of the first length bytes of a file, for outputs a resumed
+    # download appends to.
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        while length > 0:
+            data = handle.read(min(length, 1024 * 1024))
+            if not data:
+                break
+            sha256.update(data)
+            length -= len(data)
+    return sha256
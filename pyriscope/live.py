@@ -0,0 +1,185 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import os
+import shutil
+import time
+from collections import deque
+from threading import Event, Lock
+
+from pyriscope.playlist import parse_playlist
+from pyriscope import processor
+from pyriscope.processor import (DEFAULT_DL_THREADS, ChunkScheduler, ReorderBuffer, RetryPolicy, Throttle,
+                                 download_chunk_to_buffer, run_with_retries, session_pool, stdout, stdoutnl)
+
+
+# Contants.
+PLAYLIST_RETRIES = 5
+
+
+# Classes.
+class LivePool:
+    # The ChunkScheduler pool of a live recording. Unlike a replay, segments
+    # keep being added while earlier ones download.
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.tasks    = deque()
+
+    def run_task(self, func, args, kargs, stop):
+        # Retries, metrics and trace spans happen in LiveRecorder.fetch_segment,
+        # so it can skip a segment that is gone for good and each is counted once.
+        return func(*args, **kargs)
+
+    def task_done(self, ok, num_bytes=0, args=None):
+        self.recorder.segment_done(ok)
+
+
+class LiveRecorder:
+    # Polls a live HLS playlist and fetches its new segments concurrently,
+    # appending them to <name>.ts in playlist order.
+    def __init__(self, name, hls_url, req_headers, options, max_duration=None):
+        self.name           = name
+        self.hls_url        = hls_url
+        self.req_headers    = req_headers
+        self.options        = options
+        self.retry_policy   = RetryPolicy(options.retries)
+        self.throttle       = None
+        if processor.bandwidth_limiter is not None:
+            # Live segments are always served before replay chunks.
+            self.throttle = Throttle(processor.bandwidth_limiter, name, options.priority, live=True)
+        self.max_duration   = max_duration
+        self.stop           = Event()
+        self.first_sequence = None
+        self.next_sequence  = None
+        self.scheduled      = 0.0
+        self.discovered     = {}
+        self.latencies      = []
+        self.num_pending    = 0
+        self.num_written    = 0
+        self.num_bytes      = 0
+        self.start_time     = time.monotonic()
+        self.num_failed     = 0
+        self.num_dropped    = 0
+        self.lock           = Lock()
+
+    def segment_done(self, ok):
+        with self.lock:
+            self.num_pending -= 1
+            if not ok:
+                self.num_failed += 1
+
+    def segment_written(self, index, size):
+        # ReorderBuffer's on_write: the segment has reached the file.
+        with self.lock:
+            discovered = self.discovered.pop(index, None)
+            if discovered is not None and size > 0:
+                self.latencies.append(time.monotonic() - discovered)
+                self.num_written += 1
+                self.num_bytes += size
+        if self.options.on_progress is not None:
+            # Same fields as a replay's progress, a live stream has no total.
+            self.options.on_progress({'broadcast': self.name, 'chunks': self.num_written, 'failed': self.num_failed,
+                                      'total': None, 'bytes': self.num_bytes, 'eta': None,
+                                      'rate': round(self.num_bytes / max(time.monotonic() - self.start_time, 0.001))})
+        stdout("Recording stream to {}.ts: {} segments, {:.1f}s behind live edge.".format(
+            self.name, self.num_written, self.latencies[-1] if self.latencies else 0.0))
+
+    def fetch_segment(self, url, index, reorder_buffer):
+        try:
+            return run_with_retries(download_chunk_to_buffer, (url, self.req_headers, index, reorder_buffer),
+                                    {'throttle': self.throttle}, self.retry_policy, self.stop)
+        except Exception:
+            # Keep the reorder buffer moving past the missing segment.
+            reorder_buffer.put(index, b'')
+            raise
+
+    def fetch_playlist(self, url):
+        for attempt in range(1, PLAYLIST_RETRIES + 1):
+            try:
+                response = session_pool.get(url, headers=self.req_headers, timeout=10)
+                if response.ok:
+                    return response.text
+                if response.status_code in (403, 404, 410):
+                    return None
+            except Exception:
+                pass
+            if self.stop.wait(min(2 ** attempt, 10)):
+                return None
+        return None
+
+    def schedule(self, segments, ended, scheduler, pool, reorder_buffer):
+        for segment in segments:
+            sequence = segment.sequence
+            if self.first_sequence is None:
+                self.first_sequence = sequence
+                self.next_sequence = sequence
+            if sequence < self.next_sequence:
+                continue
+
+            # Segments that left the playlist before we saw them are lost.
+            while self.next_sequence < sequence:
+                reorder_buffer.put(self.next_sequence - self.first_sequence, b'')
+                self.num_dropped += 1
+                self.next_sequence += 1
+
+            if self.max_duration is not None and self.scheduled >= self.max_duration:
+                return True
+
+            index = sequence - self.first_sequence
+            with self.lock:
+                self.discovered[index] = time.monotonic()
+                self.num_pending += 1
+            scheduler.add_task(pool, (self.fetch_segment, (segment.url, index, reorder_buffer), {}))
+            self.scheduled += segment.duration
+            self.next_sequence += 1
+
+        return ended
+
+    def record(self):
+        temp_dir_name = ".pyriscope.{}".format(self.name)
+        if not os.path.exists(temp_dir_name):
+            os.makedirs(temp_dir_name)
+
+        scheduler = ChunkScheduler(self.options.jobs or DEFAULT_DL_THREADS)
+        pool = LivePool(self)
+        reorder_buffer = ReorderBuffer("{}.ts".format(self.name), temp_dir_name, self.options.buffer_size,
+                                       self.segment_written)
+
+        stdout("Recording stream to {}.ts".format(self.name))
+        playlist_url = self.hls_url
+        try:
+            while not self.stop.is_set():
+                text = self.fetch_playlist(playlist_url)
+                if text is None:
+                    break
+
+                playlist = parse_playlist(text, playlist_url)
+                if playlist.variants:
+                    playlist_url = playlist.best_variant()
+                    continue
+
+                if self.schedule(playlist.segments, playlist.ended, scheduler, pool, reorder_buffer):
+                    break
+
+                # Reload after half a target duration, per the HLS spec when nothing changed.
+                self.stop.wait(max(playlist.target_duration / 2, 0.5))
+
+            while self.num_pending > 0:
+                time.sleep(0.1)
+        except KeyboardInterrupt:
+            self.stop.set()
+            stdoutnl("Stopping recording...")
+
+        scheduler.shutdown()
+        reorder_buffer.close()
+        shutil.rmtree(temp_dir_name, ignore_errors=True)
+
+        if self.latencies:
+            stdoutnl("{}.ts: {:.0f}s recorded in {} segments ({} failed, {} dropped). "
+                     "Behind live edge: {:.1f}s average, {:.1f}s worst.".format(
+                         self.name, self.scheduled, self.num_written, self.num_failed, self.num_dropped,
+                         sum(self.latencies) / len(self.latencies), max(self.latencies)))
+        return self.num_written > 0
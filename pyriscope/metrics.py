@@ -0,0 +1,231 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import json
+import os
+import time
+from collections import deque
+from threading import Event, Lock, Thread
+
+
+# Contants.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RATE_WINDOW_SECONDS = 5.0
+EXPORT_INTERVAL = 10.0
+
+
+# Classes.
+class Histogram:
+    # Cumulative buckets, as Prometheus expects them.
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count  = 0
+        self.sum    = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    # Counters for every chunk downloaded in this run. Each broadcast's
+    # TasksInfo registers itself so its progress can be reported.
+    def __init__(self):
+        self.num_chunks     = 0
+        self.num_failed     = 0
+        self.num_bytes      = 0
+        self.num_retries    = 0
+        self.num_hedged     = 0
+        self.num_hedges_won = 0
+        self.num_split      = 0
+        self.num_ranges     = 0
+        self.latency        = Histogram(LATENCY_BUCKETS)
+        self.recent         = deque()
+        self.num_broadcasts = 0
+        self.broadcasts     = []
+        self.start_time     = time.monotonic()
+        self.lock           = Lock()
+
+    def add_broadcast(self, tasks_info):
+        # Only unfinished broadcasts are kept, so --serve and --watch don't
+        # hold on to every broadcast they ever downloaded.
+        with self.lock:
+            self.num_broadcasts += 1
+            self.broadcasts = [other for other in self.broadcasts if not other.is_finished()]
+            self.broadcasts.append(tasks_info)
+
+    def num_active(self):
+        with self.lock:
+            self.broadcasts = [tasks_info for tasks_info in self.broadcasts if not tasks_info.is_finished()]
+            return len(self.broadcasts)
+
+    def record_chunk(self, latency, num_bytes):
+        now = time.monotonic()
+        with self.lock:
+            self.num_chunks += 1
+            self.num_bytes += num_bytes
+            self.latency.observe(latency)
+            self.recent.append((now, num_bytes))
+
+    def record_failure(self):
+        with self.lock:
+            self.num_failed += 1
+
+    def record_retry(self):
+        with self.lock:
+            self.num_retries += 1
+
+    def record_hedge(self, won=False):
+        # A duplicate request sent for a straggling chunk, or one that
+        # finished before the original.
+        with self.lock:
+            if won:
+                self.num_hedges_won += 1
+            else:
+                self.num_hedged += 1
+
+    def record_split(self, num_ranges):
+        # A chunk fetched as num_ranges byte ranges at once.
+        with self.lock:
+            self.num_split += 1
+            self.num_ranges += num_ranges
+
+    def rate(self):
+        # Bytes per second over the last few seconds.
+        now = time.monotonic()
+        with self.lock:
+            while self.recent and self.recent[0][0] < now - RATE_WINDOW_SECONDS:
+                self.recent.popleft()
+            num_bytes = sum(size for _, size in self.recent)
+        return num_bytes / min(RATE_WINDOW_SECONDS, max(now - self.start_time, 0.001))
+
+    def snapshot(self):
+        with self.lock:
+            return {'chunks': self.num_chunks, 'failed': self.num_failed, 'bytes': self.num_bytes,
+                    'retries': self.num_retries, 'hedged': self.num_hedged, 'hedges_won': self.num_hedges_won,
+                    'split': self.num_split, 'ranges': self.num_ranges,
+                    'broadcasts': self.num_broadcasts,
+                    'active': sum(1 for tasks_info in self.broadcasts if not tasks_info.is_finished()),
+                    'elapsed': round(time.monotonic() - self.start_time, 3)}
+
+
+class MetricsExporter(Thread):
+    # Rewrites a Prometheus textfile every few seconds for long batch runs.
+    def __init__(self, metrics, path, interval=EXPORT_INTERVAL):
+        Thread.__init__(self, daemon=True)
+        self.metrics  = metrics
+        self.path     = path
+        self.interval = interval
+        self.stop     = Event()
+        self.start()
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        temp_path = "{}.{}".format(self.path, os.getpid())
+        try:
+            with open(temp_path, 'w') as handle:
+                handle.write(prometheus_text(self.metrics))
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
+
+    def close(self):
+        self.stop.set()
+        self.write()
+
+
+# Functions.
+def progress(tasks_info):
+    # Rate and ETA of one broadcast, from its own progress so far.
+    elapsed = max(time.monotonic() - tasks_info.start_time, 0.001)
+    rate = tasks_info.num_bytes / elapsed
+    remaining = tasks_info.num_tasks - tasks_info.num_tasks_complete - tasks_info.num_tasks_failed
+    eta = None
+    if tasks_info.num_tasks_complete > 0 and rate > 0:
+        eta = remaining * (tasks_info.num_bytes / tasks_info.num_tasks_complete) / rate
+    return rate, eta
+
+
+def json_event(event, **fields):
+    fields['event'] = event
+    fields['time'] = round(time.time(), 3)
+    return json.dumps(fields, sort_keys=True)
+
+
+def progress_fields(tasks_info):
+    rate, eta = progress(tasks_info)
+    return {'broadcast': tasks_info.name, 'chunks': tasks_info.num_tasks_complete,
+            'failed': tasks_info.num_tasks_failed, 'total': tasks_info.num_tasks, 'bytes': tasks_info.num_bytes,
+            'rate': round(rate), 'eta': None if eta is None else round(eta, 1)}
+
+
+def progress_event(tasks_info):
+    return json_event('progress', **progress_fields(tasks_info))
+
+
+def format_rate(rate):
+    for unit in ("B/s", "KB/s", "MB/s"):
+        if rate < 1024:
+            return "{:.1f} {}".format(rate, unit)
+        rate /= 1024
+    return "{:.1f} GB/s".format(rate)
+
+
+def format_eta(eta):
+    if eta is None:
+        return "--:--"
+    minutes, seconds = divmod(int(eta), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+    return "{}:{:02d}".format(minutes, seconds)
+
+
+def prometheus_text(metrics):
+    with metrics.lock:
+        lines = [
+            "# HELP pyriscope_chunks_total Replay chunks finished, by result.",
+            "# TYPE pyriscope_chunks_total counter",
+            'pyriscope_chunks_total{{result="ok"}} {}'.format(metrics.num_chunks),
+            'pyriscope_chunks_total{{result="failed"}} {}'.format(metrics.num_failed),
+            "# HELP pyriscope_bytes_total Bytes of chunk data downloaded.",
+            "# TYPE pyriscope_bytes_total counter",
+            "pyriscope_bytes_total {}".format(metrics.num_bytes),
+            "# HELP pyriscope_retries_total Chunk requests retried.",
+            "# TYPE pyriscope_retries_total counter",
+            "pyriscope_retries_total {}".format(metrics.num_retries),
+            "# HELP pyriscope_hedged_requests_total Duplicate requests for straggling chunks, and those that won.",
+            "# TYPE pyriscope_hedged_requests_total counter",
+            'pyriscope_hedged_requests_total{{result="sent"}} {}'.format(metrics.num_hedged),
+            'pyriscope_hedged_requests_total{{result="won"}} {}'.format(metrics.num_hedges_won),
+            "# HELP pyriscope_chunk_latency_seconds Time to download one chunk.",
+            "# TYPE pyriscope_chunk_latency_seconds histogram",
+        ]
+        for bound, count in zip(metrics.latency.bounds, metrics.latency.counts):
+            lines.append('pyriscope_chunk_latency_seconds_bucket{{le="{}"}} {}'.format(bound, count))
+        lines += [
+            'pyriscope_chunk_latency_seconds_bucket{{le="+Inf"}} {}'.format(metrics.latency.count),
+            "pyriscope_chunk_latency_seconds_sum {:.6f}".format(metrics.latency.sum),
+            "pyriscope_chunk_latency_seconds_count {}".format(metrics.latency.count),
+        ]
+    num_active = metrics.num_active()
+
+    lines += [
+        "# HELP pyriscope_download_rate_bytes Download rate over the last {:.0f} seconds.".format(RATE_WINDOW_SECONDS),
+        "# TYPE pyriscope_download_rate_bytes gauge",
+        "pyriscope_download_rate_bytes {:.0f}".format(metrics.rate()),
+        "# HELP pyriscope_broadcasts_active Broadcasts with chunks still to download.",
+        "# TYPE pyriscope_broadcasts_active gauge",
+        "pyriscope_broadcasts_active {}".format(num_active),
+    ]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,152 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import math
+import re
+from bisect import bisect_right
+from urllib.parse import urljoin
+
+
+# Contants.
+DURATION_PATTERN = re.compile(r'^(-)?(?:(?:(\d+):)?(\d+):)?(\d+(?:\.\d*)?)$')
+DURATION_UNIT_PATTERN = re.compile(r'^(-)?(\d+(?:\.\d*)?)(s|ms|us)$')
+DURATION_UNITS = {'s': 1.0, 'ms': 0.001, 'us': 0.000001}
+DEFAULT_TARGET_DURATION = 2.0
+
+
+# Classes.
+class Segment:
+    def __init__(self, sequence, duration, uri, url, start, discontinuity=False):
+        self.sequence      = sequence
+        self.duration      = duration
+        self.uri           = uri
+        self.url           = url
+        self.start         = start
+        self.discontinuity = discontinuity
+
+    @property
+    def end(self):
+        return self.start + self.duration
+
+    @property
+    def file_name(self):
+        return uri_file_name(self.uri)
+
+
+class Playlist:
+    # An HLS playlist. A media playlist has segments, each with its offset
+    # from the start of the playlist; a master playlist has variants.
+    def __init__(self):
+        self.target_duration = DEFAULT_TARGET_DURATION
+        self.media_sequence  = 0
+        self.segments        = []
+        self.variants        = []
+        self.ended           = False
+
+    def duration(self):
+        if not self.segments:
+            return 0.0
+        return self.segments[-1].end
+
+    def best_variant(self):
+        # URL of the highest bandwidth variant stream.
+        if not self.variants:
+            return None
+        return max(self.variants, key=lambda variant: variant[0])[1]
+
+    def window(self, start=None, end=None):
+        # Segments overlapping [start, end). Negative times count back from the
+        # end of the playlist.
+        duration = self.duration()
+        if start is None:
+            start = 0.0
+        elif start < 0:
+            start = max(duration + start, 0.0)
+        if end is None:
+            end = duration
+        elif end < 0:
+            end = duration + end
+
+        starts = [segment.start for segment in self.segments]
+        first = max(bisect_right(starts, start) - 1, 0)
+        return [segment for segment in self.segments[first:] if segment.start < end and segment.end > start]
+
+
+# Functions.
+def parse_duration(duration):
+    # ffmpeg time duration syntax: [-][[HH:]MM:]SS[.m...] or [-]S+[.m...][s|ms|us]
+    match = re.match(DURATION_UNIT_PATTERN, duration.strip())
+    if match is not None:
+        negative, seconds, unit = match.groups()
+        total = float(seconds) * DURATION_UNITS[unit]
+        return -total if negative else total
+    match = re.match(DURATION_PATTERN, duration.strip())
+    if match is None:
+        return None
+    negative, hours, minutes, seconds = match.groups()
+    total = int(hours or 0) * 3600 + int(minutes or 0) * 60 + float(seconds)
+    return -total if negative else total
+
+
+def parse_number(text, default):
+    try:
+        number = float(text)
+    except ValueError:
+        return default
+    return number if math.isfinite(number) else default
+
+
+def format_time(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{:02d}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
+def uri_file_name(uri):
+    return uri.split('?')[0].rsplit('/', 1)[-1]
+
+
+def parse_playlist(text, base_url):
+    playlist = Playlist()
+    duration = 0.0
+    start = 0.0
+    discontinuity = False
+    bandwidth = None
+    sequence = None
+
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        # A malformed number leaves the value as it was.
+        if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            playlist.media_sequence = int(parse_number(line.split(':', 1)[1], playlist.media_sequence))
+        elif line.startswith('#EXT-X-TARGETDURATION:'):
+            playlist.target_duration = parse_number(line.split(':', 1)[1], playlist.target_duration)
+        elif line.startswith('#EXTINF:'):
+            duration = parse_number(line.split(':', 1)[1].split(',')[0], 0.0)
+        elif line.startswith('#EXT-X-DISCONTINUITY'):
+            discontinuity = True
+        elif line.startswith('#EXT-X-ENDLIST'):
+            playlist.ended = True
+        elif line.startswith('#EXT-X-STREAM-INF'):
+            match = re.search(r'BANDWIDTH=(\d+)', line)
+            bandwidth = int(match.group(1)) if match else 0
+        elif line.startswith('#'):
+            continue
+        elif bandwidth is not None:
+            playlist.variants.append((bandwidth, urljoin(base_url, line)))
+            bandwidth = None
+        else:
+            if sequence is None:
+                sequence = playlist.media_sequence
+            playlist.segments.append(Segment(sequence, duration, line, urljoin(base_url, line), start, discontinuity))
+            sequence += 1
+            start += duration
+            duration = 0.0
+            discontinuity = False
+
+    return playlist
@@ -10,23 +10,36 @@ import shutil
 import string
 import re
 import json
-import requests
-import dateutil.parser
-from subprocess import PIPE, Popen
+import hashlib
+import importlib.util
+import random
+import socket
+import time
+from subprocess import DEVNULL, PIPE, Popen
 from datetime import datetime
-from dateutil import tz
+from collections import deque
 from queue import Queue, Empty
-from threading import Thread, Event
+from threading import Thread, Event, Lock, Condition, get_ident
+from urllib.parse import urlparse
+from pyriscope.integrity import HashingWriter, Manifest, OrderedFeed, TsValidator, hash_prefix
+from pyriscope.store import ChunkStore
+from pyriscope.playlist import format_time, parse_duration, parse_playlist, uri_file_name
+from pyriscope.metrics import (Metrics, MetricsExporter, format_eta, format_rate, json_event, progress, progress_event,
+                              progress_fields)
+from pyriscope.trace import NO_SPAN, Tracer
 
 
 # Contants.
 __author__ = 'Russell Harkanson'
 VERSION = "1.2.11"
-TERM_W = shutil.get_terminal_size((80, 20))[0]
-STDOUT = "\r{:<" + str(TERM_W) + "}"
-STDOUTNL = "\r{:<" + str(TERM_W) + "}\n"
-PERISCOPE_GETBROADCAST = "https://api.periscope.tv/api/v2/getBroadcastPublic?{}={}"
-PERISCOPE_GETACCESS = "https://api.periscope.tv/api/v2/getAccessPublic?{}={}"
+STDOUT = "\r{:<{}}"
+STDOUTNL = "\r{:<{}}\n"
+# PYRISCOPE_API_URL points the API calls elsewhere, e.g. at the benchmark mock server.
+PERISCOPE_API = os.environ.get('PYRISCOPE_API_URL') or "https://api.periscope.tv/api/v2"
+PERISCOPE_GETBROADCAST = PERISCOPE_API + "/getBroadcastPublic?{}={}"
+PERISCOPE_GETACCESS = PERISCOPE_API + "/getAccessPublic?{}={}"
+PERISCOPE_GETUSERBROADCASTS = PERISCOPE_API + "/getUserBroadcastsPublic?username={}&all=true"
+PERISCOPE_GETBROADCASTS = PERISCOPE_API + "/getBroadcastsPublic?broadcast_ids={}"
 ARGLIST_HELP = ('', '-h', '--h', '-help', '--help', 'h', 'help', '?', '-?', '--?')
 ARGLIST_CONVERT = ('-c', '--convert')
 ARGLIST_CLEAN = ('-C', '--clean')
@@ -34,101 +47,1301 @@ ARGLIST_ROTATE = ('-r', '--rotate')
 ARGLIST_AGENTMOCK = ('-a', '--agent')
 ARGLIST_NAME = ('-n', '--name')
 ARGLIST_TIME = ('-t')
+ARGLIST_START = ('--start',)
+ARGLIST_END = ('--end',)
+ARGLIST_DURATION = ('--duration',)
+ARGLIST_STREAM = ('-s', '--stream')
+ARGLIST_PIPE = ('--pipe',)
+ARGLIST_NATIVE = ('--native',)
+ARGLIST_BUFFER = ('--buffer',)
+ARGLIST_ENGINE = ('-e', '--engine')
+ARGLIST_JOBS = ('-j', '--jobs')
+ARGLIST_MIN_JOBS = ('--min-jobs',)
+ARGLIST_MAX_JOBS = ('--max-jobs',)
+ARGLIST_PARALLEL = ('-p', '--parallel')
+ARGLIST_RETRIES = ('--retries',)
+ARGLIST_NO_CACHE = ('--no-cache',)
+ARGLIST_BATCH = ('-b', '--batch')
+ARGLIST_SERVE = ('--serve',)
+ARGLIST_QUEUE = ('--queue',)
+ARGLIST_WATCH = ('--watch',)
+ARGLIST_WATCH_INTERVAL = ('--watch-interval',)
+ARGLIST_PROGRESS = ('--progress',)
+ARGLIST_METRICS = ('--metrics',)
+ARGLIST_LIMIT_RATE = ('--limit-rate',)
+ARGLIST_PRIORITY = ('--priority',)
+ARGLIST_STORE_SIZE = ('--store-size',)
+ARGLIST_SEGMENT_TIME = ('--segment-time',)
+ARGLIST_TRACE = ('--trace',)
+ARGLIST_HEDGE = ('--hedge',)
+ARGLIST_SPLIT_SIZE = ('--split-size',)
+CACHE_DIR = (os.environ.get('PYRISCOPE_CACHE_DIR') or
+             os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'pyriscope'))
+FFMPEG_PROBE_TIMEOUT = 10
+DEFAULT_STORE_SIZE = 0
 DEFAULT_UA = "Mozilla\/5.0 (Windows NT 6.1; WOW64) AppleWebKit\/537.36 (KHTML, like Gecko) Chrome\/45.0.2454.101 Safari\/537.36"
 DEFAULT_DL_THREADS = 6
+DEFAULT_MIN_JOBS = 2
+DEFAULT_MAX_JOBS = 32
+DEFAULT_ASYNC_JOBS = 100
+ENGINE_THREADS = "threads"
+ENGINE_ASYNC = "async"
+RESULT_DOWNLOADED = "Downloaded"
+RESULT_PARTIAL = "Partially downloaded"
+RESULT_FAILED = "Failed"
+RESULT_RECORDING = "Recording"
+DEFAULT_BUFFER_SIZE = 64 * 1024 * 1024
+DEFAULT_RETRIES = 5
+DEFAULT_HEDGE_BUDGET = 0.05
+HEDGE_POLL_INTERVAL = 0.1
+DEFAULT_QUEUE_FILE = ".pyriscope.queue.jsonl"
+DEFAULT_WATCH_INTERVAL = 60.0
+CHUNK_TIMEOUT = (10, 60)
+DEFAULT_SPLIT_SIZE = 2 * 1024 * 1024
+MAX_RANGE_PARTS = 8
+RANGE_BLOCK_SIZE = 64 * 1024
+CONTENT_RANGE_PATTERN = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+PROGRESS_BAR = "bar"
+PROGRESS_JSON = "json"
+PROGRESS_NONE = "none"
+PROGRESS_INTERVAL = 0.2
+PROGRESS_JSON_INTERVAL = 1.0
+RATE_PATTERN = re.compile(r'^(\d+(?:\.\d*)?)([kKmMgG]?)$')
+RATE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
 FFMPEG_NOROT = "ffmpeg -y -v error -i \"{0}.ts\" -bsf:a aac_adtstoasc -codec copy \"{0}.mp4\""
 FFMPEG_ROT ="ffmpeg -y -v error -i \"{0}.ts\" -bsf:a aac_adtstoasc -acodec copy -vf \"transpose=2\" -crf 30 \"{0}.mp4\""
-FFMPEG_LIVE = "ffmpeg -y -v error -headers \"Referer:{}; User-Agent:{}\" -i \"{}\" -c copy{} \"{}.ts\""
+FFMPEG_PIPE_NOROT = "ffmpeg -y -v error -f mpegts -i pipe:0 -bsf:a aac_adtstoasc -codec copy \"{0}.mp4\""
+FFMPEG_PIPE_ROT = "ffmpeg -y -v error -f mpegts -i pipe:0 -bsf:a aac_adtstoasc -acodec copy -vf \"transpose=2\" -crf 30 \"{0}.mp4\""
+FFMPEG_LIVE = "ffmpeg -y -v error -headers \"Referer:{}; User-Agent:{}\" -i \"{}\" -c copy{}{}"
+FFMPEG_LIVE_PART = " \"{}.part{:03d}.ts\""
+FFMPEG_LIVE_SEGMENT = " -f segment -segment_time {} -reset_timestamps 1 -segment_start_number {} \"{}.part%03d.ts\""
+FFMPEG_JOIN = "ffmpeg -y -v error -f concat -safe 0 -i \"{}\" -c copy \"{}.ts\""
 URL_PATTERN = re.compile(r'(http://|https://|)(www.|)(periscope.tv|perisearch.net)/(w|\S+)/(\S+)')
-REPLAY_URL = "https://{}/{}/{}"
-REPLAY_PATTERN = re.compile(r'https://(\S*).periscope.tv/(\S*)/(\S*)')
 
 # Classes.
-class ReplayDeleted(Exception):
+class PyriscopeError(Exception):
+    # Why a broadcast couldn't be downloaded. The library API raises these,
+    # the command line prints them.
+    def __init__(self, message, url=None):
+        Exception.__init__(self, message)
+        self.url = url
+
+
+class InvalidURL(PyriscopeError):
+    pass
+
+
+class InvalidOptions(PyriscopeError):
+    pass
+
+
+class BroadcastNotFound(PyriscopeError):
+    pass
+
+
+class ReplayUnavailable(PyriscopeError):
+    pass
+
+
+class DownloadFailed(PyriscopeError):
+    pass
+
+
+class ReplayDeleted(PyriscopeError):
+    # cookie is the Cookie header the failed request was sent with.
+    def __init__(self, message, status_code=None, cookie=None):
+        PyriscopeError.__init__(self, message)
+        self.status_code = status_code
+        self.cookie      = cookie
+
+
+class ChunkTruncated(Exception):
     pass
 
 
+class ChunkCorrupt(Exception):
+    pass
+
+
+class ChunkCancelled(Exception):
+    # The other request for a hedged chunk finished first.
+    pass
+
+
+class ConnectionCounts:
+    def __init__(self):
+        self.num_requests    = 0
+        self.num_connections = 0
+        self.lock            = Lock()
+
+    def add_request(self):
+        with self.lock:
+            self.num_requests += 1
+
+    def add_connection(self):
+        with self.lock:
+            self.num_connections += 1
+
+    def num_reused(self):
+        return max(self.num_requests - self.num_connections, 0)
+
+
+class SessionPool:
+    # One keep-alive requests.Session per host, shared by all Workers.
+    def __init__(self, pool_size=DEFAULT_DL_THREADS):
+        self.pool_size = pool_size
+        self.sessions  = {}
+        self.counts    = {}
+        self.lock      = Lock()
+
+    def _mount(self, host, session):
+        from pyriscope.adapter import CountingAdapter
+        adapter = CountingAdapter(self.counts[host], pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+    def resize(self, pool_size):
+        with self.lock:
+            if pool_size <= self.pool_size:
+                return
+            self.pool_size = pool_size
+            for host, session in self.sessions.items():
+                self._mount(host, session)
+
+    def session(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                import requests
+                session = requests.Session()
+                self.counts.setdefault(host, ConnectionCounts())
+                self._mount(host, session)
+                self.sessions[host] = session
+        return session
+
+    def counts_for(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            return self.counts.setdefault(host, ConnectionCounts())
+
+    def get(self, url, **kwargs):
+        return self.session(url).get(url, **kwargs)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+class Journal:
+    # Append-only log of the chunks finished for one broadcast, kept in its
+    # temp dir so an interrupted replay download can be resumed.
+    FILE_NAME = "journal.jsonl"
+
+    def __init__(self, temp_dir_name, key):
+        self.path       = "{}/{}".format(temp_dir_name, Journal.FILE_NAME)
+        self.key        = key
+        self.downloaded = {}
+        self.written    = {}
+        self.lock       = Lock()
+
+        if Journal.matches(temp_dir_name, key):
+            self._load()
+            self.handle = open(self.path, 'a')
+        else:
+            self.handle = open(self.path, 'w')
+            self._append({'broadcast': key})
+
+    @staticmethod
+    def matches(temp_dir_name, key):
+        try:
+            with open("{}/{}".format(temp_dir_name, Journal.FILE_NAME)) as handle:
+                return json.loads(handle.readline()).get('broadcast') == key
+        except (OSError, ValueError, AttributeError):
+            return False
+
+    def _load(self):
+        with open(self.path) as handle:
+            handle.readline()
+            for line in handle:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn write from an interrupted run.
+                    break
+                if entry.get('reset'):
+                    self.written = {}
+                elif 'index' in entry:
+                    self.written[entry['index']] = entry['size']
+                elif 'file_name' in entry:
+                    self.downloaded[entry['file_name']] = entry
+
+    def _append(self, entry):
+        with self.lock:
+            self.handle.write(json.dumps(entry) + "\n")
+            self.handle.flush()
+
+    def record_download(self, file_name, url, size, etag, report=None):
+        entry = {'file_name': file_name, 'url': url, 'size': size, 'etag': etag, 'status': 'complete'}
+        if report is not None:
+            entry['check'] = report
+        self.downloaded[file_name] = entry
+        self._append(entry)
+
+    def record_write(self, index, size):
+        self.written[index] = size
+        self._append({'index': index, 'size': size})
+
+    def reset_written(self):
+        self.written = {}
+        self._append({'reset': True})
+
+    def is_downloaded(self, file_name, path):
+        entry = self.downloaded.get(file_name)
+        return entry is not None and os.path.exists(path) and os.path.getsize(path) == entry['size']
+
+    def written_prefix(self):
+        # Number of leading chunks already in the output, and their total size.
+        index = offset = 0
+        while index in self.written:
+            offset += self.written[index]
+            index += 1
+        return index, offset
+
+    def close(self):
+        with self.lock:
+            self.handle.close()
+
+
+class ReorderBuffer:
+    # Appends chunks to the output file in order. Chunks that arrive ahead of
+    # the next expected one are held in memory, and the ones furthest from the
+    # head are spilled to disk once more than max_bytes is held. A chunk is
+    # added to the manifest only once it is in the output, and on_write is
+    # called with its index and size once it has been flushed there.
+    def __init__(self, path, spill_dir, max_bytes, on_write=None, start_index=0, offset=0, handle=None, digest=None,
+                 manifest=None):
+        if handle is not None:
+            self.handle = handle
+        elif start_index > 0:
+            self.handle = open(path, 'r+b')
+            self.handle.seek(offset)
+            self.handle.truncate()
+        else:
+            self.handle = open(path, 'wb')
+        self.spill_dir  = spill_dir
+        self.max_bytes  = max_bytes
+        self.on_write   = on_write
+        self.digest     = digest
+        self.manifest   = manifest
+        self.next_index = start_index
+        self.pending    = {}
+        self.spilled    = {}
+        self.skipped    = set()
+        self.entries    = {}
+        self.num_bytes  = 0
+        self.lock       = Lock()
+
+    def put(self, index, data, entry=None):
+        # entry is the chunk's (file name, url, report) for the manifest.
+        with self.lock:
+            if entry is not None and self.manifest is not None:
+                self.entries[index] = entry
+            if index != self.next_index:
+                self.pending[index] = data
+                self.num_bytes += len(data)
+                self._spill()
+                return
+
+            self._write(data)
+            self._flush()
+
+    def skip(self, index):
+        # A chunk that failed for good is left out, so the ones after it still get written.
+        with self.lock:
+            self.skipped.add(index)
+            self._flush()
+
+    def _write(self, data):
+        self.handle.write(data)
+        if self.digest is not None:
+            self.digest.update(data)
+        if self.on_write is not None:
+            self.handle.flush()
+            self.on_write(self.next_index, len(data))
+        entry = self.entries.pop(self.next_index, None)
+        if entry is not None:
+            self.manifest.add(*entry)
+        self.next_index += 1
+
+    def _spill(self):
+        while self.num_bytes > self.max_bytes and self.pending:
+            index = max(self.pending)
+            data = self.pending.pop(index)
+            self.num_bytes -= len(data)
+
+            path = "{}/chunk_{}.spill".format(self.spill_dir, index)
+            with open(path, 'wb') as spill_file:
+                spill_file.write(data)
+            self.spilled[index] = path
+
+    def _flush(self):
+        while True:
+            if self.next_index in self.pending:
+                data = self.pending.pop(self.next_index)
+                self.num_bytes -= len(data)
+            elif self.next_index in self.spilled:
+                path = self.spilled.pop(self.next_index)
+                with open(path, 'rb') as spill_file:
+                    data = spill_file.read()
+                os.remove(path)
+            elif self.next_index in self.skipped:
+                self.skipped.remove(self.next_index)
+                self.next_index += 1
+                continue
+            else:
+                return
+
+            self._write(data)
+
+    def close(self):
+        with self.lock:
+            self.handle.close()
+
+
+class BandwidthLimiter:
+    # A token bucket of rate bytes per second shared by every chunk download.
+    # When several downloads wait for tokens, live recordings go first, and
+    # replays are served in weighted fair order: each broadcast's bytes are
+    # divided by its weight and the one with the least goes next.
+    def __init__(self, rate):
+        self.rate     = rate
+        self.capacity = max(rate / 10, 16 * 1024)
+        self.tokens   = self.capacity
+        self.last     = time.monotonic()
+        self.vtime    = {}
+        self.clock    = 0.0
+        self.waiting  = []
+        self.cond     = Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self, key, num_bytes, weight=1.0, live=False):
+        with self.cond:
+            # A broadcast that was idle doesn't get to catch up on its share.
+            self.vtime[key] = max(self.vtime.get(key, 0.0), self.clock)
+            ticket = [0 if live else 1, key]
+            self.waiting.append(ticket)
+            self.cond.notify_all()
+            try:
+                while True:
+                    self._refill()
+                    head = min(self.waiting, key=lambda waiter: (waiter[0], self.vtime[waiter[1]]))
+                    if head is ticket and self.tokens > 0:
+                        # Large reads may overdraw; the debt delays whoever is next.
+                        self.tokens -= num_bytes
+                        self.clock = self.vtime[key]
+                        self.vtime[key] += num_bytes / weight
+                        return
+                    self.cond.wait(timeout=max(-self.tokens, 1) / self.rate if head is ticket else None)
+            finally:
+                self.waiting = [waiter for waiter in self.waiting if waiter is not ticket]
+                self.cond.notify_all()
+
+
+class Throttle:
+    # One broadcast's handle on the shared BandwidthLimiter.
+    def __init__(self, limiter, key, weight=1.0, live=False):
+        self.limiter = limiter
+        self.key     = key
+        self.weight  = weight
+        self.live    = live
+
+    def consume(self, num_bytes):
+        self.limiter.consume(self.key, num_bytes, self.weight, self.live)
+
+
+class ConvertPipe:
+    # Output handle for ReorderBuffer that feeds the replay to ffmpeg's stdin
+    # as it is written, and keeps a copy in <name>.ts in case ffmpeg fails.
+    # A resumed download replays the .ts written so far into ffmpeg first.
+    def __init__(self, name, options, offset=0):
+        self.name    = name
+        self.copy    = None
+        self.broken  = False
+        self.ok      = False
+        self.errors  = []
+
+        command = FFMPEG_PIPE_ROT if options.rotate else FFMPEG_PIPE_NOROT
+        self.process = Popen(command.format(name), shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        # Drain stderr so a chatty ffmpeg can't block on a full pipe.
+        self.reader  = Thread(target=lambda: self.errors.append(self.process.stderr.read()), daemon=True)
+        self.reader.start()
+
+        if offset > 0:
+            self.copy = open("{}.ts".format(name), 'r+b')
+            remaining = offset
+            while remaining > 0:
+                data = self.copy.read(min(remaining, 1024 * 1024))
+                if not data:
+                    break
+                self._feed(data)
+                remaining -= len(data)
+            self.copy.seek(offset)
+            self.copy.truncate()
+        else:
+            self.copy = open("{}.ts".format(name), 'wb')
+
+    def _feed(self, data):
+        if self.broken:
+            return
+        try:
+            self.process.stdin.write(data)
+        except (BrokenPipeError, OSError):
+            # ffmpeg gave up; keep downloading so the .ts is still complete.
+            self.broken = True
+
+    def write(self, data):
+        self.copy.write(data)
+        self._feed(data)
+
+    def flush(self):
+        self.copy.flush()
+
+    def close(self):
+        self.copy.close()
+        try:
+            self.process.stdin.close()
+        except (BrokenPipeError, OSError):
+            self.broken = True
+        self.process.wait()
+        self.reader.join()
+        self.ok = self.process.returncode == 0 and not self.broken
+
+    def error(self):
+        return b''.join(self.errors).decode('utf-8', 'replace').strip() or \
+            "ffmpeg exited with status {}.".format(self.process.returncode)
+
+
+class ConcurrencyController:
+    # Decides how many chunk requests to one host may be in flight. Every
+    # window it compares throughput, latency and errors with the previous
+    # window: errors or throttling halve the limit, gains grow it, and a
+    # growth step that bought nothing is taken back. A pinned controller
+    # keeps its limit.
+    WINDOW_SECONDS = 2.0
+    MAX_ERROR_RATE = 0.05
+    THROTTLE_STATUS_CODES = (429, 503)
+
+    def __init__(self, host, limit, min_limit, max_limit, pinned=False):
+        self.host            = host
+        self.min_limit       = min_limit
+        self.max_limit       = max_limit
+        self.limit           = min(max(limit, min_limit), max_limit)
+        self.pinned          = pinned
+        self.in_flight       = 0
+        self.last_throughput = None
+        self.last_latency    = None
+        self.last_step       = 0
+        self.decisions       = []
+        self.cond            = Condition()
+        self._reset_window()
+
+    def _reset_window(self):
+        self.window_start     = time.monotonic()
+        self.window_bytes     = 0
+        self.window_chunks    = 0
+        self.window_errors    = 0
+        self.window_throttled = False
+        self.window_latency   = 0.0
+
+    def acquire(self, stop):
+        with self.cond:
+            while self.in_flight >= self.limit:
+                if stop.is_set():
+                    return False
+                self.cond.wait(timeout=0.5)
+            self.in_flight += 1
+            return True
+
+    def try_acquire(self):
+        # A slot only if one is free right now, for the extra ranges of a chunk.
+        with self.cond:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+
+    def record(self, latency, num_bytes, error=None):
+        with self.cond:
+            self.window_chunks += 1
+            self.window_latency += latency
+            if error is None:
+                self.window_bytes += num_bytes
+            else:
+                self.window_errors += 1
+                if getattr(error, 'status_code', None) in ConcurrencyController.THROTTLE_STATUS_CODES:
+                    self.window_throttled = True
+
+            elapsed = time.monotonic() - self.window_start
+            if elapsed >= ConcurrencyController.WINDOW_SECONDS and self.window_chunks >= self.limit:
+                self._adjust(elapsed)
+
+    def _adjust(self, elapsed):
+        throughput = self.window_bytes / elapsed
+        latency = self.window_latency / self.window_chunks
+        error_rate = self.window_errors / self.window_chunks
+        old_limit = self.limit
+        step = 0
+        reason = None
+
+        if self.pinned:
+            pass
+        elif self.window_throttled or error_rate > ConcurrencyController.MAX_ERROR_RATE:
+            self.limit = max(self.min_limit, self.limit // 2)
+            reason = "throttled" if self.window_throttled else "{:.0%} errors".format(error_rate)
+        elif self.last_throughput is None or throughput > self.last_throughput * 1.1:
+            self.limit = min(self.max_limit, self.limit + max(1, self.limit // 4))
+            step = 1
+            reason = "throughput rising"
+        elif self.last_step > 0 and (throughput < self.last_throughput * 0.95 or latency > self.last_latency * 1.5):
+            self.limit = max(self.min_limit, self.limit - 1)
+            reason = "no gain from last increase"
+
+        if self.limit != old_limit:
+            decision = "{}: {} -> {} chunk requests in flight ({}, {:.1f} MB/s, {:.0f} ms/chunk).".format(
+                self.host, old_limit, self.limit, reason, throughput / (1024 * 1024), latency * 1000)
+            self.decisions.append(decision)
+            stdoutnl(decision)
+            self.cond.notify_all()
+
+        self.last_throughput = throughput
+        self.last_latency = latency
+        self.last_step = step
+        self._reset_window()
+
+
+class RetryPolicy:
+    # Decides whether a failed chunk is tried again and how long to back off
+    # first (exponential, with full jitter). Expired cookies are renewed
+    # through the AccessRefresher before the next attempt.
+    RETRY_STATUS_CODES = (408, 425, 429, 500, 502, 503, 504)
+    AUTH_STATUS_CODES = (401, 403)
+    RETRY_ERRORS = (ChunkTruncated, ChunkCorrupt, ConnectionError, TimeoutError)
+
+    def __init__(self, max_attempts=DEFAULT_RETRIES, base_delay=0.5, max_delay=30.0, refresher=None):
+        self.max_attempts = max_attempts
+        self.base_delay   = base_delay
+        self.max_delay    = max_delay
+        self.refresher    = refresher
+        self.num_retries  = 0
+        self.lock         = Lock()
+
+    def should_retry(self, error, attempt, retry_errors=()):
+        if attempt >= self.max_attempts:
+            return False
+        if isinstance(error, ReplayDeleted):
+            if error.status_code in RetryPolicy.AUTH_STATUS_CODES:
+                return self.refresher is not None
+            return error.status_code in RetryPolicy.RETRY_STATUS_CODES
+        # Loaded with the first request, long before anything fails.
+        import requests
+        return isinstance(error, RetryPolicy.RETRY_ERRORS + (requests.RequestException,) + tuple(retry_errors))
+
+    def prepare_retry(self, error, attempt):
+        # Returns how long to wait before the next attempt.
+        with self.lock:
+            self.num_retries += 1
+        metrics.record_retry()
+        if isinstance(error, ReplayDeleted) and error.status_code in RetryPolicy.AUTH_STATUS_CODES:
+            self.refresher.refresh(error.cookie)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class AccessRefresher:
+    # Re-requests getAccessPublic for a replay and swaps the new cookies into
+    # the request headers every worker of the broadcast shares. Failures
+    # that don't say which cookies they were sent with renew at most every
+    # MIN_INTERVAL seconds.
+    MIN_INTERVAL = 5.0
+
+    def __init__(self, url_parts, req_headers):
+        self.url_parts     = url_parts
+        self.req_headers   = req_headers
+        self.last_refresh  = float('-inf')
+        self.num_refreshes = 0
+        self.lock          = Lock()
+
+    def refresh(self, cookie=None):
+        # Returns the new getAccessPublic response, None if nothing was renewed.
+        with self.lock:
+            # Another worker hit the same expiry and already renewed them.
+            if cookie is not None and cookie != self.req_headers.get('Cookie'):
+                return None
+            if cookie is None and time.monotonic() - self.last_refresh < AccessRefresher.MIN_INTERVAL:
+                return None
+            stdoutnl("Replay cookies expired, renewing access.")
+            # Never hand the expired cookies to a later run, even if this fails.
+            metadata_cache.delete('access', get_broadcast_key(self.url_parts))
+            access_public = get_access_public(self.url_parts, self.req_headers)
+            self.req_headers['Cookie'] = cookie_header(access_public)
+            metadata_cache.set('access', get_broadcast_key(self.url_parts), access_public)
+            self.last_refresh = time.monotonic()
+            self.num_refreshes += 1
+            return access_public
+
+
+class MetadataCache:
+    # On-disk cache for API responses that stop changing: broadcast info and
+    # chunk lists of ended broadcasts, replay access, and the mocked
+    # User-Agent. Every kind of entry has its own time to live. Each entry is
+    # a file of its own under <path>/<kind>/, so writing one never rewrites
+    # the others, and processes sharing the cache don't undo each other.
+    TTLS = {
+        'broadcast': 7 * 24 * 3600,
+        'chunk_list': 24 * 3600,
+        'access': 5 * 60,
+        'user_agent': 24 * 3600,
+        'ffmpeg': 30 * 24 * 3600,
+    }
+    # For broadcast info that is still going to change, such as a replay
+    # that isn't available yet.
+    SHORT_TTL = 60
+
+    def __init__(self, path):
+        self.path       = path
+        self.enabled    = True
+        self.num_hits   = 0
+        self.num_misses = 0
+        self.lock       = Lock()
+
+    def _entry_path(self, kind, key):
+        return os.path.join(self.path, kind, "{}.json".format(hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+    def get(self, kind, key):
+        if not self.enabled:
+            return None
+        path = self._entry_path(kind, key)
+        try:
+            with open(path) as handle:
+                entry = json.load(handle)
+        except (OSError, ValueError):
+            entry = None
+        if entry is not None and entry['expires'] < time.time():
+            remove_quietly(path)
+            entry = None
+        with self.lock:
+            if entry is None or entry.get('key') != key:
+                self.num_misses += 1
+                return None
+            self.num_hits += 1
+        return entry['value']
+
+    def set(self, kind, key, value, ttl=None):
+        if not self.enabled:
+            return
+        if ttl is None:
+            ttl = MetadataCache.TTLS[kind]
+        path = self._entry_path(kind, key)
+        temp_path = "{}.{}.{}".format(path, os.getpid(), get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_path, 'w') as handle:
+                json.dump({'key': key, 'value': value, 'expires': time.time() + ttl}, handle)
+            os.replace(temp_path, path)
+        except OSError:
+            remove_quietly(temp_path)
+
+    def delete(self, kind, key):
+        remove_quietly(self._entry_path(kind, key))
+
+
 class TasksInfo:
     def __init__(self, name, num_tasks):
         self.name = name
         self.num_tasks = num_tasks
         self.num_tasks_complete = 0
+        self.num_tasks_failed = 0
+        self.num_bytes = 0
+        self.start_time = time.monotonic()
+        self.last_shown = 0.0
+        self.on_progress = None
+        self.on_failure = None
+        self.lock = Lock()
+        metrics.add_broadcast(self)
 
     def is_complete(self):
         return self.num_tasks_complete == self.num_tasks
 
+    def is_finished(self):
+        return self.num_tasks_complete + self.num_tasks_failed == self.num_tasks
+
+    def task_done(self, ok, num_bytes=0):
+        with self.lock:
+            if ok:
+                self.num_tasks_complete += 1
+                self.num_bytes += num_bytes or 0
+            else:
+                self.num_tasks_failed += 1
+                metrics.record_failure()
+            finished = self.is_finished()
+            self.show_progress(finished)
+        if self.on_progress is not None:
+            self.on_progress(progress_fields(self))
+        return finished
+
+    def task_failed(self, args):
+        # Called with the task's arguments once it has failed for good.
+        if self.on_failure is not None:
+            self.on_failure(*args)
+
+    def show_progress(self, force=False):
+        # Redrawing after every chunk costs real CPU on fast links.
+        now = time.monotonic()
+        interval = PROGRESS_JSON_INTERVAL if metrics.progress_mode == PROGRESS_JSON else PROGRESS_INTERVAL
+        if metrics.progress_mode == PROGRESS_NONE or (not force and now - self.last_shown < interval):
+            return
+        self.last_shown = now
+
+        if metrics.progress_mode == PROGRESS_JSON:
+            sys.stderr.write(progress_event(self) + "\n")
+            sys.stderr.flush()
+            return
+
+        perc = int((self.num_tasks_complete / self.num_tasks)*100)
+        rate, eta = progress(self)
+        sys.stdout.write(STDOUT.format("[{:>3}%] Downloading replay {}.ts. {}, ETA {}".format(
+            perc, self.name, format_rate(rate), format_eta(eta)), terminal_width()))
+        sys.stdout.flush()
+
+
+class Flight:
+    # A chunk task while it runs, with its original request and the hedged
+    # one, if any. Whichever claims the chunk first keeps it.
+    def __init__(self, func, args, kargs):
+        self.func        = func
+        self.args        = args
+        self.kargs       = kargs
+        self.start       = None
+        self.attempts    = []
+        self.winner      = None
+        self.hedged      = False
+        self.num_running = 0
+        self.reported    = False
+        self.lock        = Lock()
+
+    def attempt(self, hedge):
+        with self.lock:
+            if self.reported or self.winner is not None:
+                return None
+            attempt = Attempt(self, hedge)
+            self.attempts.append(attempt)
+            self.num_running += 1
+            return attempt
+
+    def claim(self, attempt):
+        with self.lock:
+            if self.winner is None:
+                self.winner = attempt
+                for other in self.attempts:
+                    if other is not attempt:
+                        other.abort()
+            return self.winner is attempt
+
+    def finish(self, ok, num_bytes):
+        # What to report for the chunk: the first success, or a failure once
+        # no request for it is left. None for every other request.
+        with self.lock:
+            self.num_running -= 1
+            if self.reported or (not ok and self.num_running > 0):
+                return None
+            self.reported = True
+            return ok, num_bytes
+
+
+class Attempt:
+    # One request for a chunk of a hedged pool, passed to the chunk functions
+    # as race.
+    def __init__(self, flight, hedge):
+        self.flight    = flight
+        self.hedge     = hedge
+        self.responses = []
+
+    def write_path(self, path):
+        # Each request downloads beside the chunk, the winner takes its place.
+        return "{}.{}".format(path, "hedge" if self.hedge else "part")
+
+    def lost(self):
+        winner = self.flight.winner
+        return winner is not None and winner is not self
+
+    def begin(self):
+        # The chunk straggles from when its request goes out, not from when
+        # it was queued or waiting for a concurrency slot.
+        if not self.hedge:
+            self.flight.start = time.monotonic()
+
+    def claim(self):
+        return self.flight.claim(self)
+
+    def attach(self, response):
+        with self.flight.lock:
+            self.responses.append(response)
+            if self.lost():
+                self.abort()
+
+    def detach(self, response):
+        # The connection goes back to the pool, it mustn't be cut off after that.
+        with self.flight.lock:
+            self.responses.remove(response)
+
+    def abort(self):
+        # Called with the flight locked. Shutting the sockets down makes a
+        # read blocked on a stalled server return at once.
+        for response in self.responses:
+            connection = getattr(response.raw, 'connection', None)
+            sock = getattr(connection, 'sock', None)
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class Hedger:
+    # Tail-latency cutting for one ThreadPool. Workers that run out of tasks
+    # send a second request for a straggling chunk: one running HEDGE_FACTOR
+    # times the median chunk time, or just the median once TAIL_FRACTION of
+    # the chunks are done. At most budget of the chunks are hedged, each once.
+    HEDGE_FACTOR = 3.0
+    TAIL_FRACTION = 0.9
+    MIN_DELAY = 0.5
+    MIN_SAMPLES = 3
+    NUM_SAMPLES = 64
+
+    def __init__(self, num_tasks, budget):
+        self.num_tasks  = num_tasks
+        self.max_hedges = max(1, int(num_tasks * budget))
+        self.flights    = []
+        self.latencies  = deque(maxlen=Hedger.NUM_SAMPLES)
+        self.num_done   = 0
+        self.num_hedged = 0
+        self.lock       = Lock()
+
+    def begin(self, func, args, kargs):
+        flight = Flight(func, args, kargs)
+        with self.lock:
+            self.flights.append(flight)
+        return flight.attempt(False)
+
+    def pick(self):
+        # A hedged request for the longest running straggler, or None.
+        with self.lock:
+            if self.num_hedged >= self.max_hedges or len(self.latencies) < Hedger.MIN_SAMPLES:
+                return None
+            median = sorted(self.latencies)[len(self.latencies) // 2]
+            if self.num_done >= self.num_tasks * Hedger.TAIL_FRACTION:
+                threshold = max(median, Hedger.MIN_DELAY)
+            else:
+                threshold = max(median * Hedger.HEDGE_FACTOR, Hedger.MIN_DELAY)
+            now = time.monotonic()
+            for flight in self.flights:
+                if not flight.hedged and flight.start is not None and now - flight.start >= threshold:
+                    attempt = flight.attempt(True)
+                    if attempt is None:
+                        continue
+                    flight.hedged = True
+                    self.num_hedged += 1
+                    metrics.record_hedge()
+                    return attempt
+        return None
+
+    def settle(self, attempt, ok, num_bytes):
+        # The (ok, num_bytes) to report for the chunk, None if another request
+        # for it reports.
+        flight = attempt.flight
+        result = flight.finish(ok, num_bytes)
+        if result is None:
+            return None
+        with self.lock:
+            self.flights.remove(flight)
+            self.num_done += 1
+            if ok and flight.start is not None:
+                self.latencies.append(time.monotonic() - flight.start)
+        if ok and attempt.hedge:
+            metrics.record_hedge(won=True)
+        return result
+
 
 class Worker(Thread):
     def __init__(self, thread_pool):
-        Thread.__init__(self)
-        self.tasks      = thread_pool.tasks
-        self.tasks_info = thread_pool.tasks_info
-        self.stop       = thread_pool.stop
+        # A daemon, so a hedged request that lost can't hold up the exit.
+        Thread.__init__(self, daemon=True)
+        self.thread_pool  = thread_pool
+        self.tasks        = thread_pool.tasks
+        self.tasks_info   = thread_pool.tasks_info
+        self.stop         = thread_pool.stop
+        self.controller   = thread_pool.controller
+        self.retry_policy = thread_pool.retry_policy
+        self.hedger       = thread_pool.hedger
         self.start()
 
     def run(self):
+        # Idle workers look for stragglers to hedge more often.
+        timeout = 0.5 if self.hedger is None else HEDGE_POLL_INTERVAL
         while not self.stop.is_set():
             try:
                 # don't block forever, ...
-                func, args, kargs = self.tasks.get(timeout=0.5)
+                func, args, kargs = self.tasks.get(timeout=timeout)
             except Empty:
                 # ...check periodically if we should stop
+                race = self.hedger.pick() if self.hedger is not None else None
+                if race is not None:
+                    flight = race.flight
+                    self.report(self.run_task(flight.func, flight.args, flight.kargs, race))
+                continue
+            if func is None:
+                # woken up to stop
                 continue
 
-            try: func(*args, **kargs)
-            except Exception as e:
-                print("\nError: ThreadPool Worker Exception:", e)
-                sys.exit(1)
-
-            self.tasks_info.num_tasks_complete += 1
-            perc = int((self.tasks_info.num_tasks_complete / self.tasks_info.num_tasks)*100)
-            sys.stdout.write(STDOUT.format("[{:>3}%] Downloading replay {}.ts.".format(perc, self.tasks_info.name)))
-            sys.stdout.flush()
+            race = self.hedger.begin(func, args, kargs) if self.hedger is not None else None
+            result = self.run_task(func, args, kargs, race)
 
             self.tasks.task_done()
 
-            if self.tasks_info.is_complete():
-                # stop other threads, no more work
-                self.stop.set()
+            self.report(result)
+
+    def run_task(self, func, args, kargs, race=None):
+        num_bytes = 0
+        error = None
+        retry_policy = self.retry_policy
+        controller = self.controller
+        if race is not None:
+            kargs = dict(kargs, race=race)
+            if race.hedge:
+                # The hedge is the retry. The stragglers hold the concurrency
+                # slots, the budget keeps hedges few.
+                retry_policy = None
+                controller = None
+        try:
+            num_bytes = run_with_retries(func, args, kargs, retry_policy, self.stop, controller)
+            ok = True
+        except Exception as e:
+            error = e
+            ok = False
+
+        if race is not None:
+            result = self.hedger.settle(race, ok, num_bytes)
+            if result is None:
+                return None
+            ok, num_bytes = result
+        if not ok:
+            if not isinstance(error, ChunkCancelled):
+                show_error("ThreadPool Worker Exception: {}".format(error))
+            self.tasks_info.task_failed(args)
+        return ok, num_bytes
+
+    def report(self, result):
+        if result is not None and self.tasks_info.task_done(*result):
+            # stop other threads, no more work
+            self.stop.set()
+            self.thread_pool.wake()
 
 
 class ThreadPool:
-    def __init__(self, name, num_threads, num_tasks):
-        self.tasks      = Queue(0)
-        self.tasks_info = TasksInfo(name, num_tasks)
-        self.stop       = Event()
-        self.workers    = [Worker(self) for _ in range(num_threads)]
+    def __init__(self, name, num_threads, num_tasks, controller=None, retry_policy=None, hedger=None):
+        self.tasks        = Queue(0)
+        self.tasks_info   = TasksInfo(name, num_tasks)
+        self.stop         = Event()
+        self.cancelled    = False
+        self.controller   = controller
+        self.retry_policy = retry_policy
+        self.hedger       = hedger
+        if controller is not None:
+            # enough threads for the controller's ceiling, it decides how many run
+            num_threads = controller.max_limit
+        if self.tasks_info.is_finished():
+            # nothing to do, let the workers exit straight away
+            self.stop.set()
+        self.workers      = [Worker(self) for _ in range(num_threads)]
 
     def add_task(self, func, *args, **kwargs):
         self.tasks.put((func, args, kwargs))
 
+    def wake(self):
+        # Idle workers would otherwise notice the stop only at their next timeout.
+        for _ in self.workers:
+            self.tasks.put((None, None, None))
+
     def is_complete(self):
         return self.tasks_info.is_complete()
 
     def wait_completion(self):
-        # If all workers quit because of errors, tasks.join()
-        # will never return. Join worker threads instead.
+        # Join worker threads rather than tasks, so Ctrl+C stays responsive.
         while self.workers:
             try:
                 self.workers = [w for w in self.workers if w.is_alive()]
+                if self.hedger is not None and self.tasks_info.is_finished():
+                    # all that is left are requests that lost and were cut off
+                    break
                 for worker in self.workers:
                     # don't block forever, ...
                     worker.join(timeout=0.5)
             # ...so we can gracefully abort on Ctrl+C
             except KeyboardInterrupt:
                 self.stop.set()
+                self.cancelled = True
                 stdoutnl('Cancelling download...')
 
-        if not self.stop.is_set() and not self.tasks_info.is_complete():
+        if not self.cancelled and not self.tasks_info.is_complete():
             stdoutnl('Replay became unavailable before download finished.')
 
 
+class ScheduledPool:
+    # One broadcast's share of a ChunkScheduler, with the ThreadPool interface.
+    def __init__(self, scheduler, name, num_tasks, retry_policy=None):
+        self.scheduler    = scheduler
+        self.tasks        = deque()
+        self.tasks_info   = TasksInfo(name, num_tasks)
+        self.retry_policy = retry_policy
+        self.done         = Event()
+        if self.tasks_info.is_finished():
+            self.done.set()
+
+    def add_task(self, func, *args, **kwargs):
+        self.scheduler.add_task(self, (func, args, kwargs))
+
+    def is_complete(self):
+        return self.tasks_info.is_complete()
+
+    def run_task(self, func, args, kargs, stop):
+        return run_with_retries(func, args, kargs, self.retry_policy, stop)
+
+    def task_done(self, ok, num_bytes=0, args=None):
+        if not ok:
+            self.tasks_info.task_failed(args)
+        if self.tasks_info.task_done(ok, num_bytes):
+            self.done.set()
+
+    def wait_completion(self):
+        while not self.done.wait(timeout=0.5):
+            if self.scheduler.stop.is_set():
+                return
+
+        if not self.tasks_info.is_complete():
+            stdoutnl('Replay became unavailable before download finished.')
+
+
+class SchedulerWorker(Thread):
+    def __init__(self, scheduler):
+        Thread.__init__(self, daemon=True)
+        self.scheduler = scheduler
+        self.start()
+
+    def run(self):
+        while True:
+            pool, task = self.scheduler.next_task()
+            if pool is None:
+                return
+
+            func, args, kargs = task
+            try:
+                num_bytes = pool.run_task(func, args, kargs, self.scheduler.stop)
+            except Exception as e:
+                show_error("ThreadPool Worker Exception: {}".format(e))
+                pool.task_done(False, args=args)
+            else:
+                pool.task_done(True, num_bytes)
+
+
+class ChunkScheduler:
+    # A fixed set of download workers shared by concurrent broadcasts. Each
+    # broadcast queues its chunks in its own ScheduledPool, and the workers
+    # take one chunk from each pool with queued work in turn.
+    def __init__(self, num_threads):
+        self.pools   = deque()
+        self.cond    = Condition()
+        self.stop    = Event()
+        self.workers = [SchedulerWorker(self) for _ in range(num_threads)]
+
+    def pool(self, name, num_tasks, retry_policy=None):
+        return ScheduledPool(self, name, num_tasks, retry_policy)
+
+    def add_task(self, pool, task):
+        with self.cond:
+            if not pool.tasks:
+                self.pools.append(pool)
+            pool.tasks.append(task)
+            self.cond.notify()
+
+    def next_task(self):
+        with self.cond:
+            while not self.pools:
+                if self.stop.is_set():
+                    return None, None
+                self.cond.wait(timeout=0.5)
+            if self.stop.is_set():
+                return None, None
+
+            pool = self.pools.popleft()
+            task = pool.tasks.popleft()
+            if pool.tasks:
+                self.pools.append(pool)
+            return pool, task
+
+    def shutdown(self):
+        self.stop.set()
+        with self.cond:
+            self.cond.notify_all()
+
+
+class ConversionPool:
+    # Runs ffmpeg conversions in the background, at most one per CPU core, so
+    # the downloads of later broadcasts don't wait for them.
+    def __init__(self, num_workers=None):
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.executor    = None
+        self.futures     = []
+        self.lock        = Lock()
+
+    def submit(self, name, options):
+        with self.lock:
+            if self.executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+            future = self.executor.submit(convert_ts, name, options)
+            self.futures.append(future)
+        return future
+
+    def add(self, ok, errors):
+        # A conversion that already ran elsewhere, through a ConvertPipe.
+        from concurrent.futures import Future
+        future = Future()
+        future.set_result((ok, errors))
+        with self.lock:
+            self.futures.append(future)
+        return future
+
+    def wait(self):
+        # (ok, ffmpeg stderr) of every conversion submitted so far. Shutting
+        # the executor down also waits for the futures' done callbacks.
+        with self.lock:
+            executor, self.executor = self.executor, None
+            futures = list(self.futures)
+        if executor is not None:
+            executor.shutdown()
+        return [future.result() for future in futures]
+
+
+class Options:
+    # Settings shared by every broadcast in one run.
+    def __init__(self):
+        self.ffmpeg        = True
+        self.convert       = False
+        self.clean         = False
+        self.rotate        = False
+        self.agent_mocking = False
+        self.name          = ""
+        self.live_duration = ""
+        self.native_live   = False
+        self.segment_time  = None
+        self.start_time    = None
+        self.end_time      = None
+        self.duration      = None
+        self.stream        = False
+        self.pipe          = False
+        self.buffer_size   = DEFAULT_BUFFER_SIZE
+        self.engine        = ENGINE_THREADS
+        self.jobs          = None
+        self.min_jobs      = DEFAULT_MIN_JOBS
+        self.max_jobs      = DEFAULT_MAX_JOBS
+        self.parallel      = 1
+        self.retries       = DEFAULT_RETRIES
+        self.hedge_budget  = DEFAULT_HEDGE_BUDGET
+        self.split_size    = DEFAULT_SPLIT_SIZE
+        self.cache         = True
+        self.batch         = None
+        self.serve_port    = None
+        self.queue_file    = DEFAULT_QUEUE_FILE
+        self.watch_file    = None
+        self.poll_interval = DEFAULT_WATCH_INTERVAL
+        self.progress      = PROGRESS_BAR
+        self.metrics_file  = None
+        self.trace_file    = None
+        self.limit_rate    = None
+        self.priority      = 1.0
+        self.store_size    = DEFAULT_STORE_SIZE
+        self.on_progress   = None
+        self.req_headers   = {}
+
+
+# Console output, turned off when pyriscope is used as a library.
+console = True
+
+# Chunk counters and progress reporting for the whole run.
+metrics = Metrics()
+metrics.progress_mode = PROGRESS_BAR
+metrics_exporter = None
+
+# Timed spans of the run, set by --trace.
+tracer = None
+
+# Download bandwidth shared by every broadcast, set by --limit-rate.
+bandwidth_limiter = None
+
+# Replay chunks kept between runs, set by --store-size.
+chunk_store = None
+
+# Shared HTTP connection pool.
+session_pool = SessionPool()
+
+# API responses kept between runs.
+metadata_cache = MetadataCache(os.path.join(CACHE_DIR, 'metadata'))
+
+# What the ffmpeg on PATH can do, in the same place but left on by --no-cache.
+ffmpeg_cache = MetadataCache(os.path.join(CACHE_DIR, 'metadata'))
+ffmpeg_probe = None
+
+# Output width, measured on the first progress line.
+term_width = None
+
+# ffmpeg conversions, shared by every broadcast in one run.
+conversion_pool = ConversionPool()
+
+# Chunk concurrency per host and job limits, kept across broadcasts in one run.
+controllers = {}
+controllers_lock = Lock()
+
+# Replay chunks larger than this are fetched as parallel byte ranges, set by
+# --split-size. Hosts that turned out not to serve ranges are in range_hosts.
+split_size = DEFAULT_SPLIT_SIZE
+range_hosts = {}
+range_executor = None
+range_executor_lock = Lock()
+
+
 # Functions.
 def show_help():
-    if shutil.which("ffmpeg") is not None:
-        ffmpeg_status = "FOUND! Live stream recording and conversion/rotation is available!"
+    probe = probe_ffmpeg()
+    if probe:
+        ffmpeg_status = "FOUND! (version {}) Live stream recording and conversion/rotation is available!".format(
+            probe['version'] or "unknown")
     else:
-        ffmpeg_status = "NOT FOUND! Live stream recording and conversion/rotation is NOT available."
+        ffmpeg_status = "NOT FOUND! Conversion/rotation is NOT available. Live streams use the built-in recorder."
 
     print("""version {}
 
@@ -149,6 +1362,34 @@ options:
     -a, --agent             Turn on random user agent mocking. (Adds extra HTTP request)
     -n, --name <file>       Name the file (for single URL input only).
     -t <duration>           The duration (defined by ffmpeg) to record live streams.
+    --segment-time <time>   Split live recordings into parts of this length instead of joining them. (Requires ffmpeg)
+    --start <time>          Download the replay from this time on. Negative times count back from the end.
+    --end <time>            Download the replay up to this time.
+    --duration <time>       Download this much of the replay, from --start or the beginning.
+    --native                Record live streams with the built-in parallel HLS recorder instead of ffmpeg.
+    -s, --stream            Write replay chunks straight to the .ts as they arrive.
+    --pipe                  Convert while downloading by streaming chunks into ffmpeg. With -C, the .ts is then deleted.
+    -e, --engine <engine>   Replay download engine: threads or async. (async requires aiohttp)
+    -j, --jobs <n>          Number of chunks to download at once. (Default: adaptive threads, {} async)
+    --min-jobs <n>          Lower bound for adaptive threaded downloads. (Default: {})
+    --max-jobs <n>          Upper bound for adaptive threaded downloads. (Default: {})
+    -p, --parallel <n>      Number of broadcasts to download at once, sharing the --jobs limit. (Default: 1)
+    --retries <n>           Attempts per replay chunk before giving up on it. (Default: {})
+    --hedge <fraction>      Share of chunks that may get a second request when they straggle. 0 turns it off. (Default: {:g})
+    --split-size <size>     Fetch replay chunks larger than this as parallel byte ranges. 0 turns it off. (Default: 2M)
+    --no-cache              Don't read or write the broadcast metadata cache.
+    -b, --batch <file>      Queue the URLs listed in a file, one per line. Use - for stdin.
+    --serve <port>          Keep running and accept URLs over HTTP on 127.0.0.1:<port>.
+    --queue <file>          Job queue file for --batch/--serve/--watch. (Default: {})
+    --watch <file>          Keep running and queue every new live stream or replay of the users and broadcasts listed.
+    --watch-interval <s>    Seconds between checks of each watched user or broadcast. (Default: {:g})
+    --progress <mode>       Progress output: bar, json (JSON lines on stderr) or none. (Default: bar)
+    --metrics <file>        Keep a Prometheus textfile of download counters up to date.
+    --trace <file>          Write timed spans of every phase and chunk as Chrome trace JSON, and list the slowest.
+    --limit-rate <rate>     Cap the total download rate, in bytes per second. Accepts K, M and G suffixes.
+    --priority <weight>     Share of the --limit-rate budget relative to other broadcasts. (Default: 1)
+    --store-size <size>     Keep up to this many bytes of replay chunks for later runs, e.g. 1G. (Default: 0, off)
+    --buffer <MB>           With --stream, memory held for out-of-order chunks before spilling to disk. (Default: {})
 
 ffmpeg status:
     {}
@@ -161,10 +1402,54 @@ About:
 
     Pyriscope is open source, with a public repo on Github.
         https://github.com/rharkanson/pyriscope
-        """.format(VERSION, ffmpeg_status, __author__))
+        """.format(VERSION, DEFAULT_ASYNC_JOBS, DEFAULT_MIN_JOBS, DEFAULT_MAX_JOBS, DEFAULT_RETRIES,
+                   DEFAULT_HEDGE_BUDGET, DEFAULT_QUEUE_FILE, DEFAULT_WATCH_INTERVAL,
+                   DEFAULT_BUFFER_SIZE // (1024 * 1024),
+                   ffmpeg_status, __author__))
     sys.exit(0)
 
 
+def probe_ffmpeg():
+    # Path, version and encoders of the ffmpeg on PATH, or {} without one.
+    # Running ffmpeg takes longer than the rest of start-up, so the result is
+    # cached until the binary changes.
+    global ffmpeg_probe
+    if ffmpeg_probe is not None:
+        return ffmpeg_probe
+
+    path = shutil.which("ffmpeg")
+    if path is None:
+        ffmpeg_probe = {}
+        return ffmpeg_probe
+
+    stat = os.stat(path)
+    key = "{}:{}:{}".format(path, stat.st_size, stat.st_mtime)
+    probe = ffmpeg_cache.get('ffmpeg', key)
+    if probe is None:
+        probe = {'path': path, 'version': None, 'encoders': []}
+        try:
+            version = Popen([path, '-hide_banner', '-version'], stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL)
+            lines = version.communicate(timeout=FFMPEG_PROBE_TIMEOUT)[0].decode('utf-8', 'replace').splitlines()
+            if lines and lines[0].startswith("ffmpeg version "):
+                probe['version'] = lines[0].split()[2]
+
+            encoders = Popen([path, '-hide_banner', '-encoders'], stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL)
+            lines = encoders.communicate(timeout=FFMPEG_PROBE_TIMEOUT)[0].decode('utf-8', 'replace').splitlines()
+            # The list follows a " ------" line, one "<flags> <name> <description>" per encoder.
+            listed = False
+            for line in lines:
+                if listed and len(line.split()) > 1:
+                    probe['encoders'].append(line.split()[1])
+                listed = listed or line.strip().startswith("---")
+        except Exception:
+            # An ffmpeg that can't answer is left for the conversion to report.
+            pass
+        ffmpeg_cache.set('ffmpeg', key, probe)
+
+    ffmpeg_probe = probe
+    return ffmpeg_probe
+
+
 def dissect_url(url):
     match = re.search(URL_PATTERN, url)
     parts = {}
@@ -180,49 +1465,117 @@ def dissect_url(url):
             parts['token'] = ""
 
     except:
-        print("\nError: Invalid URL: {}".format(url))
-        sys.exit(1)
-
-    return parts
-
-
-def dissect_replay_url(url):
-    match = re.search(REPLAY_PATTERN, url)
-    parts = {}
-
-    try:
-        parts['key'] = match.group(2)
-        parts['file'] = match.group(3)
-
-    except:
-        print("\nError: Invalid Replay URL: {}".format(url))
-        sys.exit(1)
+        raise InvalidURL("Invalid URL", url)
 
     return parts
 
 
 def get_mocked_user_agent():
     try:
-        response = requests.get("http://api.useragent.io/")
+        response = session_pool.get("http://api.useragent.io/")
         response = json.loads(response.text)
         return response['ua']
     except:
         try:
-            response = requests.get("http://labs.wis.nu/ua/")
+            response = session_pool.get("http://labs.wis.nu/ua/")
             response = json.loads(response.text)
             return response['ua']
         except:
             return DEFAULT_UA
 
 
+def get_broadcast_key(url_parts):
+    return url_parts['broadcast_id'] if url_parts['token'] == "" else url_parts['token']
+
+
+def get_access_public(url_parts, req_headers):
+    if url_parts['token'] == "":
+        req_url = PERISCOPE_GETACCESS.format("broadcast_id", url_parts['broadcast_id'])
+    else:
+        req_url = PERISCOPE_GETACCESS.format("token", url_parts['token'])
+
+    with trace("getAccessPublic", 'api') as span:
+        response = session_pool.get(req_url, headers=req_headers)
+        span.set(status=response.status_code)
+    return json.loads(response.text)
+
+
+def get_broadcast_public(url_parts, req_headers):
+    # Public Periscope API call to get information about the broadcast.
+    broadcast_key = get_broadcast_key(url_parts)
+    broadcast_public = metadata_cache.get('broadcast', broadcast_key)
+    if broadcast_public is not None:
+        return broadcast_public
+
+    if url_parts['token'] == "":
+        req_url = PERISCOPE_GETBROADCAST.format("broadcast_id", url_parts['broadcast_id'])
+    else:
+        req_url = PERISCOPE_GETBROADCAST.format("token", url_parts['token'])
+
+    stdout("Downloading broadcast information.")
+    with trace("getBroadcastPublic", 'api') as span:
+        response = session_pool.get(req_url, headers=req_headers)
+        span.set(status=response.status_code)
+    broadcast_public = json.loads(response.text)
+
+    if 'success' in broadcast_public and broadcast_public['success'] == False:
+        raise BroadcastNotFound("Video expired/deleted/wasn't found", url_parts['url'])
+
+    # Only the information of an ended broadcast with its replay up is final.
+    info = broadcast_public['broadcast']
+    if info['state'] != 'RUNNING':
+        ttl = None if info.get('available_for_replay') else MetadataCache.SHORT_TTL
+        metadata_cache.set('broadcast', broadcast_key, broadcast_public, ttl)
+    return broadcast_public
+
+
+def cookie_header(access_public):
+    cookiestr = ""
+    for cookie in access_public['cookies']:
+        cookiestr = cookiestr + "{}={};".format(cookie['Name'], cookie['Value'])
+    return cookiestr
+
+
+def trace(name, category, **args):
+    # A span for --trace. While tracing is off, this call is all it costs.
+    if tracer is None:
+        return NO_SPAN
+    return tracer.span(name, category, **args)
+
+
+def terminal_width():
+    global term_width
+    if term_width is None:
+        term_width = shutil.get_terminal_size((80, 20))[0]
+    return term_width
+
+
 def stdout(s):
-    sys.stdout.write(STDOUT.format(s))
-    sys.stdout.flush()
+    if console:
+        sys.stdout.write(STDOUT.format(s, terminal_width()))
+        sys.stdout.flush()
 
 
 def stdoutnl(s):
-    sys.stdout.write(STDOUTNL.format(s))
-    sys.stdout.flush()
+    if console:
+        sys.stdout.write(STDOUTNL.format(s, terminal_width()))
+        sys.stdout.flush()
+
+
+def show(s):
+    if console:
+        print(s)
+
+
+def show_error(s):
+    show("\nError: {}".format(s))
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
 
 
 def sanitize(s):
@@ -231,35 +1584,594 @@ def sanitize(s):
     return sanitized
 
 
-def download_chunk(url, headers, path):
-    with open(path, 'wb') as handle:
-        data = requests.get(url, stream=True, headers=headers)
+def check_chunk_size(url, data, size):
+    # Content-Length counts encoded bytes, so only plain bodies can be checked.
+    if data.headers.get('Content-Encoding', 'identity') != 'identity':
+        return
+    expected = data.headers.get('Content-Length')
+    if expected is not None and expected.isdigit() and int(expected) != size:
+        raise ChunkTruncated('Chunk {} truncated: {} of {} bytes.'.format(url, size, expected))
+
+
+def check_chunk_packets(url, validator):
+    if not validator.is_valid():
+        raise ChunkCorrupt('Chunk {} is not valid MPEG-TS: {}.'.format(url, validator.error()))
+
+
+def first_range_headers(url, headers, controller=None):
+    # Asks for the first split_size bytes of a chunk. A 206 answer gives the
+    # chunk's full size, so this request is also the probe for splitting it.
+    # Only chunks with a concurrency controller to take slots from are split.
+    if not split_size or controller is None or not range_hosts.get(urlparse(url).netloc, True):
+        return headers
+    headers = dict(headers)
+    headers['Range'] = "bytes=0-{}".format(split_size - 1)
+    # Ranges of a compressed body can't be read on their own.
+    headers['Accept-Encoding'] = "identity"
+    return headers
+
+
+def split_point(url, data):
+    # (end of the first range, chunk size) of a chunk to fetch in ranges, or
+    # None if data holds the whole chunk.
+    if 'Range' not in data.request.headers:
+        return None
+    host = urlparse(url).netloc
+    if data.status_code != 206:
+        # The host ignores ranges, don't ask it again.
+        range_hosts[host] = False
+        return None
+    range_hosts[host] = True
+    match = re.match(CONTENT_RANGE_PATTERN, data.headers.get('Content-Range', ""))
+    if match is None or int(match.group(1)) != 0:
+        raise ChunkTruncated('Chunk {} has an unexpected range: {}.'.format(url, data.headers.get('Content-Range')))
+    end, size = int(match.group(2)) + 1, int(match.group(3))
+    if end >= size:
+        return None
+    return end, size
+
+
+def preallocate(handle, size):
+    handle.truncate(size)
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(handle.fileno(), 0, size)
+        except OSError:
+            pass
+
+
+def download_ranges(url, headers, data, target, split, throttle=None, race=None, controller=None, feed=None):
+    # Reads the first range of a chunk from data while the range pool fetches
+    # the rest, in up to MAX_RANGE_PARTS - 1 requests. Each of those takes a
+    # slot of the host's controller that is free right now, so -j still
+    # bounds the requests in flight. With none free, the rest is fetched in
+    # one request after the first range, under this request's own slot.
+    # Each range is written straight into target at its offset: a bytearray,
+    # or the path of a preallocated file, and handed to feed if there is one.
+    # The first failure stops every range.
+    first_end, size = split
+    num_parts = min(-(-(size - first_end) // split_size), MAX_RANGE_PARTS - 1)
+    num_slots = 0
+    while controller is not None and num_slots < num_parts and controller.try_acquire():
+        num_slots += 1
+    part_size = -(-(size - first_end) // max(num_slots, 1))
+    starts = range(first_end, size, part_size)
+    for _ in range(num_slots - len(starts)):
+        controller.release()
+    etag = data.headers.get('ETag')
+    stop = Event()
+    futures = []
+    if num_slots > 0:
+        futures = [submit_range(fetch_range_in_slot, controller, url, headers, target, start,
+                                min(start + part_size, size), etag, throttle, race, stop, feed)
+                   for start in starts]
+    metrics.record_split(len(starts) + 1)
+    try:
+        read_range(url, data, target, 0, first_end, throttle, race, stop, feed)
+        if not futures:
+            fetch_range(url, headers, target, first_end, size, etag, throttle, race, stop, feed)
+    except Exception:
+        stop.set()
+        raise
+    finally:
+        for future in futures:
+            future.exception()
+    for future in futures:
+        future.result()
+
+
+def fetch_range(url, headers, target, start, end, etag, throttle=None, race=None, stop=None, feed=None):
+    headers = dict(headers, Range="bytes={}-{}".format(start, end - 1))
+    headers['Accept-Encoding'] = "identity"
+    if etag:
+        # A changed chunk comes back whole instead of as a range of it.
+        headers['If-Range'] = etag
+    try:
+        data = session_pool.get(url, stream=True, headers=headers, timeout=CHUNK_TIMEOUT)
+        if race is not None:
+            race.attach(data)
+        try:
+            if not data.ok:
+                raise ReplayDeleted('Unable to download chunk {}.'.format(url), data.status_code,
+                                    data.request.headers.get('Cookie'))
+            match = re.match(CONTENT_RANGE_PATTERN, data.headers.get('Content-Range', ""))
+            if data.status_code != 206 or match is None or \
+                    (int(match.group(1)), int(match.group(2)) + 1) != (start, end):
+                raise ChunkTruncated('Chunk {} changed while its ranges were downloading.'.format(url))
+            read_range(url, data, target, start, end, throttle, race, stop, feed)
+        finally:
+            if race is not None:
+                race.detach(data)
+            data.close()
+    except Exception:
+        stop.set()
+        raise
+
+
+def fetch_range_in_slot(controller, *args):
+    # A range run on the range pool, with a concurrency slot taken for it.
+    try:
+        fetch_range(*args)
+    finally:
+        controller.release()
 
+
+def read_range(url, data, target, start, end, throttle=None, race=None, stop=None, feed=None):
+    handle = None
+    if not isinstance(target, bytearray):
+        handle = open(target, 'r+b')
+        handle.seek(start)
+    position = start
+    try:
+        for block in data.iter_content(RANGE_BLOCK_SIZE):
+            check_race(url, race)
+            if stop is not None and stop.is_set():
+                raise ChunkTruncated('Chunk {} stopped: another of its ranges failed.'.format(url))
+            if position + len(block) > end:
+                raise ChunkTruncated('Chunk {} sent more than the range asked for.'.format(url))
+            if throttle is not None:
+                throttle.consume(len(block))
+            if handle is None:
+                target[position:position + len(block)] = block
+            else:
+                handle.write(block)
+            if feed is not None:
+                feed.feed(position, block)
+            position += len(block)
+    finally:
+        if handle is not None:
+            handle.close()
+    if position != end:
+        raise ChunkTruncated('Chunk {} truncated: {} of {} bytes.'.format(url, position - start, end - start))
+
+
+def submit_range(func, *args):
+    global range_executor
+    with range_executor_lock:
+        if range_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            range_executor = ThreadPoolExecutor(max_workers=DEFAULT_MAX_JOBS, thread_name_prefix="range")
+    return range_executor.submit(func, *args)
+
+
+def check_race(url, race):
+    if race is not None and race.lost():
+        raise ChunkCancelled('Chunk {} was downloaded by another request.'.format(url))
+
+
+def download_chunk(url, headers, path, journal=None, throttle=None, manifest=None, store=None, race=None,
+                   controller=None):
+    size = 0
+    validator = TsValidator()
+    check_race(url, race)
+    if race is not None:
+        race.begin()
+    write_path = path if race is None else race.write_path(path)
+    # Never write through a hard link into the chunk store.
+    if os.path.exists(write_path):
+        os.remove(write_path)
+    try:
+        with open(write_path, 'wb') as handle:
+            data = session_pool.get(url, stream=True, headers=first_range_headers(url, headers, controller),
+                                    timeout=CHUNK_TIMEOUT)
+            if tracer is not None:
+                tracer.note(status=data.status_code)
+            if race is not None:
+                race.attach(data)
+
+            try:
+                if not data.ok:
+                    raise ReplayDeleted('Unable to download chunk {}.'.format(url), data.status_code,
+                                        data.request.headers.get('Cookie'))
+                split = split_point(url, data)
+                if split is None:
+                    for block in data.iter_content(4096):
+                        check_race(url, race)
+                        if throttle is not None:
+                            throttle.consume(len(block))
+                        handle.write(block)
+                        validator.feed(block)
+                        size += len(block)
+                    check_chunk_size(url, data, size)
+                else:
+                    size = split[1]
+                    preallocate(handle, size)
+                    # Checked in order as the ranges are written.
+                    download_ranges(url, headers, data, write_path, split, throttle, race, controller,
+                                    OrderedFeed(validator))
+                check_chunk_packets(url, validator)
+            except Exception:
+                # Whatever went wrong after the other request won is down to it.
+                check_race(url, race)
+                raise
+            finally:
+                if race is not None:
+                    race.detach(data)
+                # Hand the connection back to the pool.
+                data.close()
+
+        if race is not None:
+            if not race.claim():
+                check_race(url, race)
+            os.replace(write_path, path)
+    except Exception:
+        # Lost, cancelled or failed, a partial file is no use to anyone.
+        remove_quietly(write_path)
+        raise
+
+    if journal is not None:
+        journal.record_download(os.path.basename(path), url, size, data.headers.get('ETag'), validator.report())
+    if manifest is not None:
+        manifest.add(os.path.basename(path), url, validator.report())
+    if store is not None:
+        store.add_file(os.path.basename(path), path, validator.report())
+
+    return size
+
+
+def read_stored_chunk(url, index, reorder_buffer, store):
+    # Feeds a chunk from the chunk store into the output, False if it isn't there.
+    content, report = store.read(uri_file_name(url))
+    if content is None:
+        return False
+    if tracer is not None:
+        tracer.note(status="stored")
+    reorder_buffer.put(index, content, (uri_file_name(url), url, report))
+    return True
+
+
+def download_chunk_to_buffer(url, headers, index, reorder_buffer, throttle=None, store=None, race=None,
+                             controller=None):
+    check_race(url, race)
+    if store is not None and read_stored_chunk(url, index, reorder_buffer, store):
+        return 0
+    if race is not None:
+        race.begin()
+
+    data = session_pool.get(url, stream=True, headers=first_range_headers(url, headers, controller),
+                            timeout=CHUNK_TIMEOUT)
+    if tracer is not None:
+        tracer.note(status=data.status_code)
+    if race is not None:
+        race.attach(data)
+    validator = TsValidator()
+
+    try:
         if not data.ok:
-            raise ReplayDeleted('Unable to download chunk {}.'.format(url))
-        for block in data.iter_content(4096):
-            handle.write(block)
+            raise ReplayDeleted('Unable to download chunk {}.'.format(url), data.status_code,
+                                data.request.headers.get('Cookie'))
+        split = split_point(url, data)
+        if split is None:
+            blocks = []
+            for block in data.iter_content(4096):
+                check_race(url, race)
+                if throttle is not None:
+                    throttle.consume(len(block))
+                validator.feed(block)
+                blocks.append(block)
+            content = b''.join(blocks)
+            check_chunk_size(url, data, len(content))
+        else:
+            # Every range lands in place, nothing is joined afterwards.
+            content = bytearray(split[1])
+            download_ranges(url, headers, data, content, split, throttle, race, controller)
+            validator.feed(content)
+        check_chunk_packets(url, validator)
+    except Exception:
+        check_race(url, race)
+        raise
+    finally:
+        if race is not None:
+            race.detach(data)
+        data.close()
+
+    # Only the first request for the chunk may put it in the output.
+    if race is not None and not race.claim():
+        check_race(url, race)
+
+    if store is not None:
+        store.add_data(uri_file_name(url), content, validator.report())
+    reorder_buffer.put(index, content, (uri_file_name(url), url, validator.report()))
+    return len(content)
+
+
+def run_with_retries(func, args, kargs, retry_policy, stop, controller=None):
+    attempt = 1
+    while True:
+        try:
+            return run_attempt(func, args, kargs, stop, controller)
+        except Exception as e:
+            if retry_policy is None or not retry_policy.should_retry(e, attempt):
+                raise
+            delay = retry_policy.prepare_retry(e, attempt)
+            # backing off without holding a concurrency slot, give up on stop
+            if stop.wait(delay):
+                raise
+            attempt += 1
+
+
+def run_attempt(func, args, kargs, stop, controller=None):
+    if tracer is not None:
+        # The url comes first for every chunk task.
+        with tracer.span(uri_file_name(args[0]), 'chunk', url=args[0]) as span:
+            num_bytes = run_attempt_untraced(func, args, kargs, stop, controller)
+            span.set(bytes=num_bytes or 0)
+        return num_bytes
+    return run_attempt_untraced(func, args, kargs, stop, controller)
+
+
+def run_attempt_untraced(func, args, kargs, stop, controller=None):
+    if controller is None:
+        start = time.monotonic()
+        num_bytes = func(*args, **kargs)
+        metrics.record_chunk(time.monotonic() - start, num_bytes or 0)
+        return num_bytes
+
+    if not controller.acquire(stop):
+        raise ReplayDeleted('Download cancelled.')
+    start = time.monotonic()
+    try:
+        # The chunk's extra ranges take slots from the same controller.
+        num_bytes = func(*args, controller=controller, **kargs)
+    except Exception as e:
+        # A hedged request that lost says nothing about the host.
+        controller.record(time.monotonic() - start, 0, None if isinstance(e, ChunkCancelled) else e)
+        raise
+    finally:
+        controller.release()
+    controller.record(time.monotonic() - start, num_bytes or 0)
+    metrics.record_chunk(time.monotonic() - start, num_bytes or 0)
+    return num_bytes
+
+
+def get_controller(url, options):
+    host = urlparse(url).netloc
+    # Broadcasts run with other limits (e.g. Client(jobs=...)) get a controller of their own.
+    key = (host, options.jobs, options.min_jobs, options.max_jobs)
+    with controllers_lock:
+        controller = controllers.get(key)
+        if controller is None:
+            if options.jobs is not None:
+                controller = ConcurrencyController(host, options.jobs, options.jobs, options.jobs, pinned=True)
+            else:
+                controller = ConcurrencyController(host, DEFAULT_DL_THREADS, options.min_jobs, options.max_jobs)
+            controllers[key] = controller
+    return controller
 
 
-def process(args):
+def show_connection_stats():
+    for host, counts in sorted(session_pool.stats().items()):
+        if counts.num_requests == 0:
+            continue
+        stdoutnl("{}: {} requests, {} connections opened, {} reused.".format(
+            host, counts.num_requests, counts.num_connections, counts.num_reused()))
+
+
+def download_replay(name, download_list, req_headers, key, options, scheduler=None, retry_policy=None, stored=None,
+                    on_convert=None):
+    temp_dir_name = ".pyriscope.{}".format(name)
+    if not os.path.exists(temp_dir_name):
+        os.makedirs(temp_dir_name)
+
+    journal = Journal(temp_dir_name, key)
+    if retry_policy is None:
+        retry_policy = RetryPolicy(options.retries)
+
+    output = "{}.ts".format(name)
+    manifest = Manifest(name, key, [chunk_info['file_name'] for chunk_info in download_list], output)
+
+    # Work out which chunks are still missing from a previous run.
+    tasks = []
+    if options.stream:
+        start_index, offset = journal.written_prefix()
+        if start_index > 0 and (not os.path.exists("{}.ts".format(name)) or os.path.getsize("{}.ts".format(name)) < offset):
+            start_index, offset = 0, 0
+            journal.reset_written()
+        for index, chunk_info in enumerate(download_list[:start_index]):
+            manifest.add_known(chunk_info['file_name'], journal.written[index])
+        for index, chunk_info in enumerate(download_list[start_index:], start_index):
+            tasks.append((download_chunk_to_buffer, chunk_info['url'], index))
+        num_done = start_index
+    else:
+        num_stored = 0
+        for chunk_info in download_list:
+            chunk_info['file_path'] = "{}/{}".format(temp_dir_name, chunk_info['file_name'])
+            if not journal.is_downloaded(chunk_info['file_name'], chunk_info['file_path']):
+                report = None
+                if stored is not None:
+                    report = stored.link(chunk_info['file_name'], chunk_info['file_path'])
+                if report is None:
+                    tasks.append((download_chunk, chunk_info['url'], chunk_info['file_path']))
+                    continue
+                journal.record_download(chunk_info['file_name'], chunk_info['url'], report['size'], None, report)
+                num_stored += 1
+            entry = journal.downloaded[chunk_info['file_name']]
+            if 'check' in entry:
+                manifest.add(chunk_info['file_name'], chunk_info['url'], entry['check'])
+            else:
+                manifest.add_known(chunk_info['file_name'], entry['size'])
+        num_done = len(download_list) - len(tasks) - num_stored
+        if num_stored > 0:
+            stdoutnl("{} of {} chunks of {}.ts found in the chunk store.".format(num_stored, len(download_list), name))
+
+    if num_done > 0:
+        stdoutnl("Resuming {}.ts: {} of {} chunks already downloaded.".format(name, num_done, len(download_list)))
+
+    stdout("Downloading replay {}.ts.".format(name))
+
+    throttle = None
+    if bandwidth_limiter is not None:
+        throttle = Throttle(bandwidth_limiter, name, options.priority)
+
+    if options.engine == ENGINE_ASYNC:
+        from pyriscope import aioengine
+        jobs = options.jobs or DEFAULT_ASYNC_JOBS
+        if scheduler is not None:
+            # Each broadcast runs its own event loop, so split the limit evenly.
+            jobs = max(1, jobs // options.parallel)
+        pool = aioengine.AsyncPool(name, jobs, len(tasks), retry_policy)
+        chunk_funcs = {download_chunk: aioengine.download_chunk,
+                       download_chunk_to_buffer: aioengine.download_chunk_to_buffer}
+        tasks = [(chunk_funcs[task[0]],) + task[1:] for task in tasks]
+    elif scheduler is not None:
+        pool = scheduler.pool(name, len(tasks), retry_policy)
+    else:
+        hedger = None
+        if options.hedge_budget:
+            hedger = Hedger(len(tasks), options.hedge_budget)
+        pool = ThreadPool(name, DEFAULT_DL_THREADS, len(tasks), get_controller(download_list[0]['url'], options),
+                          retry_policy, hedger)
+    pool.tasks_info.on_progress = options.on_progress
+
+    if options.stream:
+        # Chunks go straight into the .ts, in order, as they arrive.
+        convert_pipe = None
+        if options.pipe:
+            convert_pipe = ConvertPipe(name, options, offset)
+        # Hash the output as it is written, resumed outputs start from what is there.
+        digest = hash_prefix("{}.ts".format(name), offset) if offset > 0 else hashlib.sha256()
+        reorder_buffer = ReorderBuffer("{}.ts".format(name), temp_dir_name, options.buffer_size, journal.record_write,
+                                       start_index, offset, convert_pipe, digest, manifest)
+        # A chunk that failed for good must not hold back the ones after it.
+        pool.tasks_info.on_failure = lambda url, req_headers, index, *rest: reorder_buffer.skip(index)
+
+        for func, url, index in tasks:
+            pool.add_task(func, url, req_headers, index, reorder_buffer, throttle=throttle, store=stored)
+
+        with trace("download", 'phase', broadcast=name, chunks=len(tasks)):
+            pool.wait_completion()
+        with trace("write out", 'phase', broadcast=name):
+            reorder_buffer.close()
+        manifest.set_output(digest.hexdigest())
+
+        if convert_pipe is not None:
+            if convert_pipe.ok:
+                stdoutnl("Converted to {}.mp4!".format(name))
+                if options.clean:
+                    # Only a successful conversion makes the .ts expendable.
+                    try:
+                        os.remove(output)
+                        output = manifest.output = "{}.mp4".format(name)
+                        manifest.set_output(None)
+                    except OSError:
+                        stdoutnl("Failed to delete {}.".format(output))
+                future = conversion_pool.add(True, "")
+            else:
+                # Keep the .ts, and a manifest that doesn't pass for a finished download.
+                show_error("Converting to {}.mp4 failed: {}".format(name, convert_pipe.error()))
+                manifest.fail(convert_pipe.error())
+                future = conversion_pool.add(False, convert_pipe.error())
+            if on_convert is not None:
+                on_convert(future)
+
+    else:
+        for func, url, file_path in tasks:
+            pool.add_task(func, url, req_headers, file_path, journal, throttle=throttle, manifest=manifest,
+                          store=stored)
+
+        with trace("download", 'phase', broadcast=name, chunks=len(tasks)):
+            pool.wait_completion()
+
+        if os.path.exists("{}.ts".format(name)):
+            try:
+                os.remove("{}.ts".format(name))
+            except:
+                stdoutnl("Failed to delete preexisting {}.ts.".format(name))
+
+        # Missing chunks leave a gap instead of cutting the replay short.
+        with trace("concatenate", 'phase', broadcast=name):
+            handle = HashingWriter(open("{}.ts".format(name), 'wb'))
+            for chunk_info in download_list:
+                if chunk_info['file_name'] not in manifest.chunks:
+                    continue
+                with open(chunk_info['file_path'], 'rb') as ts_file:
+                    handle.write(ts_file.read())
+            handle.close()
+        manifest.set_output(handle.sha256.hexdigest())
+
+    journal.close()
+
+    manifest.write()
+    if manifest.missing():
+        stdoutnl("{} of {} chunks missing from {}, see {}.".format(
+            len(manifest.missing()), len(download_list), output, manifest.path))
+
+    # don't delete temp if the download had missing chunks, just in case
+    if pool.is_complete() and os.path.exists(temp_dir_name):
+        try:
+            shutil.rmtree(temp_dir_name)
+        except:
+            stdoutnl("Failed to delete temp folder: {}.".format(temp_dir_name))
+
+    if pool.is_complete():
+        stdoutnl("{}.ts Downloaded!".format(name))
+    else:
+        stdoutnl("{}.ts partially Downloaded!".format(name))
+
+    return pool.is_complete()
+
+
+def convert_ts(name, options):
+    stdout("Converting to {}.mp4".format(name))
+
+    with trace("convert", 'ffmpeg', broadcast=name) as span:
+        if options.rotate:
+            process = Popen(FFMPEG_ROT.format(name), shell=True, stdout=PIPE, stderr=PIPE)
+        else:
+            process = Popen(FFMPEG_NOROT.format(name), shell=True, stdout=PIPE, stderr=PIPE)
+        errors = process.communicate()[1].decode('utf-8', 'replace').strip()
+        span.set(status=process.returncode)
+
+    if process.returncode != 0:
+        errors = errors or "ffmpeg exited with status {}.".format(process.returncode)
+        show_error("Converting to {}.mp4 failed: {}".format(name, errors))
+        return False, errors
+
+    stdoutnl("Converted to {}.mp4!".format(name))
+    if errors:
+        stdoutnl(errors)
+
+    # Only a successful conversion makes the .ts expendable.
+    if options.clean and os.path.exists("{}.ts".format(name)):
+        try:
+            os.remove("{}.ts".format(name))
+        except:
+            stdout("Failed to delete {}.ts.".format(name))
+
+    return True, errors
+
+
+def parse_args(args):
     # Make sure there are args, do a primary check for help.
     if len(args) == 0 or args[0] in ARGLIST_HELP:
         show_help()
 
     # Defaults arg flag settings.
     url_parts_list = []
-    ffmpeg = True
-    convert = False
-    clean = False
-    rotate = False
-    agent_mocking = False
-    name = ""
-    live_duration = ""
-    req_headers = {}
-
-    # Check for ffmpeg.
-    if shutil.which("ffmpeg") is None:
-        ffmpeg = False
+    options = Options()
+
+    # Long options also take their value as --option=value.
+    args = [part for arg in args for part in (arg.split('=', 1) if arg.startswith('--') and '=' in arg else [arg])]
 
     # Read in args and set appropriate flags.
     cont = None
@@ -268,280 +2180,740 @@ def process(args):
             if args[i][0] in ('\'', '\"'):
                 if args[i][-1:] == args[i][0]:
                     cont = None
-                    name = args[i][1:-1]
+                    options.name = args[i][1:-1]
                 else:
                     cont = args[i][0]
-                    name = args[i][1:]
+                    options.name = args[i][1:]
             else:
                 cont = None
-                name = args[i]
+                options.name = args[i]
             continue
         if cont in ('\'', '\"'):
             if args[i][-1:] == cont:
                 cont = None
-                name += " {}".format(args[i][:-1])
+                options.name += " {}".format(args[i][:-1])
             else:
-                name += " {}".format(args[i])
+                options.name += " {}".format(args[i])
             continue
         if cont == ARGLIST_TIME:
             cont = None
-            live_duration = args[i]
+            options.live_duration = args[i]
+        if cont in (ARGLIST_START, ARGLIST_END, ARGLIST_DURATION):
+            seconds = parse_duration(args[i])
+            if seconds is None or (cont == ARGLIST_DURATION and seconds <= 0):
+                print("\nError: Invalid time: {}".format(args[i]))
+                sys.exit(1)
+            if cont == ARGLIST_START:
+                options.start_time = seconds
+            elif cont == ARGLIST_END:
+                options.end_time = seconds
+            else:
+                options.duration = seconds
+            cont = None
+            continue
+        if cont == ARGLIST_BUFFER:
+            cont = None
+            try:
+                options.buffer_size = int(args[i]) * 1024 * 1024
+            except ValueError:
+                print("\nError: Invalid buffer size: {}".format(args[i]))
+                sys.exit(1)
+            continue
+        if cont == ARGLIST_ENGINE:
+            cont = None
+            if args[i] not in (ENGINE_THREADS, ENGINE_ASYNC):
+                print("\nError: Invalid engine: {}".format(args[i]))
+                sys.exit(1)
+            options.engine = args[i]
+            continue
+        if cont == ARGLIST_JOBS:
+            cont = None
+            if not args[i].isdigit() or int(args[i]) < 1:
+                print("\nError: Invalid number of jobs: {}".format(args[i]))
+                sys.exit(1)
+            options.jobs = int(args[i])
+            continue
+        if cont in (ARGLIST_MIN_JOBS, ARGLIST_MAX_JOBS):
+            if not args[i].isdigit() or int(args[i]) < 1:
+                print("\nError: Invalid number of jobs: {}".format(args[i]))
+                sys.exit(1)
+            if cont == ARGLIST_MIN_JOBS:
+                options.min_jobs = int(args[i])
+            else:
+                options.max_jobs = int(args[i])
+            cont = None
+            continue
+        if cont == ARGLIST_PARALLEL:
+            cont = None
+            if not args[i].isdigit() or int(args[i]) < 1:
+                print("\nError: Invalid number of parallel broadcasts: {}".format(args[i]))
+                sys.exit(1)
+            options.parallel = int(args[i])
+            continue
+        if cont == ARGLIST_RETRIES:
+            cont = None
+            if not args[i].isdigit() or int(args[i]) < 1:
+                print("\nError: Invalid number of retries: {}".format(args[i]))
+                sys.exit(1)
+            options.retries = int(args[i])
+            continue
+        if cont == ARGLIST_BATCH:
+            cont = None
+            options.batch = args[i]
+            continue
+        if cont == ARGLIST_SERVE:
+            cont = None
+            if not args[i].isdigit() or not 0 < int(args[i]) < 65536:
+                print("\nError: Invalid port: {}".format(args[i]))
+                sys.exit(1)
+            options.serve_port = int(args[i])
+            continue
+        if cont == ARGLIST_QUEUE:
+            cont = None
+            options.queue_file = args[i]
+            continue
+        if cont == ARGLIST_WATCH:
+            cont = None
+            options.watch_file = args[i]
+            continue
+        if cont == ARGLIST_WATCH_INTERVAL:
+            cont = None
+            try:
+                options.poll_interval = float(args[i])
+            except ValueError:
+                options.poll_interval = 0
+            if not options.poll_interval > 0:
+                print("\nError: Invalid interval: {}".format(args[i]))
+                sys.exit(1)
+            continue
+        if cont == ARGLIST_PROGRESS:
+            cont = None
+            if args[i] not in (PROGRESS_BAR, PROGRESS_JSON, PROGRESS_NONE):
+                print("\nError: Invalid progress mode: {}".format(args[i]))
+                sys.exit(1)
+            options.progress = args[i]
+            continue
+        if cont == ARGLIST_METRICS:
+            cont = None
+            options.metrics_file = args[i]
+            continue
+        if cont == ARGLIST_LIMIT_RATE:
+            cont = None
+            options.limit_rate = parse_rate(args[i])
+            if options.limit_rate is None:
+                print("\nError: Invalid rate: {}".format(args[i]))
+                sys.exit(1)
+            continue
+        if cont == ARGLIST_TRACE:
+            cont = None
+            options.trace_file = args[i]
+            continue
+        if cont == ARGLIST_SPLIT_SIZE:
+            cont = None
+            options.split_size = parse_size(args[i])
+            if options.split_size is None:
+                print("\nError: Invalid size: {}".format(args[i]))
+                sys.exit(1)
+            continue
+        if cont == ARGLIST_HEDGE:
+            cont = None
+            options.hedge_budget = parse_fraction(args[i])
+            if options.hedge_budget is None:
+                print("\nError: Invalid hedge budget: {}".format(args[i]))
+                sys.exit(1)
+            continue
+        if cont == ARGLIST_SEGMENT_TIME:
+            cont = None
+            options.segment_time = parse_duration(args[i])
+            if options.segment_time is None or options.segment_time <= 0:
+                print("\nError: Invalid time: {}".format(args[i]))
+                sys.exit(1)
+            continue
+        if cont == ARGLIST_STORE_SIZE:
+            cont = None
+            options.store_size = parse_size(args[i])
+            if options.store_size is None:
+                print("\nError: Invalid size: {}".format(args[i]))
+                sys.exit(1)
+            continue
+        if cont == ARGLIST_PRIORITY:
+            cont = None
+            options.priority = parse_priority(args[i])
+            if options.priority is None:
+                print("\nError: Invalid priority: {}".format(args[i]))
+                sys.exit(1)
+            continue
 
         if re.search(URL_PATTERN, args[i]) is not None:
             url_parts_list.append(dissect_url(args[i]))
         if args[i] in ARGLIST_HELP:
             show_help()
         if args[i] in ARGLIST_CONVERT:
-            convert = True
+            options.convert = True
         if args[i] in ARGLIST_CLEAN:
-            convert = True
-            clean = True
+            options.convert = True
+            options.clean = True
         if args[i] in ARGLIST_ROTATE:
-            convert = True
-            rotate = True
+            options.convert = True
+            options.rotate = True
         if args[i] in ARGLIST_AGENTMOCK:
-            agent_mocking = True
+            options.agent_mocking = True
         if args[i] in ARGLIST_NAME:
             cont = ARGLIST_NAME
         if args[i] in ARGLIST_TIME:
             cont = ARGLIST_TIME
+        if args[i] in ARGLIST_START:
+            cont = ARGLIST_START
+        if args[i] in ARGLIST_END:
+            cont = ARGLIST_END
+        if args[i] in ARGLIST_DURATION:
+            cont = ARGLIST_DURATION
+        if args[i] in ARGLIST_STREAM:
+            options.stream = True
+        if args[i] in ARGLIST_PIPE:
+            options.convert = True
+            options.stream = True
+            options.pipe = True
+        if args[i] in ARGLIST_NATIVE:
+            options.native_live = True
+        if args[i] in ARGLIST_BUFFER:
+            cont = ARGLIST_BUFFER
+        if args[i] in ARGLIST_ENGINE:
+            cont = ARGLIST_ENGINE
+        if args[i] in ARGLIST_JOBS:
+            cont = ARGLIST_JOBS
+        if args[i] in ARGLIST_MIN_JOBS:
+            cont = ARGLIST_MIN_JOBS
+        if args[i] in ARGLIST_MAX_JOBS:
+            cont = ARGLIST_MAX_JOBS
+        if args[i] in ARGLIST_PARALLEL:
+            cont = ARGLIST_PARALLEL
+        if args[i] in ARGLIST_RETRIES:
+            cont = ARGLIST_RETRIES
+        if args[i] in ARGLIST_NO_CACHE:
+            options.cache = False
+        if args[i] in ARGLIST_BATCH:
+            cont = ARGLIST_BATCH
+        if args[i] in ARGLIST_SERVE:
+            cont = ARGLIST_SERVE
+        if args[i] in ARGLIST_QUEUE:
+            cont = ARGLIST_QUEUE
+        if args[i] in ARGLIST_WATCH:
+            cont = ARGLIST_WATCH
+        if args[i] in ARGLIST_WATCH_INTERVAL:
+            cont = ARGLIST_WATCH_INTERVAL
+        if args[i] in ARGLIST_PROGRESS:
+            cont = ARGLIST_PROGRESS
+        if args[i] in ARGLIST_METRICS:
+            cont = ARGLIST_METRICS
+        if args[i] in ARGLIST_LIMIT_RATE:
+            cont = ARGLIST_LIMIT_RATE
+        if args[i] in ARGLIST_PRIORITY:
+            cont = ARGLIST_PRIORITY
+        if args[i] in ARGLIST_STORE_SIZE:
+            cont = ARGLIST_STORE_SIZE
+        if args[i] in ARGLIST_SEGMENT_TIME:
+            cont = ARGLIST_SEGMENT_TIME
+        if args[i] in ARGLIST_TRACE:
+            cont = ARGLIST_TRACE
+        if args[i] in ARGLIST_HEDGE:
+            cont = ARGLIST_HEDGE
+        if args[i] in ARGLIST_SPLIT_SIZE:
+            cont = ARGLIST_SPLIT_SIZE
+
+    return url_parts_list, options
+
+
+def parse_rate(rate):
+    # Bytes per second, with an optional K, M or G suffix.
+    match = re.match(RATE_PATTERN, rate.strip())
+    if match is None or float(match.group(1)) <= 0:
+        return None
+    return float(match.group(1)) * RATE_UNITS[match.group(2).lower()]
+
+
+def parse_size(size):
+    # Bytes, with an optional K, M or G suffix. 0 is allowed.
+    match = re.match(RATE_PATTERN, size.strip())
+    if match is None:
+        return None
+    return int(float(match.group(1)) * RATE_UNITS[match.group(2).lower()])
+
+
+def parse_priority(priority):
+    try:
+        priority = float(priority)
+    except ValueError:
+        return None
+    return priority if priority > 0 else None
 
 
-    # Check for URLs found.
-    if len(url_parts_list) < 1:
-        print("\nError: No valid URLs entered.")
-        sys.exit(1)
+def parse_fraction(fraction):
+    try:
+        fraction = float(fraction)
+    except ValueError:
+        return None
+    return fraction if 0 <= fraction <= 1 else None
+
+
+def replay_window(options):
+    # The [start, end) range of the replay to download, in playlist time.
+    if options.start_time is None and options.end_time is None and options.duration is None:
+        return None
+    start = options.start_time
+    end = options.end_time
+    if options.duration is not None:
+        end = (start or 0.0) + options.duration
+        if start is not None and start < 0 and end >= 0:
+            end = None
+    return start, end
+
+
+def process_broadcast(url_parts, options, scheduler=None, on_convert=None, broadcast_public=None, on_record=None):
+    # Each broadcast gets its own copy, the replay path adds Cookie and Host.
+    req_headers = dict(options.req_headers)
+    name = options.name
+
+    broadcast_key = get_broadcast_key(url_parts)
+
+    if broadcast_public is None:
+        broadcast_public = get_broadcast_public(url_parts, req_headers)
+
+    # Loaded the correct JSON. Create file name.
+    if name[-3:] == ".ts":
+        name = name[:-3]
+    if name[-4:] == ".mp4":
+        name = name[:-4]
+    if name == "":
+        import dateutil.parser
+        from dateutil import tz
+        broadcast_start_time_dt = dateutil.parser.parse(broadcast_public['broadcast']['start'])
+        broadcast_start_time_dt = broadcast_start_time_dt.astimezone(tz.tzlocal())
+        broadcast_start_time = "{}-{:02d}-{:02d} {:02d}-{:02d}-{:02d}".format(
+            broadcast_start_time_dt.year, broadcast_start_time_dt.month, broadcast_start_time_dt.day,
+            broadcast_start_time_dt.hour, broadcast_start_time_dt.minute, broadcast_start_time_dt.second)
+        name = "{} ({})".format(broadcast_public['broadcast']['username'], broadcast_start_time)
+
+    name = sanitize(name)
+
+    # An unfinished download of this broadcast is resumed, not renamed.
+    # A different time range is a different download as far as resuming goes.
+    download_key = broadcast_key
+    if replay_window(options) is not None:
+        download_key = "{}@{}-{}".format(broadcast_key, *replay_window(options))
+    resuming = Journal.matches(".pyriscope.{}".format(name), download_key)
+
+    # A finished download of the same replay is reused, not repeated.
+    if broadcast_public['broadcast']['state'] != 'RUNNING' and not resuming:
+        output = Manifest.completed_output(name, download_key)
+        if output is not None:
+            stdoutnl("{} is already downloaded.".format(output))
+            if options.convert and output == "{}.ts".format(name) and not os.path.isfile("{}.mp4".format(name)):
+                future = conversion_pool.submit(name, options)
+                if on_convert is not None:
+                    on_convert(future)
+            return RESULT_DOWNLOADED, output
+
+    if resuming:
+        return capture_broadcast(name, url_parts, broadcast_public, req_headers, download_key, options, scheduler,
+                                 on_convert, on_record)
+
+    name = claim_name(name, ".live" if broadcast_public['broadcast']['state'] == 'RUNNING' else "")
+    try:
+        return capture_broadcast(name, url_parts, broadcast_public, req_headers, download_key, options, scheduler,
+                                 on_convert, on_record)
+    except BaseException:
+        # Give the name back unless something was downloaded to resume.
+        try:
+            os.rmdir(".pyriscope.{}".format(name))
+        except OSError:
+            pass
+        raise
+
+
+def claim_name(name, suffix=""):
+    # name, or else name-1, name-2... whichever is first to have no output
+    # yet and a temp dir this call creates. Creating the temp dir is the
+    # claim, so parallel downloads of one broadcast, in this process or
+    # another, never share their files.
+    candidate = name
+    i = 0
+    while True:
+        if not os.path.isfile("{}{}.ts".format(candidate, suffix)):
+            try:
+                os.makedirs(".pyriscope.{}{}".format(candidate, suffix))
+                break
+            except FileExistsError:
+                pass
+        i = i + 1
+        candidate = "{}-{}".format(name, i)
+    if candidate != name:
+        show("FILE ALREADY EXISTS. SAVING AS " + candidate)
+    return candidate
+
+
+def capture_broadcast(name, url_parts, broadcast_public, req_headers, download_key, options, scheduler=None,
+                      on_convert=None, on_record=None):
+    broadcast_key = get_broadcast_key(url_parts)
+
+    # Get ready to start capturing.
+    if broadcast_public['broadcast']['state'] == 'RUNNING':
+        # The stream is live, start live capture.
+        name = "{}.live".format(name)
+
+        stdout("Downloading live stream information.")
+        access_public = get_access_public(url_parts, req_headers)
+
+        if 'success' in access_public and access_public['success'] == False:
+            raise BroadcastNotFound("Video expired/deleted/wasn't found", url_parts['url'])
+
+        max_duration = None
+        if not options.live_duration == "":
+            max_duration = parse_duration(options.live_duration)
+            if max_duration is None or max_duration <= 0:
+                raise InvalidOptions("Invalid duration: {}".format(options.live_duration), url_parts['url'])
+
+        if options.ffmpeg and not options.native_live:
+            # ffmpeg records in the background, restarted if it drops out.
+            from pyriscope.supervisor import live_supervisor
+            future = live_supervisor.record(name, url_parts, req_headers, access_public['hls_url'], options,
+                                            max_duration, on_convert)
+            if on_record is not None:
+                on_record(future)
+                return RESULT_RECORDING, "{}.ts".format(name)
+            return future.result()
+
+        from pyriscope.live import LiveRecorder
+
+        live_headers = dict(req_headers)
+        live_headers['Referer'] = url_parts['url']
+        recorder = LiveRecorder(name, access_public['hls_url'], live_headers, options, max_duration)
+        if not recorder.record():
+            raise DownloadFailed("Unable to record live stream", url_parts['url'])
+
+        stdoutnl("{}.ts Downloaded!".format(name))
+
+        # Convert video to .mp4.
+        if options.convert:
+            future = conversion_pool.submit(name, options)
+            if on_convert is not None:
+                on_convert(future)
+
+        return RESULT_DOWNLOADED, "{}.ts".format(name)
+
+    if not broadcast_public['broadcast']['available_for_replay']:
+        raise ReplayUnavailable("Replay unavailable", url_parts['url'])
+
+    # Broadcast replay is available.
+    access_public = metadata_cache.get('access', broadcast_key)
+    if access_public is None:
+        stdout("Downloading replay information.")
+        access_public = get_access_public(url_parts, req_headers)
+
+        if 'success' in access_public and access_public['success'] == False:
+            raise BroadcastNotFound("Video expired/deleted/wasn't found", url_parts['url'])
+
+        metadata_cache.set('access', broadcast_key, access_public)
+
+    base_url = access_public['replay_url']
+
+    req_headers['Cookie'] = cookie_header(access_public)
+
+    host = urlparse(base_url).netloc
+    req_headers['Host'] = host
+
+    refresher = AccessRefresher(url_parts, req_headers)
+
+    # Get the list of chunks to download.
+    chunks = metadata_cache.get('chunk_list', broadcast_key)
+    if chunks is None:
+        stdout("Downloading chunk list.")
+        response = get_chunk_list(base_url, req_headers)
+        if response.status_code in RetryPolicy.AUTH_STATUS_CODES:
+            # Cached or expired cookies, renew them and try once more.
+            access_public = refresher.refresh(response.request.headers.get('Cookie'))
+            if access_public is not None:
+                base_url = access_public['replay_url']
+                response = get_chunk_list(base_url, req_headers)
+        chunks = response.text
+        show("\n")
+        show(response.status_code)
+        show("\n")
+        if not response.ok:
+            raise DownloadFailed("Unable to download chunk list (HTTP {})".format(response.status_code),
+                                 url_parts['url'])
+
+        # The replay of an ended broadcast does not change.
+        if parse_playlist(chunks, base_url).segments:
+            metadata_cache.set('chunk_list', broadcast_key, chunks)
+    playlist = parse_playlist(chunks, base_url)
+    segments = playlist.segments
+
+    # Only the chunks overlapping the requested time range.
+    window = replay_window(options)
+    if window is not None and segments:
+        segments = playlist.window(*window)
+        if not segments:
+            raise InvalidOptions("Time range is outside the replay ({})".format(format_time(playlist.duration())),
+                                 url_parts['url'])
+        stdoutnl("Downloading {} to {} of {} ({} of {} chunks).".format(
+            format_time(segments[0].start), format_time(segments[-1].end), format_time(playlist.duration()),
+            len(segments), len(playlist.segments)))
+
+    download_list = []
+    for segment in segments:
+        download_list.append(
+            {
+                'url': segment.url,
+                'file_name': segment.file_name
+            }
+        )
+    # Check for empty download_list
+    if not download_list:
+        raise DownloadFailed("No chunks found", url_parts['url'])
+
+    # Download chunk .ts files and append them.
+    retry_policy = RetryPolicy(options.retries, refresher=refresher)
+    stored = None
+    if chunk_store is not None:
+        # Both URL forms of a broadcast share its id.
+        stored = chunk_store.broadcast(sanitize(broadcast_public['broadcast'].get('id') or broadcast_key))
+    conversions = []
+    complete = download_replay(name, download_list, req_headers, download_key, options, scheduler, retry_policy,
+                               stored, conversions.append)
+
+    # Convert video to .mp4, unless it was converted on the way in.
+    if options.convert and not options.pipe:
+        conversions.append(conversion_pool.submit(name, options))
+    if on_convert is not None:
+        for future in conversions:
+            on_convert(future)
+
+    output = "{}.ts".format(name)
+    if options.pipe and options.clean and conversions[0].result()[0]:
+        output = "{}.mp4".format(name)
+    if complete:
+        return RESULT_DOWNLOADED, output
+    return RESULT_PARTIAL, output
+
+
+def get_chunk_list(base_url, req_headers):
+    with trace("chunk list", 'api') as span:
+        response = session_pool.get(base_url, headers=req_headers)
+        span.set(status=response.status_code)
+    return response
+
+
+def run_broadcast(url_parts, options, scheduler=None, on_convert=None, on_record=None):
+    # Keep one bad URL from taking down the others.
+    try:
+        with trace("broadcast", 'phase', url=url_parts['url']):
+            return process_broadcast(url_parts, options, scheduler, on_convert, on_record=on_record)
+    except PyriscopeError as e:
+        show_error("{}: {}".format(e, url_parts['url']))
+        return RESULT_FAILED, "{}.".format(e)
+    except (OSError, ValueError, KeyError) as e:
+        # Network and file errors, or a response that isn't what was expected.
+        show_error("{}: {}".format(str(e) or type(e).__name__, url_parts['url']))
+        return RESULT_FAILED, str(e) or type(e).__name__
+
+
+def wait_recording(url_parts, future):
+    while True:
+        try:
+            while not future.done():
+                time.sleep(0.2)
+            return future.result()
+        except KeyboardInterrupt:
+            stdoutnl("Stopping live recordings...")
+            from pyriscope.supervisor import live_supervisor
+            live_supervisor.stop()
+        except PyriscopeError as e:
+            show_error("{}: {}".format(e, url_parts['url']))
+            return RESULT_FAILED, "{}.".format(e)
+
+
+def show_summary(url_parts_list, results):
+    stdoutnl("")
+    stdoutnl("Summary:")
+    for url_parts, (result, detail) in zip(url_parts_list, results):
+        stdoutnl("    [{}] {} {}".format(result, url_parts['url'], detail))
+    num_ok = sum(1 for result, _ in results if result == RESULT_DOWNLOADED)
+    stdoutnl("{} of {} broadcasts downloaded.".format(num_ok, len(results)))
+
+
+def check_options(options):
+    # Settings of one download, from the command line or the library API.
+    if options.engine not in (ENGINE_THREADS, ENGINE_ASYNC):
+        raise InvalidOptions("Invalid engine: {}".format(options.engine))
+    if options.progress not in (PROGRESS_BAR, PROGRESS_JSON, PROGRESS_NONE):
+        raise InvalidOptions("Invalid progress mode: {}".format(options.progress))
+    if options.min_jobs > options.max_jobs:
+        raise InvalidOptions("--min-jobs is larger than --max-jobs")
+    if options.end_time is not None and options.duration is not None:
+        raise InvalidOptions("--end and --duration can't be used together")
+    if not 0 <= options.hedge_budget <= 1:
+        raise InvalidOptions("Invalid hedge budget: {}".format(options.hedge_budget))
+    if options.live_duration != "" and not (parse_duration(options.live_duration) or 0) > 0:
+        raise InvalidOptions("Invalid duration: {}".format(options.live_duration))
 
     # Disable conversion/rotation if ffmpeg is not found.
-    if convert and not ffmpeg:
-        print("ffmpeg not found: Disabling conversion/rotation.")
-        convert = False
-        clean = False
-        rotate = False
+    probe = probe_ffmpeg()
+    options.ffmpeg = bool(probe)
+    if options.convert and not options.ffmpeg:
+        show("ffmpeg not found: Disabling conversion/rotation.")
+        options.convert = False
+        options.clean = False
+        options.rotate = False
+        options.pipe = False
+    if options.segment_time and (options.native_live or not options.ffmpeg):
+        show("--segment-time needs ffmpeg: Live recordings are kept in one file.")
+        options.segment_time = None
+    if options.rotate and probe.get('encoders') and 'libx264' not in probe['encoders']:
+        show("ffmpeg has no libx264 encoder: Rotated videos use its default encoder.")
+
+    # The async engine needs aiohttp.
+    if options.engine == ENGINE_ASYNC and importlib.util.find_spec("aiohttp") is None:
+        show("aiohttp not found: Using threaded download engine.")
+        options.engine = ENGINE_THREADS
 
     # Set a mocked user agent.
-    if agent_mocking:
-        stdout("Getting mocked User-Agent.")
-        req_headers['User-Agent'] = get_mocked_user_agent()
+    if options.agent_mocking:
+        user_agent = metadata_cache.get('user_agent', 'mocked')
+        if user_agent is None:
+            stdout("Getting mocked User-Agent.")
+            user_agent = get_mocked_user_agent()
+            if user_agent != DEFAULT_UA:
+                metadata_cache.set('user_agent', 'mocked', user_agent)
+        options.req_headers['User-Agent'] = user_agent
     else:
-        req_headers['User-Agent'] = DEFAULT_UA
-
-
-    url_count = 0
-    for url_parts in url_parts_list:
-        url_count += 1
-
-        # Disable custom naming for multiple URLs.
-        if len(url_parts_list) > 1:
-            name = ""
-
-        # Public Periscope API call to get information about the broadcast.
-        if url_parts['token'] == "":
-            req_url = PERISCOPE_GETBROADCAST.format("broadcast_id", url_parts['broadcast_id'])
-        else:
-            req_url = PERISCOPE_GETBROADCAST.format("token", url_parts['token'])
-
-        stdout("Downloading broadcast information.")
-        response = requests.get(req_url, headers=req_headers)
-        broadcast_public = json.loads(response.text)
+        options.req_headers['User-Agent'] = DEFAULT_UA
 
-        if 'success' in broadcast_public and broadcast_public['success'] == False:
-            print("\nError: Video expired/deleted/wasn't found: {}".format(url_parts['url']))
-            continue
-
-        # Loaded the correct JSON. Create file name.
-        if name[-3:] == ".ts":
-            name = name[:-3]
-        if name[-4:] == ".mp4":
-            name = name[:-4]
-        if name == "":
-            broadcast_start_time_dt = dateutil.parser.parse(broadcast_public['broadcast']['start'])
-            broadcast_start_time_dt = broadcast_start_time_dt.astimezone(tz.tzlocal())
-            broadcast_start_time = "{}-{:02d}-{:02d} {:02d}-{:02d}-{:02d}".format(
-                broadcast_start_time_dt.year, broadcast_start_time_dt.month, broadcast_start_time_dt.day,
-                broadcast_start_time_dt.hour, broadcast_start_time_dt.minute, broadcast_start_time_dt.second)
-            name = "{} ({})".format(broadcast_public['broadcast']['username'], broadcast_start_time)
-
-        name = sanitize(name)
-        
-        tempfilename = os.getcwd() + "\\" + name + ".ts"
-        if os.path.isfile(tempfilename):
-            i = 0
-            while os.path.isfile(tempfilename):
-                i = i + 1
-                tempfilename = os.getcwd() + "\\" + name + "-" + str(i) + ".ts"
-            name = name + "-" + str(i)
-            print("FILE ALREADY EXISTS. SAVING AS " + name)
-
-        # Get ready to start capturing.
-        if broadcast_public['broadcast']['state'] == 'RUNNING':
-            # Cannot record live stream without ffmpeg.
-            if not ffmpeg:
-                print("\nError: Cannot record live stream without ffmpeg: {}".format(url_parts['url']))
-                continue
 
-            # The stream is live, start live capture.
-            name = "{}.live".format(name)
-
-            if url_parts['token'] == "":
-                req_url = PERISCOPE_GETACCESS.format("broadcast_id", url_parts['broadcast_id'])
-            else:
-                req_url = PERISCOPE_GETACCESS.format("token", url_parts['token'])
-
-            stdout("Downloading live stream information.")
-            response = requests.get(req_url, headers=req_headers)
-            access_public = json.loads(response.text)
-
-            if 'success' in access_public and access_public['success'] == False:
-                print("\nError: Video expired/deleted/wasn't found: {}".format(url_parts['url']))
-                continue
-
-            time_argument = ""
-            if not live_duration == "":
-                time_argument = " -t {}".format(live_duration)
-
-            live_url = FFMPEG_LIVE.format(
-                url_parts['url'],
-                req_headers['User-Agent'],
-                access_public['hls_url'],
-                time_argument,
-                name)
-
-            # Start downloading live stream.
-            stdout("Recording stream to {}.ts".format(name))
-
-            Popen(live_url, shell=True, stdout=PIPE).stdout.read()
+def prepare(options):
+    try:
+        check_options(options)
+    except PyriscopeError as e:
+        print("\nError: {}.".format(e))
+        sys.exit(1)
+    configure(options)
+
+
+def configure(options):
+    # Sets up what every broadcast in the run shares, for the command line
+    # and api.Client alike.
+    global metrics_exporter, bandwidth_limiter, chunk_store, tracer, split_size
+    metadata_cache.enabled = options.cache
+    metrics.progress_mode = options.progress
+    split_size = options.split_size
+    if options.metrics_file:
+        metrics_exporter = MetricsExporter(metrics, options.metrics_file)
+    if options.trace_file:
+        tracer = Tracer(options.trace_file)
+    if options.limit_rate:
+        bandwidth_limiter = BandwidthLimiter(options.limit_rate)
+    if options.store_size:
+        chunk_store = ChunkStore(os.path.join(CACHE_DIR, 'chunks'), options.store_size)
+
+    # Size the per-host connection pools to the number of download workers.
+    session_pool.resize(options.jobs or options.max_jobs)
+
+
+def finish(results):
+    conversions = conversion_pool.wait()
+    if conversions:
+        stdoutnl("{} of {} conversions succeeded.".format(sum(1 for ok, _ in conversions if ok), len(conversions)))
+
+    snapshot = metrics.snapshot()
+    if snapshot['chunks']:
+        stdoutnl("{} chunks, {:.1f} MB in {:.1f}s, {} failed, {} retries.".format(
+            snapshot['chunks'], snapshot['bytes'] / (1024 * 1024), snapshot['elapsed'], snapshot['failed'],
+            snapshot['retries']))
+    if snapshot['hedged']:
+        stdoutnl("Hedged requests: {} sent, {} finished first.".format(snapshot['hedged'], snapshot['hedges_won']))
+    if snapshot['split']:
+        stdoutnl("Byte ranges: {} chunks fetched in {} range requests.".format(snapshot['split'], snapshot['ranges']))
+    show_connection_stats()
+    if metrics_exporter is not None:
+        metrics_exporter.close()
+    if tracer is not None:
+        for line in tracer.summary():
+            stdoutnl(line)
+        try:
+            tracer.write()
+            stdoutnl("Trace written to {}.".format(tracer.path))
+        except OSError as e:
+            show_error("Unable to write {}: {}".format(tracer.path, e))
+    if metrics.progress_mode == PROGRESS_JSON:
+        sys.stderr.write(json_event('summary', **snapshot) + "\n")
+    if chunk_store is not None and (chunk_store.num_hits or chunk_store.num_added):
+        stdoutnl("Chunk store: {} chunks reused, {} added.".format(chunk_store.num_hits, chunk_store.num_added))
+    if metadata_cache.num_hits or metadata_cache.num_misses:
+        stdoutnl("Metadata cache: {} hits, {} misses.".format(metadata_cache.num_hits, metadata_cache.num_misses))
+    session_pool.close()
+    ok = all(result == RESULT_DOWNLOADED for result, _ in results) and all(ok for ok, _ in conversions)
+    sys.exit(0 if ok else 1)
 
-            stdoutnl("{}.ts Downloaded!".format(name))
 
-            # Convert video to .mp4.
-            if convert:
-                stdout("Converting to {}.mp4".format(name))
+def process(args):
+    url_parts_list, options = parse_args(args)
 
-                if rotate:
-                    Popen(FFMPEG_ROT.format(name), shell=True, stdout=PIPE).stdout.read()
-                else:
-                    Popen(FFMPEG_NOROT.format(name), shell=True, stdout=PIPE).stdout.read()
+    # Long-running job queue instead of a fixed list of URLs.
+    if options.batch or options.serve_port or options.watch_file:
+        from pyriscope import batch
+        options.name = ""
+        prepare(options)
+        finish(batch.run(url_parts_list, options))
 
-                stdoutnl("Converted to {}.mp4!".format(name))
+    # Check for URLs found.
+    if len(url_parts_list) < 1:
+        print("\nError: No valid URLs entered.")
+        sys.exit(1)
 
-                if clean and os.path.exists("{}.ts".format(name)):
-                    os.remove("{}.ts".format(name))
+    # Each broadcast is downloaded once, however often its URL was given.
+    keys = set()
+    unique = []
+    for url_parts in url_parts_list:
+        if get_broadcast_key(url_parts) in keys:
+            stdoutnl("Skipping duplicate URL: {}".format(url_parts['url']))
             continue
-
-        else:
-            if not broadcast_public['broadcast']['available_for_replay']:
-                print("\nError: Replay unavailable: {}".format(url_parts['url']))
-                continue
-
-            # Broadcast replay is available.
-            if url_parts['token'] == "":
-                req_url = PERISCOPE_GETACCESS.format("broadcast_id", url_parts['broadcast_id'])
-            else:
-                req_url = PERISCOPE_GETACCESS.format("token", url_parts['token'])
-
-            stdout("Downloading replay information.")
-            response = requests.get(req_url, headers=req_headers)
-            access_public = json.loads(response.text)
-
-            if 'success' in access_public and access_public['success'] == False:
-                print("\nError: Video expired/deleted/wasn't found: {}".format(url_parts['url']))
-                continue
-
-            base_url = access_public['replay_url']
-            base_url_parts = dissect_replay_url(base_url)
-
-
-            cookiestr = ""
-            cookielist = access_public['cookies']
-            for cookie in cookielist:
-                cookiestr = cookiestr + "{}={};".format(cookie['Name'], cookie['Value'])
-
-            #req_headers['Cookie'] = "{}={};{}={}".format(access_public['cookies'][0]['Name'], access_public['cookies'][0]['Value'], access_public['cookies'][1]['Name'], access_public['cookies'][1]['Value'])
-            req_headers['Cookie'] = cookiestr
-
-            from urllib.parse import urlparse
-            host = urlparse(base_url).netloc
-            req_headers['Host'] = host
-
-            # Get the list of chunks to download.
-            stdout("Downloading chunk list.")
-            response = requests.get(base_url, headers=req_headers)
-            chunks = response.text
-            chunk_pattern = re.compile(r'chunk_\d+\.ts')
-            print("\n")
-            print(response.status_code)
-            print("\n")
-            download_list = []
-            for chunk in re.findall(chunk_pattern, chunks):
-                download_list.append(
-                    {
-                        'url': REPLAY_URL.format(host, base_url_parts['key'], chunk),
-                        'file_name': chunk
-                    }
-                )
-            # Check for empty download_list
-            if not download_list:
-                print("No chunks found")
-                quit()
-
-            # Download chunk .ts files and append them.
-            pool = ThreadPool(name, DEFAULT_DL_THREADS, len(download_list))
-
-            temp_dir_name = ".pyriscope.{}".format(name)
-            if not os.path.exists(temp_dir_name):
-                os.makedirs(temp_dir_name)
-
-            stdout("Downloading replay {}.ts.".format(name))
-
-            for chunk_info in download_list:
-                temp_file_path = "{}/{}".format(temp_dir_name, chunk_info['file_name'])
-                chunk_info['file_path'] = temp_file_path
-                pool.add_task(download_chunk, chunk_info['url'], req_headers, temp_file_path)
-
-            pool.wait_completion()
-
-            if os.path.exists("{}.ts".format(name)):
-                try:
-                    os.remove("{}.ts".format(name))
-                except:
-                    stdoutnl("Failed to delete preexisting {}.ts.".format(name))
-
-            with open("{}.ts".format(name), 'wb') as handle:
-                for chunk_info in download_list:
-                    file_path = chunk_info['file_path']
-                    if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
-                        break
-                    with open(file_path, 'rb') as ts_file:
-                        handle.write(ts_file.read())
-
-            # don't delete temp if the download had missing chunks, just in case
-            if pool.is_complete() and os.path.exists(temp_dir_name):
-                try:
-                    shutil.rmtree(temp_dir_name)
-                except:
-                    stdoutnl("Failed to delete temp folder: {}.".format(temp_dir_name))
-
-            if pool.is_complete():
-                stdoutnl("{}.ts Downloaded!".format(name))
-            else:
-                stdoutnl("{}.ts partially Downloaded!".format(name))
-
-            # Convert video to .mp4.
-            if convert:
-                stdout("Converting to {}.mp4".format(name))
-
-                if rotate:
-                    Popen(FFMPEG_ROT.format(name), shell=True, stdout=PIPE).stdout.read()
-                else:
-                    Popen(FFMPEG_NOROT.format(name), shell=True, stdout=PIPE).stdout.read()
-
-                stdoutnl("Converted to {}.mp4!".format(name))
-
-                if clean and os.path.exists("{}.ts".format(name)):
-                    try:
-                        os.remove("{}.ts".format(name))
-                    except:
-                        stdout("Failed to delete {}.ts.".format(name))
-
-    sys.exit(0)
+        keys.add(get_broadcast_key(url_parts))
+        unique.append(url_parts)
+    url_parts_list = unique
+
+    # Disable custom naming for multiple URLs.
+    if len(url_parts_list) > 1:
+        options.name = ""
+
+    prepare(options)
+
+    if options.parallel > 1 and len(url_parts_list) > 1:
+        # Several broadcasts at once, drawing chunk workers from one scheduler.
+        options.parallel = min(options.parallel, len(url_parts_list))
+        scheduler = ChunkScheduler(options.jobs or DEFAULT_DL_THREADS)
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=options.parallel)
+        try:
+            futures = [executor.submit(run_broadcast, url_parts, options, scheduler) for url_parts in url_parts_list]
+            results = [future.result() for future in futures]
+        except KeyboardInterrupt:
+            stdoutnl('Cancelling downloads...')
+            scheduler.shutdown()
+            executor.shutdown(wait=False, cancel_futures=True)
+            sys.exit(1)
+        scheduler.shutdown()
+        executor.shutdown()
+    else:
+        # Live streams keep recording in the background while the rest run.
+        recordings = {}
+        results = []
+        for index, url_parts in enumerate(url_parts_list):
+            results.append(run_broadcast(url_parts, options,
+                                         on_record=lambda future, index=index: recordings.setdefault(index, future)))
+        for index, future in recordings.items():
+            results[index] = wait_recording(url_parts_list[index], future)
+
+    if len(url_parts_list) > 1:
+        show_summary(url_parts_list, results)
+
+    finish(results)
@@ -0,0 +1,177 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import errno
+import json
+import os
+import shutil
+from threading import Lock
+
+
+# Contants.
+CHECK_SUFFIX = ".check.json"
+EVICT_TARGET = 0.9
+
+
+# Classes.
+class ChunkStore:
+    # Replay chunks kept between runs and shared by every process using the
+    # same cache directory, as <root>/<broadcast key>/<chunk file name> with
+    # its integrity check next to it. The chunks of an ended broadcast never
+    # change, so they are handed out as hard links where the filesystem
+    # allows. The least recently used chunks are evicted once the store
+    # grows past max_bytes.
+    def __init__(self, root, max_bytes):
+        self.root        = root
+        self.max_bytes   = max_bytes
+        self.total_bytes = None
+        self.num_hits    = 0
+        self.num_added   = 0
+        self.hard_links  = True
+        self.lock        = Lock()
+
+    def broadcast(self, key):
+        return StoredChunks(self, key)
+
+    def link_or_copy(self, source, destination):
+        # Hard link when source and destination share a filesystem. Once a
+        # link fails because they don't, later chunks are copied straight away.
+        if os.path.exists(destination):
+            os.remove(destination)
+        if self.hard_links:
+            try:
+                os.link(source, destination)
+                return
+            except OSError as e:
+                if e.errno == errno.EXDEV:
+                    self.hard_links = False
+        shutil.copyfile(source, destination)
+
+    def _scan(self):
+        # (mtime, size, path) of every chunk, from the filesystem, since other
+        # processes add and evict chunks too.
+        chunks = []
+        for dir_path, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                if file_name.endswith(CHECK_SUFFIX) or file_name.startswith('.'):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                chunks.append((stat.st_mtime, stat.st_size, path))
+        return chunks
+
+    def _added(self, size):
+        with self.lock:
+            self.num_added += 1
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self._scan())
+            else:
+                self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        chunks = sorted(self._scan())
+        self.total_bytes = sum(size for _, size, _ in chunks)
+        for _, size, path in chunks:
+            if self.total_bytes <= self.max_bytes * EVICT_TARGET:
+                break
+            for file_path in (path, path + CHECK_SUFFIX):
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+            self.total_bytes -= size
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                # Still has chunks.
+                pass
+
+    def _hit(self):
+        with self.lock:
+            self.num_hits += 1
+
+
+class StoredChunks:
+    # One broadcast's chunks in a ChunkStore.
+    def __init__(self, store, key):
+        self.store = store
+        self.path  = os.path.join(store.root, key)
+
+    def _check(self, file_name):
+        # The integrity report of a stored chunk, None if it isn't stored.
+        path = os.path.join(self.path, file_name)
+        try:
+            with open(path + CHECK_SUFFIX) as handle:
+                report = json.load(handle)
+            if os.path.getsize(path) != report['size']:
+                return None
+            # Mark it as recently used.
+            os.utime(path)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return report
+
+    def link(self, file_name, path):
+        # Puts the stored chunk at path and returns its report, or None.
+        report = self._check(file_name)
+        if report is None:
+            return None
+        try:
+            self.store.link_or_copy(os.path.join(self.path, file_name), path)
+        except OSError:
+            return None
+        self.store._hit()
+        return report
+
+    def read(self, file_name):
+        # (data, report) of the stored chunk, or (None, None).
+        report = self._check(file_name)
+        if report is None:
+            return None, None
+        try:
+            with open(os.path.join(self.path, file_name), 'rb') as handle:
+                data = handle.read()
+        except OSError:
+            return None, None
+        if len(data) != report['size']:
+            return None, None
+        self.store._hit()
+        return data, report
+
+    def add_file(self, file_name, path, report):
+        self._add(file_name, report, lambda temp_path: self.store.link_or_copy(path, temp_path))
+
+    def add_data(self, file_name, data, report):
+        def write(temp_path):
+            with open(temp_path, 'wb') as handle:
+                handle.write(data)
+        self._add(file_name, report, write)
+
+    def _add(self, file_name, report, write):
+        # The report goes first: a chunk without one doesn't count as stored.
+        path = os.path.join(self.path, file_name)
+        temp_path = os.path.join(self.path, ".{}.{}".format(file_name, os.getpid()))
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(temp_path + CHECK_SUFFIX, 'w') as handle:
+                json.dump(report, handle)
+            os.replace(temp_path + CHECK_SUFFIX, path + CHECK_SUFFIX)
+            write(temp_path)
+            os.replace(temp_path, path)
+        except OSError:
+            # A full or read-only store only costs the next run a download.
+            for file_path in (temp_path, temp_path + CHECK_SUFFIX):
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+            return
+        self.store._added(report['size'])
@@ -0,0 +1,276 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import os
+import re
+import shutil
+import time
+from concurrent.futures import Future
+from subprocess import DEVNULL, PIPE, Popen
+from threading import Lock, Thread
+
+from pyriscope import processor
+from pyriscope.processor import (FFMPEG_JOIN, FFMPEG_LIVE, FFMPEG_LIVE_PART, FFMPEG_LIVE_SEGMENT, RESULT_DOWNLOADED,
+                                 DownloadFailed, get_access_public, get_broadcast_public, show, stdout, stdoutnl)
+
+
+# Contants.
+POLL_INTERVAL = 0.5
+# Runs shorter than this count towards giving up on a broadcast.
+QUICK_EXIT = 10.0
+MAX_QUICK_EXITS = 8
+MAX_BACKOFF = 30.0
+# ffmpeg's exit status after SIGINT or 'q'.
+FFMPEG_INTERRUPTED = 255
+
+
+# Classes.
+class LiveCapture:
+    # One live broadcast recorded by ffmpeg into <name>.partNNN.ts files. A
+    # run that ends while the broadcast is still RUNNING is restarted into
+    # the next part with fresh access. The parts are joined into <name>.ts
+    # at the end, unless they were asked for as fixed-length segments.
+    def __init__(self, name, url_parts, req_headers, hls_url, options, max_duration=None, on_convert=None):
+        self.name          = name
+        self.url_parts     = url_parts
+        self.req_headers   = req_headers
+        self.hls_url       = hls_url
+        self.options       = options
+        self.max_duration  = max_duration
+        self.on_convert    = on_convert
+        self.temp_dir_name = ".pyriscope.{}".format(name)
+        self.process       = None
+        self.log           = None
+        self.run_start     = None
+        self.recorded      = 0.0
+        self.num_runs      = 0
+        self.num_quick     = 0
+        self.next_start    = 0.0
+        self.stopping      = False
+        self.errors        = ""
+        self.future        = Future()
+
+    def parts(self):
+        # (number, file name) of the parts written so far, in order.
+        pattern = re.compile(r'^{}\.part(\d+)\.ts$'.format(re.escape(self.name)))
+        parts = []
+        for file_name in os.listdir('.'):
+            match = pattern.match(file_name)
+            if match is not None:
+                parts.append((int(match.group(1)), file_name))
+        return sorted(parts)
+
+    def start(self):
+        parts = self.parts()
+        number = parts[-1][0] + 1 if parts else 0
+
+        time_argument = ""
+        if self.max_duration is not None:
+            time_argument = " -t {:.3f}".format(self.max_duration - self.recorded)
+        if self.options.segment_time:
+            output = FFMPEG_LIVE_SEGMENT.format(self.options.segment_time, number, self.name)
+        else:
+            output = FFMPEG_LIVE_PART.format(self.name, number)
+        command = FFMPEG_LIVE.format(self.url_parts['url'], self.req_headers['User-Agent'], self.hls_url,
+                                     time_argument, output)
+
+        os.makedirs(self.temp_dir_name, exist_ok=True)
+        self.log = open(os.path.join(self.temp_dir_name, "ffmpeg.log"), 'w+b')
+        # ffmpeg stops cleanly on a 'q' written to its stdin.
+        self.process = Popen(command, shell=True, stdin=PIPE, stdout=DEVNULL, stderr=self.log)
+        self.run_start = time.monotonic()
+        self.num_runs += 1
+        if self.num_runs == 1:
+            stdout("Recording stream to {}.ts".format(self.name))
+
+    def stop(self):
+        self.stopping = True
+        process = self.process
+        if process is not None and process.poll() is None:
+            try:
+                process.stdin.write(b'q')
+                process.stdin.flush()
+            except (BrokenPipeError, OSError):
+                pass
+
+    def poll(self):
+        # Called by the supervisor, True once the recording is finished.
+        if self.process is not None:
+            if self.process.poll() is None:
+                return False
+            if not self._run_ended():
+                return self._finish()
+        if self.stopping:
+            return self._finish()
+        if time.monotonic() < self.next_start:
+            return False
+
+        try:
+            live = self._refresh()
+        except Exception as e:
+            # Most likely the same network trouble that stopped ffmpeg.
+            self.errors = "Unable to check the broadcast: {}".format(e)
+            if not self._back_off(True):
+                return self._finish()
+            return False
+        if not live:
+            return self._finish()
+
+        stdoutnl("{}.ts: ffmpeg stopped while the broadcast is live, restarting.".format(self.name))
+        self.start()
+        return False
+
+    def _run_ended(self):
+        # True if the broadcast should be checked for a restart.
+        process, self.process = self.process, None
+        elapsed = time.monotonic() - self.run_start
+        self.recorded += elapsed
+        try:
+            process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        self.log.seek(0)
+        self.errors = self.log.read().decode('utf-8', 'replace').strip() or \
+            "ffmpeg exited with status {}.".format(process.returncode)
+        self.log.close()
+
+        if self.stopping or process.returncode < 0 or process.returncode == FFMPEG_INTERRUPTED:
+            # Stopped on purpose. Ctrl+C reaches ffmpeg too.
+            return False
+        if self.max_duration is not None and self.recorded >= self.max_duration - POLL_INTERVAL:
+            return False
+        return self._back_off(elapsed < QUICK_EXIT)
+
+    def _back_off(self, quick):
+        self.num_quick = self.num_quick + 1 if quick else 0
+        if self.num_quick >= MAX_QUICK_EXITS:
+            return False
+        self.next_start = time.monotonic() + min(2 ** self.num_quick, MAX_BACKOFF)
+        return True
+
+    def _refresh(self):
+        # Fresh access to the stream if the broadcast is still live. A RUNNING
+        # broadcast is never served from the metadata cache.
+        broadcast_public = get_broadcast_public(self.url_parts, self.req_headers)
+        if broadcast_public['broadcast']['state'] != 'RUNNING':
+            return False
+        access_public = get_access_public(self.url_parts, self.req_headers)
+        if 'hls_url' not in access_public:
+            return False
+        self.hls_url = access_public['hls_url']
+        return True
+
+    def _finish(self):
+        parts = []
+        for _, file_name in self.parts():
+            if os.path.getsize(file_name) > 0:
+                parts.append(file_name)
+            else:
+                os.remove(file_name)
+
+        if not parts:
+            shutil.rmtree(self.temp_dir_name, ignore_errors=True)
+            self.future.set_exception(DownloadFailed("Unable to record live stream: {}".format(self.errors),
+                                                     self.url_parts['url']))
+            return True
+
+        if self.options.segment_time or not self._join(parts):
+            outputs = [file_name[:-3] for file_name in parts]
+            path = "{}.part*.ts".format(self.name)
+            stdoutnl("{} Downloaded! ({} parts)".format(path, len(parts)))
+        else:
+            outputs = [self.name]
+            path = "{}.ts".format(self.name)
+            stdoutnl("{} Downloaded!".format(path))
+        shutil.rmtree(self.temp_dir_name, ignore_errors=True)
+
+        # Convert video to .mp4.
+        if self.options.convert:
+            for output in outputs:
+                future = processor.conversion_pool.submit(output, self.options)
+                if self.on_convert is not None:
+                    self.on_convert(future)
+
+        self.future.set_result((RESULT_DOWNLOADED, path))
+        return True
+
+    def _join(self, parts):
+        # Lossless: ffmpeg's concat demuxer copies the streams and lines up
+        # the timestamps of each run.
+        if len(parts) == 1:
+            os.replace(parts[0], "{}.ts".format(self.name))
+            return True
+
+        list_path = os.path.join(self.temp_dir_name, "parts.txt")
+        with open(list_path, 'w') as handle:
+            for file_name in parts:
+                handle.write("file '{}'\n".format(os.path.abspath(file_name).replace("'", "'\\''")))
+        process = Popen(FFMPEG_JOIN.format(list_path, self.name), shell=True, stdin=DEVNULL, stdout=DEVNULL,
+                        stderr=PIPE)
+        errors = process.communicate()[1].decode('utf-8', 'replace').strip()
+        if process.returncode != 0:
+            # The parts still hold the whole recording.
+            show("Joining the parts of {}.ts failed: {}".format(self.name, errors))
+            return False
+        for file_name in parts:
+            os.remove(file_name)
+        return True
+
+    def fail(self, error):
+        if self.process is not None:
+            self.stop()
+        if not self.future.done():
+            self.future.set_exception(DownloadFailed("Live recording failed: {}".format(error),
+                                                     self.url_parts['url']))
+
+
+class LiveSupervisor:
+    # Watches every ffmpeg live capture of the run from one thread, so a live
+    # recording doesn't hold up other broadcasts, or other recordings.
+    def __init__(self):
+        self.captures = []
+        self.thread   = None
+        self.lock     = Lock()
+
+    def record(self, name, url_parts, req_headers, hls_url, options, max_duration=None, on_convert=None):
+        # Starts recording and returns a Future of (result, path).
+        capture = LiveCapture(name, url_parts, req_headers, hls_url, options, max_duration, on_convert)
+        capture.start()
+        with self.lock:
+            self.captures.append(capture)
+            if self.thread is None:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return capture.future
+
+    def run(self):
+        while True:
+            with self.lock:
+                captures = list(self.captures)
+                if not captures:
+                    self.thread = None
+                    return
+            for capture in captures:
+                try:
+                    finished = capture.poll()
+                except Exception as e:
+                    capture.fail(e)
+                    finished = True
+                if finished:
+                    with self.lock:
+                        self.captures.remove(capture)
+            time.sleep(POLL_INTERVAL)
+
+    def stop(self):
+        # Ends every recording with what was captured so far.
+        with self.lock:
+            captures = list(self.captures)
+        for capture in captures:
+            capture.stop()
+
+
+# Every live recording of the run.
+live_supervisor = LiveSupervisor()
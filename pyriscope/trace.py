@@ -0,0 +1,148 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import json
+import os
+import time
+from contextvars import ContextVar
+from itertools import count
+from threading import Lock, current_thread, get_ident
+
+
+# Contants.
+SUMMARY_SIZE = 10
+# Made-up thread ids for async workers, clear of real ones in the trace.
+VIRTUAL_TID_START = 1
+
+
+# Classes.
+class Span:
+    # A timed part of the run, recorded when its with block is left.
+    def __init__(self, tracer, name, category, args, tid=None):
+        self.tracer   = tracer
+        self.name     = name
+        self.category = category
+        self.args     = args
+        self.tid      = tid if tid is not None else get_ident()
+        self.token    = None
+        self.start    = time.perf_counter()
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        # Tracer.note() adds to the innermost span of the thread or task.
+        self.token = self.tracer.current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.current.reset(self.token)
+        if exc_value is not None:
+            self.args['error'] = type(exc_value).__name__
+            if getattr(exc_value, 'status_code', None) is not None:
+                self.args.setdefault('status', exc_value.status_code)
+        self.tracer.add(self, time.perf_counter())
+        return False
+
+
+class NoSpan:
+    # What processor.trace() hands out while tracing is off.
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class Tracer:
+    # Spans of every phase and chunk of the run, written as Chrome trace-event
+    # JSON for chrome://tracing, Perfetto or speedscope.
+    def __init__(self, path):
+        self.path         = path
+        self.origin       = time.perf_counter()
+        self.pid          = os.getpid()
+        self.spans        = []
+        self.thread_names = {}
+        self.virtual_tids = count(VIRTUAL_TID_START)
+        self.current      = ContextVar('span', default=None)
+        self.lock         = Lock()
+
+    def span(self, name, category, tid=None, **args):
+        return Span(self, name, category, args, tid)
+
+    def note(self, **args):
+        span = self.current.get()
+        if span is not None:
+            span.args.update(args)
+
+    def virtual_thread(self, name):
+        # A timeline of its own, for work that shares a real thread.
+        tid = next(self.virtual_tids)
+        with self.lock:
+            self.thread_names[tid] = name
+        return tid
+
+    def add(self, span, end):
+        with self.lock:
+            self.spans.append((span.name, span.category, span.tid, span.start, end, span.args))
+            if span.tid not in self.thread_names:
+                self.thread_names[span.tid] = current_thread().name
+
+    def write(self):
+        with self.lock:
+            spans = list(self.spans)
+            thread_names = dict(self.thread_names)
+
+        events = [{'name': "process_name", 'ph': "M", 'pid': self.pid, 'args': {'name': "pyriscope"}}]
+        for tid, name in thread_names.items():
+            events.append({'name': "thread_name", 'ph': "M", 'pid': self.pid, 'tid': tid, 'args': {'name': name}})
+        for name, category, tid, start, end, args in spans:
+            events.append({'name': name, 'cat': category, 'ph': "X", 'pid': self.pid, 'tid': tid,
+                           'ts': round((start - self.origin) * 1e6, 1), 'dur': round((end - start) * 1e6, 1),
+                           'args': args})
+
+        temp_path = "{}.{}".format(self.path, os.getpid())
+        with open(temp_path, 'w') as handle:
+            json.dump({'traceEvents': events, 'displayTimeUnit': "ms"}, handle)
+        os.replace(temp_path, self.path)
+
+    def summary(self, size=SUMMARY_SIZE):
+        # Lines ranking the phases by total time and the slowest chunks.
+        with self.lock:
+            spans = list(self.spans)
+            thread_names = dict(self.thread_names)
+
+        phases = {}
+        chunks = []
+        for name, category, tid, start, end, args in spans:
+            if category == 'chunk':
+                chunks.append((end - start, name, tid, args))
+                continue
+            total, num, longest = phases.get(name, (0.0, 0, 0.0))
+            phases[name] = (total + end - start, num + 1, max(longest, end - start))
+
+        lines = []
+        if phases:
+            lines.append("Slowest phases:")
+            lines.append("    {:>9} {:>6} {:>9}  {}".format("total", "count", "max", "phase"))
+            ranked = sorted(phases.items(), key=lambda item: item[1][0], reverse=True)
+            for name, (total, num, longest) in ranked[:size]:
+                lines.append("    {:>8.3f}s {:>6} {:>8.3f}s  {}".format(total, num, longest, name))
+        if chunks:
+            lines.append("Slowest chunks:")
+            lines.append("    {:>9} {:>10} {:>6}  {}".format("time", "bytes", "status", "chunk (thread)"))
+            for duration, name, tid, args in sorted(chunks, key=lambda chunk: chunk[0], reverse=True)[:size]:
+                lines.append("    {:>8.3f}s {:>10} {:>6}  {} ({})".format(
+                    duration, args.get('bytes', "-"), args.get('status', args.get('error', "-")), name,
+                    thread_names.get(tid, tid)))
+        return lines
+
+
+# Shared, since it holds nothing.
+NO_SPAN = NoSpan()
@@ -0,0 +1,232 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import json
+import random
+import re
+import time
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+
+from pyriscope.batch import STATE_QUEUED
+from pyriscope.processor import (PERISCOPE_GETBROADCASTS, PERISCOPE_GETUSERBROADCASTS, URL_PATTERN,
+                                 dissect_url, session_pool, stdoutnl)
+
+
+# Contants.
+BROADCAST_URL = "https://www.periscope.tv/w/{}"
+USER_PATTERN = re.compile(r'^(?:(?:https?://)?(?:www\.)?periscope\.tv/|@)?(\w+)/?$')
+# Broadcast IDs per getBroadcastsPublic request.
+MAX_BATCH = 100
+MAX_BACKOFF = 15 * 60.0
+JITTER = 0.2
+# The first checks of many users are spread out by this much each.
+STARTUP_SPACING = 0.1
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# (connect, read) timeout of a check. A check that is slow to answer is tried
+# again at the next one.
+POLL_TIMEOUT = (5, 10)
+# Users checked at once.
+POLL_WORKERS = 8
+
+
+# Classes.
+class PollError(Exception):
+    def __init__(self, message, retry_after=None):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class WatchTarget:
+    # A watched user or broadcast ID and when to check it next. states holds
+    # a user's broadcasts as of the last check, None until the first one.
+    def __init__(self, key, next_poll=0.0):
+        self.key       = key
+        self.next_poll = next_poll
+        self.failures  = 0
+        self.states    = None
+
+
+class Watcher(Thread):
+    # Polls watched users and broadcast IDs and queues a job for every
+    # broadcast that goes live, or ends with a replay, while it runs. Checks
+    # are conditional requests, broadcast IDs are checked MAX_BATCH at a
+    # time, users that are due are checked side by side, and failing checks
+    # back off exponentially with jitter.
+    def __init__(self, queue, users, broadcast_ids, interval, req_headers):
+        Thread.__init__(self, daemon=True)
+        self.queue            = queue
+        self.interval         = interval
+        self.req_headers      = req_headers
+        now = time.monotonic()
+        self.users            = [WatchTarget(user, now + index * STARTUP_SPACING)
+                                 for index, user in enumerate(users)]
+        self.broadcasts       = {key: WatchTarget(key, now) for key in broadcast_ids}
+        self.validators       = {}
+        self.stop_event       = Event()
+        self.num_requests     = 0
+        self.num_not_modified = 0
+        self.num_queued       = 0
+        self.lock             = Lock()
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix="watch") as executor:
+            while not self.stop_event.is_set():
+                now = time.monotonic()
+                due = [target for target in self.broadcasts.values() if target.next_poll <= now]
+                for start in range(0, len(due), MAX_BATCH):
+                    self.check(due[start:start + MAX_BATCH], self.poll_broadcasts)
+                # One slow user doesn't hold up the others.
+                due = [target for target in self.users if target.next_poll <= now]
+                for future in [executor.submit(self.check, [target], self.poll_user) for target in due]:
+                    future.result()
+
+                targets = self.users + list(self.broadcasts.values())
+                if not targets:
+                    stdoutnl("Watch: Nothing left to watch.")
+                    return
+                wait = min(target.next_poll for target in targets) - time.monotonic()
+                self.stop_event.wait(min(max(wait, 0.05), self.interval))
+
+    def stop(self):
+        self.stop_event.set()
+
+    def check(self, targets, poll):
+        try:
+            poll(targets)
+        except Exception as e:
+            wait = getattr(e, 'retry_after', None) or 0
+            for target in targets:
+                target.failures += 1
+                delay = min(self.interval * 2 ** target.failures, MAX_BACKOFF) * random.uniform(0.5, 1.0)
+                target.next_poll = time.monotonic() + max(delay, wait)
+            stdoutnl("Watch: Checking {} failed: {}".format(", ".join(target.key for target in targets), e))
+            return
+        for target in targets:
+            target.failures = 0
+            target.next_poll = time.monotonic() + self.interval * random.uniform(1 - JITTER, 1 + JITTER)
+
+    def fetch(self, url):
+        # The decoded response, or None if nothing changed since the last one.
+        headers = dict(self.req_headers)
+        etag, last_modified = self.validators.get(url, (None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        response = session_pool.get(url, headers=headers, timeout=POLL_TIMEOUT)
+        with self.lock:
+            self.num_requests += 1
+            if response.status_code == 304:
+                self.num_not_modified += 1
+        if response.status_code == 304:
+            return None
+        if response.status_code in RETRY_STATUSES:
+            raise PollError("HTTP {}".format(response.status_code), retry_after(response))
+        if response.status_code != 200:
+            raise PollError("HTTP {}".format(response.status_code))
+
+        body = json.loads(response.text)
+        if response.headers.get('ETag') or response.headers.get('Last-Modified'):
+            self.validators[url] = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return body
+
+    def poll_user(self, targets):
+        target = targets[0]
+        body = self.fetch(PERISCOPE_GETUSERBROADCASTS.format(target.key))
+        if body is None:
+            return
+
+        states = {}
+        for broadcast in broadcast_list(body):
+            state = (broadcast.get('state'), bool(broadcast.get('available_for_replay')))
+            states[broadcast['id']] = state
+            if target.states is None:
+                # The first check only catches what is live right now.
+                if state[0] == 'RUNNING':
+                    self.found(broadcast, "is live")
+            elif target.states.get(broadcast['id']) != state:
+                if state[0] == 'RUNNING':
+                    self.found(broadcast, "went live")
+                elif state[1]:
+                    self.found(broadcast, "has a replay")
+        target.states = states
+
+    def poll_broadcasts(self, targets):
+        url = PERISCOPE_GETBROADCASTS.format(",".join(target.key for target in targets))
+        body = self.fetch(url)
+        if body is None:
+            return
+
+        for broadcast in broadcast_list(body):
+            if broadcast.get('id') not in self.broadcasts:
+                continue
+            if broadcast.get('state') == 'RUNNING':
+                self.found(broadcast, "is live")
+            elif broadcast.get('available_for_replay'):
+                self.found(broadcast, "has a replay")
+            elif broadcast.get('state') in ('ENDED', 'TIMED_OUT'):
+                stdoutnl("Watch: {} ended without a replay.".format(broadcast['id']))
+            else:
+                continue
+            del self.broadcasts[broadcast['id']]
+            # The next batch is a different request.
+            self.validators.pop(url, None)
+
+    def found(self, broadcast, reason):
+        # The queue skips a broadcast it already has, e.g. the replay of a
+        # live stream that was recorded.
+        job = self.queue.add(BROADCAST_URL.format(broadcast['id']))
+        if job is not None and job['state'] == STATE_QUEUED:
+            with self.lock:
+                self.num_queued += 1
+            stdoutnl("Watch: {} {} {}, queued as job {}.".format(
+                broadcast.get('username') or "Broadcast", broadcast['id'], reason, job['id']))
+
+
+# Functions.
+def broadcast_list(body):
+    if isinstance(body, dict):
+        body = body.get('broadcasts') or []
+    return [broadcast for broadcast in body if isinstance(broadcast, dict) and broadcast.get('id')]
+
+
+def retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_targets(path):
+    # Users and broadcast IDs, one per line: a user name, @name or profile
+    # URL, or a broadcast URL.
+    users = []
+    broadcast_ids = []
+    with open(path) as handle:
+        for line in handle:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if re.search(URL_PATTERN, line):
+                url_parts = dissect_url(line)
+                if url_parts['token'] == "":
+                    broadcast_ids.append(url_parts['broadcast_id'])
+                    continue
+            else:
+                match = USER_PATTERN.match(line)
+                if match is not None:
+                    users.append(match.group(1))
+                    continue
+            print("\nError: Can't watch: {}".format(line))
+    return users, broadcast_ids
@@ -30,6 +30,7 @@ setup(name='pyriscope',
           'Topic :: Multimedia :: Video :: Capture'
       ],
       install_requires=["requests", "wheel", "six", "python-dateutil"],
+      extras_require={'async': ["aiohttp"]},
       entry_points={
           'console_scripts': [
               'pyriscope = pyriscope.__main__:main'
@@ -0,0 +1,102 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from mockserver import MockServer
+
+# pyriscope reads the API URL and the cache directory when it is imported, so
+# one mock server serves the whole session and the tests never touch ~/.cache.
+mock_server = MockServer(num_chunks=10, chunk_size=188 * 20, latency=0.0).start()
+os.environ['PYRISCOPE_API_URL'] = mock_server.api_url
+os.environ['PYRISCOPE_CACHE_DIR'] = tempfile.mkdtemp(prefix="pyriscope-tests-")
+
+
+@pytest.fixture
+def server():
+    # The shared mock server, back to its defaults after each test.
+    yield mock_server
+    mock_server.num_chunks = 10
+    mock_server.chunk_size = 188 * 20
+    mock_server.latency = 0.0
+    mock_server.error_rate = 0.0
+    mock_server.stall_rate = 0.0
+    mock_server.ranges = True
+    with mock_server.lock:
+        mock_server.broadcasts = {}
+    mock_server.reset()
+
+
+@pytest.fixture
+def cli(tmp_path):
+    # Runs pyriscope's command line in tmp_path against the mock server.
+    def run(*args):
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        return subprocess.run([sys.executable, "-m", "pyriscope"] + list(args), cwd=str(tmp_path), env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=60)
+    return run
+
+
+def install_ffmpeg(tmp_path, monkeypatch, script):
+    # Puts a directory with a fake ffmpeg running script first on PATH.
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    ffmpeg = bin_dir / "ffmpeg"
+    ffmpeg.write_text("#!/bin/sh\n" + script)
+    ffmpeg.chmod(0o755)
+    monkeypatch.setenv('PATH', "{}{}{}".format(bin_dir, os.pathsep, os.environ['PATH']))
+    # Probe this one, not whatever ffmpeg an earlier test found.
+    from pyriscope import processor
+    monkeypatch.setattr(processor, 'ffmpeg_probe', None)
+    return str(bin_dir)
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch):
+    # Copies its input, a file or stdin, to the output, its last argument.
+    return install_ffmpeg(tmp_path, monkeypatch, """
+for arg; do
+    [ "$previous" = "-i" ] && input="$arg"
+    previous="$arg"
+done
+if [ "$input" = "pipe:0" ]; then cat > "$previous"; else cp "$input" "$previous"; fi
+""")
+
+
+@pytest.fixture
+def failing_ffmpeg(tmp_path, monkeypatch):
+    # Reads its input and fails.
+    return install_ffmpeg(tmp_path, monkeypatch, "cat > /dev/null\necho 'Invalid data found' >&2\nexit 1\n")
+
+
+@pytest.fixture
+def recording_ffmpeg(tmp_path, monkeypatch):
+    # Each live run records "run" into its part. The concat demuxer joins the parts.
+    return install_ffmpeg(tmp_path, monkeypatch, """
+for arg; do
+    [ "$previous" = "-i" ] && input="$arg"
+    previous="$arg"
+done
+case "$*" in
+    *concat*) sed -n "s/^file '\\\\(.*\\\\)'$/\\\\1/p" "$input" | while read -r part; do cat "$part"; done > "$previous";;
+    *) printf run > "$previous";;
+esac
+""")
+
+
+@pytest.fixture
+def refused_ffmpeg(tmp_path, monkeypatch):
+    # Exits at once, as when the stream can't be reached.
+    return install_ffmpeg(tmp_path, monkeypatch, "echo 'Connection refused' >&2\nexit 1\n")
@@ -0,0 +1,55 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import pytest
+
+from pyriscope.api import Client, ConversionFailed, InvalidOptions, ReplayUnavailable
+
+BROADCAST_URL = "https://www.periscope.tv/w/1LyxBeXmWObJN"
+
+
+def test_download(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    events = []
+    with Client(parallel=1, cache=False) as client:
+        broadcast = client.resolve(BROADCAST_URL)
+        assert broadcast.username == "bench" and broadcast.available_for_replay and not broadcast.is_live
+        download = client.download(broadcast, progress=events.append, name="out").result(30)
+    assert download.complete and download.path == "out.ts"
+    assert (tmp_path / "out.ts").read_bytes() == b"".join(server.chunk(index) for index in range(server.num_chunks))
+    assert events[-1]['chunks'] == events[-1]['total'] == server.num_chunks
+
+
+def test_errors_are_raised(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server.set_broadcast("pending3", "alice", "ENDED")
+    with Client(parallel=1, cache=False) as client:
+        with pytest.raises(InvalidOptions):
+            client.download(BROADCAST_URL, no_such_option=True)
+        with pytest.raises(ReplayUnavailable):
+            client.download("https://www.periscope.tv/w/pending3").result(30)
+
+
+def test_failed_pipe_raises(server, tmp_path, monkeypatch, failing_ffmpeg):
+    monkeypatch.chdir(tmp_path)
+    with Client(parallel=1, cache=False) as client:
+        future = client.download(BROADCAST_URL, name="out", pipe=True, stream=True, convert=True, clean=True)
+        with pytest.raises(ConversionFailed) as info:
+            future.result(30)
+    assert info.value.download.path == "out.ts"
+    assert (tmp_path / "out.ts").exists()
+
+
+def test_parallel_downloads_of_one_broadcast(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    expected = b"".join(server.chunk(index) for index in range(server.num_chunks))
+    with Client(parallel=2, cache=False) as client:
+        futures = [client.download(BROADCAST_URL, name="same") for _ in range(2)]
+        downloads = [future.result(30) for future in futures]
+    # Whichever way they overlap, each ends up with a whole replay.
+    for download in downloads:
+        assert (tmp_path / download.path).read_bytes() == expected
+    assert not list(tmp_path.glob(".pyriscope.*"))
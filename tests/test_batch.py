@@ -0,0 +1,60 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import json
+
+from pyriscope.batch import STATE_DONE, STATE_FAILED, STATE_QUEUED, JobQueue, add_lines
+
+URL = "https://www.periscope.tv/w/{}"
+
+
+def log_lines(path):
+    return path.read_text().splitlines()
+
+
+def test_bulk_enqueue(tmp_path):
+    path = tmp_path / "queue.jsonl"
+    queue = JobQueue(str(path))
+    lines = [URL.format("b{}".format(index)) for index in range(5000)]
+    add_lines(queue, lines + lines[:10] + ["# a comment", "not a url"])
+    assert len(queue.jobs) == 5000
+    # One line per job, nothing rewritten for the duplicates.
+    assert len(log_lines(path)) == 5000
+
+    job = queue.next_job()
+    assert job['url'] == lines[0]
+    queue.set_state(job, STATE_DONE, "b0.ts")
+    # A state change is appended, not a rewrite of the whole queue.
+    assert len(log_lines(path)) == 5002
+
+
+def test_queue_survives_restart(tmp_path):
+    path = tmp_path / "queue.jsonl"
+    queue = JobQueue(str(path))
+    first, second, third = queue.add_all([URL.format("one"), URL.format("two") + " 2", URL.format("three")])
+    assert queue.next_job() is first
+    queue.set_state(queue.next_job(), STATE_FAILED, "gone")
+    with open(str(path), 'a') as handle:
+        handle.write('{"id": 3, "st')
+
+    queue = JobQueue(str(path))
+    # The cut off job is queued again, and the log is compacted.
+    assert [job['state'] for job in queue.jobs] == [STATE_QUEUED, STATE_FAILED, STATE_QUEUED]
+    assert queue.jobs[1]['priority'] == 2.0
+    assert len(log_lines(path)) == 3
+    # Failed jobs go back in the queue when they are added again.
+    assert queue.add(URL.format("two"))['state'] == STATE_QUEUED
+    assert [queue.next_job()['id'] for _ in range(3)] == [1, 3, 2]
+
+
+def test_queue_reads_old_format(tmp_path):
+    path = tmp_path / "queue.json"
+    job = {'id': 4, 'url': URL.format("old"), 'priority': None, 'state': STATE_DONE, 'detail': "old.ts",
+           'added': 0, 'updated': 0}
+    path.write_text(json.dumps({'jobs': [job]}, indent=1))
+    queue = JobQueue(str(path))
+    assert queue.jobs == [job]
+    assert queue.add(URL.format("new"))['id'] == 5
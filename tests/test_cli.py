@@ -0,0 +1,35 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import json
+
+BROADCAST_URL = "https://www.periscope.tv/w/1LyxBeXmWObJN"
+
+
+def test_failed_pipe_exits_nonzero(server, tmp_path, cli, failing_ffmpeg):
+    result = cli(BROADCAST_URL, "-n", "out", "-C", "--pipe")
+    assert result.returncode == 1, result.stdout
+    assert b"0 of 1 conversions succeeded" in result.stdout
+    assert (tmp_path / "out.ts").exists()
+
+
+def test_duplicate_urls_download_once(server, tmp_path, cli):
+    result = cli(BROADCAST_URL, BROADCAST_URL, "-p", "2", "-n", "out")
+    assert result.returncode == 0, result.stdout
+    assert b"Skipping duplicate URL" in result.stdout
+    assert sorted(path.name for path in tmp_path.glob("*.ts")) == ["out.ts"]
+    assert (tmp_path / "out.ts").read_bytes() == b"".join(server.chunk(index) for index in range(server.num_chunks))
+
+
+def test_trace_file(server, tmp_path, cli):
+    result = cli(BROADCAST_URL, "-n", "out", "--trace", "trace.json")
+    assert result.returncode == 0, result.stdout
+    assert b"Slowest phases:" in result.stdout and b"Slowest chunks:" in result.stdout
+    events = json.loads((tmp_path / "trace.json").read_text())['traceEvents']
+    chunks = [event for event in events if event.get('cat') == 'chunk']
+    assert len(chunks) == server.num_chunks
+    assert sum(event['args']['bytes'] for event in chunks) == (tmp_path / "out.ts").stat().st_size
+    assert "download" in {event['name'] for event in events if event.get('cat') == 'phase'}
@@ -0,0 +1,60 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+from pyriscope.integrity import OrderedFeed, TsValidator
+
+
+def feed(data, block_size):
+    validator = TsValidator()
+    for offset in range(0, len(data), block_size):
+        validator.feed(data[offset:offset + block_size])
+    return validator
+
+
+def test_valid_chunk_in_any_block_size(server):
+    chunk = server.chunk(3)
+    for block_size in (1, 100, 188, 4096, len(chunk)):
+        validator = feed(chunk, block_size)
+        assert validator.is_valid(), validator.error()
+        assert validator.packets == len(chunk) // 188
+        assert validator.cc_errors == 0
+        assert validator.report()['size'] == len(chunk)
+
+
+def test_missing_sync_byte(server):
+    chunk = bytearray(server.chunk(0))
+    chunk[188 * 2] = 0
+    validator = feed(bytes(chunk), 4096)
+    assert not validator.is_valid()
+    assert validator.sync_errors == 1
+    assert "without a sync byte" in validator.error()
+
+
+def test_continuity_error_is_counted_but_valid(server):
+    chunk = server.chunk(0)
+    # Drop one packet, so the counter skips a step.
+    validator = feed(chunk[:188] + chunk[376:], 4096)
+    assert validator.is_valid()
+    assert validator.cc_errors == 1
+
+
+def test_partial_packet(server):
+    validator = feed(server.chunk(0)[:-10], 4096)
+    assert not validator.is_valid()
+    assert "after the last whole packet" in validator.error()
+
+
+
+def test_ordered_feed(server):
+    chunk = server.chunk(1)
+    validator = TsValidator()
+    ordered = OrderedFeed(validator)
+    blocks = [(offset, chunk[offset:offset + 500]) for offset in range(0, len(chunk), 500)]
+    # The last ranges in first, as when the first range is the slowest.
+    for offset, block in blocks[4:] + blocks[:4]:
+        ordered.feed(offset, block)
+    assert not ordered.pending
+    assert validator.report() == feed(chunk, len(chunk)).report()
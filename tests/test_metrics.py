@@ -0,0 +1,73 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import json
+
+from pyriscope.metrics import Metrics, MetricsExporter, format_eta, format_rate, prometheus_text
+
+BROADCAST_URL = "https://www.periscope.tv/w/1LyxBeXmWObJN"
+
+
+class Broadcast:
+    def __init__(self, finished):
+        self.finished = finished
+
+    def is_finished(self):
+        return self.finished
+
+
+def test_prometheus_text():
+    metrics = Metrics()
+    for latency in (0.2, 0.3, 3.0):
+        metrics.record_chunk(latency, 1000)
+    metrics.record_failure()
+    metrics.record_retry()
+    text = prometheus_text(metrics)
+    assert 'pyriscope_chunks_total{result="ok"} 3' in text
+    assert 'pyriscope_chunks_total{result="failed"} 1' in text
+    assert "pyriscope_bytes_total 3000" in text
+    assert "pyriscope_retries_total 1" in text
+    # Cumulative buckets.
+    assert 'pyriscope_chunk_latency_seconds_bucket{le="0.1"} 0' in text
+    assert 'pyriscope_chunk_latency_seconds_bucket{le="0.5"} 2' in text
+    assert 'pyriscope_chunk_latency_seconds_bucket{le="+Inf"} 3' in text
+
+
+def test_finished_broadcasts_are_dropped():
+    metrics = Metrics()
+    running = Broadcast(False)
+    metrics.add_broadcast(running)
+    metrics.add_broadcast(Broadcast(True))
+    assert metrics.num_active() == 1
+    assert metrics.broadcasts == [running]
+    assert metrics.snapshot()['broadcasts'] == 2
+
+
+def test_metrics_exporter(tmp_path):
+    metrics = Metrics()
+    metrics.record_chunk(0.1, 10)
+    path = tmp_path / "pyriscope.prom"
+    exporter = MetricsExporter(metrics, str(path), interval=60)
+    exporter.close()
+    assert 'pyriscope_chunks_total{result="ok"} 1' in path.read_text()
+
+
+def test_format():
+    assert format_rate(512) == "512.0 B/s"
+    assert format_rate(3 * 1024 * 1024) == "3.0 MB/s"
+    assert format_eta(None) == "--:--"
+    assert format_eta(75) == "1:15"
+    assert format_eta(3725) == "1:02:05"
+
+
+def test_json_progress(server, cli):
+    result = cli(BROADCAST_URL, "-n", "out", "--progress", "json")
+    assert result.returncode == 0, result.stdout
+    events = [json.loads(line) for line in result.stdout.decode().splitlines() if line.startswith("{")]
+    progress = [event for event in events if event['event'] == 'progress']
+    assert progress and progress[-1]['chunks'] == progress[-1]['total'] == server.num_chunks
+    summary, = [event for event in events if event['event'] == 'summary']
+    assert summary['chunks'] == server.num_chunks and summary['failed'] == 0
@@ -0,0 +1,84 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+from pyriscope.playlist import Playlist, parse_duration, parse_playlist
+
+MEDIA = """#EXTM3U
+#EXT-X-TARGETDURATION:4
+#EXT-X-MEDIA-SEQUENCE:7
+#EXTINF:3.0,
+chunk_7.ts
+#EXTINF:4.0,
+chunk_8.ts?token=x
+#EXT-X-DISCONTINUITY
+#EXTINF:2.5,
+https://cdn.example.com/other/chunk_9.ts
+#EXT-X-ENDLIST
+"""
+
+MASTER = """#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=800000
+low/playlist.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2400000
+high/playlist.m3u8
+"""
+
+
+def test_parse_media_playlist():
+    playlist = parse_playlist(MEDIA, "https://replay.example.com/abc/playlist.m3u8")
+    assert playlist.target_duration == 4.0
+    assert playlist.ended
+    assert [segment.sequence for segment in playlist.segments] == [7, 8, 9]
+    assert [segment.start for segment in playlist.segments] == [0.0, 3.0, 7.0]
+    assert playlist.duration() == 9.5
+    assert [segment.discontinuity for segment in playlist.segments] == [False, False, True]
+    assert playlist.segments[0].url == "https://replay.example.com/abc/chunk_7.ts"
+    assert playlist.segments[1].file_name == "chunk_8.ts"
+    assert playlist.segments[2].url == "https://cdn.example.com/other/chunk_9.ts"
+
+
+def test_parse_master_playlist():
+    playlist = parse_playlist(MASTER, "https://live.example.com/abc/master.m3u8")
+    assert not playlist.segments
+    assert playlist.best_variant() == "https://live.example.com/abc/high/playlist.m3u8"
+
+
+def test_window():
+    playlist = parse_playlist(MEDIA, "https://replay.example.com/abc/playlist.m3u8")
+    sequences = lambda segments: [segment.sequence for segment in segments]
+    assert sequences(playlist.window()) == [7, 8, 9]
+    # Segments that only overlap the range are kept whole.
+    assert sequences(playlist.window(3.5, 6.0)) == [8]
+    assert sequences(playlist.window(2.0, 7.5)) == [7, 8, 9]
+    # Negative times count back from the end.
+    assert sequences(playlist.window(-2.0)) == [9]
+    assert sequences(playlist.window(None, -3.0)) == [7, 8]
+    assert sequences(playlist.window(20.0)) == []
+
+
+def test_parse_duration():
+    assert parse_duration("00:01:02.5") == 62.5
+    assert parse_duration("1:30") == 90.0
+    assert parse_duration("-90") == -90.0
+    assert parse_duration("soon") is None
+
+
+def test_parse_duration_units():
+    assert parse_duration("90s") == 90.0
+    assert parse_duration("500ms") == 0.5
+    assert parse_duration("2500us") == 0.0025
+    assert parse_duration("-1.5s") == -1.5
+    assert parse_duration("90m") is None
+    assert parse_duration("1:30s") is None
+
+
+def test_malformed_numbers_are_skipped():
+    text = MEDIA.replace("#EXTINF:4.0,", "#EXTINF:abc,").replace("#EXT-X-TARGETDURATION:4", "#EXT-X-TARGETDURATION:")
+    text = text.replace("#EXT-X-MEDIA-SEQUENCE:7", "#EXT-X-MEDIA-SEQUENCE:nan")
+    playlist = parse_playlist(text, "https://replay.example.com/abc/playlist.m3u8")
+    assert [segment.duration for segment in playlist.segments] == [3.0, 0.0, 2.5]
+    assert [segment.sequence for segment in playlist.segments] == [0, 1, 2]
+    assert playlist.target_duration == Playlist().target_duration
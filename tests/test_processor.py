@@ -0,0 +1,342 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+import pytest
+
+from pyriscope import processor
+from pyriscope.integrity import Manifest
+from pyriscope.processor import BandwidthLimiter, Hedger, Journal, Options, ReorderBuffer
+
+
+def test_session_pool_reuses_connections(server):
+    pool = processor.SessionPool(4)
+    headers = {'Cookie': processor.cookie_header(server.access_public())}
+    for chunk_info in server.download_list():
+        assert pool.get(chunk_info['url'], headers=headers).content
+    counts = pool.stats()[server.url.split('//', 1)[1]]
+    assert counts.num_requests == server.num_chunks
+    assert counts.num_connections == 1
+    assert counts.num_reused() == server.num_chunks - 1
+    pool.close()
+
+
+def test_reorder_buffer_writes_in_order(tmp_path):
+    buffer = ReorderBuffer(str(tmp_path / "out.ts"), str(tmp_path), 1024)
+    for index in (2, 0, 3, 1):
+        buffer.put(index, "<{}>".format(index).encode())
+    buffer.close()
+    assert (tmp_path / "out.ts").read_bytes() == b"<0><1><2><3>"
+
+
+def test_reorder_buffer_spills_to_disk(tmp_path):
+    buffer = ReorderBuffer(str(tmp_path / "out.ts"), str(tmp_path), 10)
+    for index in range(5, 0, -1):
+        buffer.put(index, bytes([index]) * 8)
+    assert buffer.spilled
+    assert buffer.num_bytes <= 10
+    buffer.put(0, b"\0" * 8)
+    buffer.close()
+    assert (tmp_path / "out.ts").read_bytes() == b"".join(bytes([index]) * 8 for index in range(6))
+    assert not list(tmp_path.glob("*.spill"))
+
+
+def test_reorder_buffer_skips_failed_chunks(tmp_path):
+    manifest = Manifest(str(tmp_path / "out"), "key", ["c0", "c1", "c2"])
+    buffer = ReorderBuffer(str(tmp_path / "out.ts"), str(tmp_path), 1024, manifest=manifest)
+    buffer.put(2, b"two", ("c2", "url2", {'size': 3}))
+    # Held back behind the missing chunk, so not in the manifest yet.
+    assert "c2" not in manifest.chunks
+    buffer.put(0, b"zero", ("c0", "url0", {'size': 4}))
+    buffer.skip(1)
+    buffer.close()
+    assert (tmp_path / "out.ts").read_bytes() == b"zerotwo"
+    assert manifest.missing() == ["c1"]
+
+
+def test_journal_resumes(tmp_path):
+    journal = Journal(str(tmp_path), "broadcast")
+    journal.record_download("chunk_0.ts", "url", 3, None)
+    journal.record_write(0, 10)
+    journal.record_write(1, 20)
+    journal.record_write(3, 40)
+    journal.close()
+    (tmp_path / "chunk_0.ts").write_bytes(b"abc")
+    # A write torn by an interrupted run ends the log.
+    with open(str(tmp_path / Journal.FILE_NAME), 'a') as handle:
+        handle.write('{"index": 2, "si')
+
+    journal = Journal(str(tmp_path), "broadcast")
+    assert journal.is_downloaded("chunk_0.ts", str(tmp_path / "chunk_0.ts"))
+    assert not journal.is_downloaded("chunk_1.ts", str(tmp_path / "chunk_1.ts"))
+    assert journal.written_prefix() == (2, 30)
+    journal.close()
+
+    # Another broadcast's journal is started over.
+    journal = Journal(str(tmp_path), "other")
+    assert journal.written_prefix() == (0, 0)
+    assert not journal.downloaded
+    journal.close()
+
+
+def test_bandwidth_limiter_caps_rate():
+    limiter = BandwidthLimiter(200 * 1024)
+    start = time.monotonic()
+    for _ in range(10):
+        limiter.consume("broadcast", 10 * 1024)
+    # 100K at 200K/s, less the bucket's 20K burst.
+    assert time.monotonic() - start >= 0.3
+
+
+def test_hedger_picks_stragglers():
+    hedger = Hedger(10, 0.2)
+    for _ in range(3):
+        attempt = hedger.begin(None, (), {})
+        attempt.begin()
+        assert hedger.settle(attempt, True, 1) == (True, 1)
+    straggler = hedger.begin(None, (), {})
+    straggler.begin()
+    assert hedger.pick() is None
+
+    straggler.flight.start -= Hedger.MIN_DELAY
+    hedge = hedger.pick()
+    assert hedge is not None and hedge.hedge and hedge.flight is straggler.flight
+    # Each chunk is hedged once.
+    assert hedger.pick() is None
+
+    assert hedge.claim()
+    assert straggler.lost()
+    assert hedger.settle(hedge, True, 5) == (True, 5)
+    assert hedger.settle(straggler, False, 0) is None
+
+
+def test_hedger_reports_failure_once_every_request_failed():
+    hedger = Hedger(10, 0.5)
+    attempt = hedger.begin(None, (), {})
+    hedge = attempt.flight.attempt(True)
+    assert hedger.settle(attempt, False, 0) is None
+    assert hedger.settle(hedge, False, 0) == (False, 0)
+
+
+def download(server, tmp_path, monkeypatch, download_list=None, **settings):
+    monkeypatch.chdir(tmp_path)
+    options = Options()
+    options.retries = 1
+    for key, value in settings.items():
+        setattr(options, key, value)
+    headers = {'Cookie': processor.cookie_header(server.access_public())}
+    complete = processor.download_replay("out", download_list or server.download_list(), headers, "key", options)
+    manifest = json.loads((tmp_path / "out.manifest.json").read_text())
+    return complete, (tmp_path / "out.ts").read_bytes(), manifest
+
+
+def test_download_replay(server, tmp_path, monkeypatch):
+    complete, data, manifest = download(server, tmp_path, monkeypatch)
+    assert complete
+    assert data == b"".join(server.chunk(index) for index in range(server.num_chunks))
+    assert manifest['missing'] == []
+    assert not os.path.exists(str(tmp_path / ".pyriscope.out"))
+
+
+def test_download_replay_in_ranges(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(processor, 'split_size', 188 * 4)
+    complete, data, _ = download(server, tmp_path, monkeypatch, stream=True)
+    assert complete
+    assert data == b"".join(server.chunk(index) for index in range(server.num_chunks))
+
+
+def test_download_chunks_in_ranges_to_files(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(processor, 'split_size', 188 * 4)
+    num_split = processor.metrics.snapshot()['split']
+    complete, data, manifest = download(server, tmp_path, monkeypatch)
+    assert complete
+    assert processor.metrics.snapshot()['split'] > num_split
+    assert data == b"".join(server.chunk(index) for index in range(server.num_chunks))
+    # Checked in order, though the ranges came in side by side.
+    for index, chunk in enumerate(manifest['chunks']):
+        assert chunk['sha256'] == hashlib.sha256(server.chunk(index)).hexdigest()
+        assert chunk['packets'] == 20 and chunk['sync_errors'] == 0
+
+
+def test_stream_leaves_out_missing_chunk(server, tmp_path, monkeypatch):
+    download_list = server.download_list()
+    # Beyond the mock's chunks, so it answers 404.
+    download_list.insert(3, {'url': download_list[0]['url'].replace("chunk_0", "chunk_99"),
+                             'file_name': "chunk_99.ts"})
+    for stream in (True, False):
+        complete, data, manifest = download(server, tmp_path, monkeypatch, download_list, stream=stream)
+        assert not complete
+        assert data == b"".join(server.chunk(index) for index in range(server.num_chunks))
+        assert manifest['missing'] == ["chunk_99.ts"]
+        assert len(manifest['chunks']) == server.num_chunks
+        assert not list(tmp_path.glob(".pyriscope.out/*.part"))
+
+
+def test_failed_pipe_keeps_ts(server, tmp_path, monkeypatch, failing_ffmpeg):
+    conversions = []
+    monkeypatch.chdir(tmp_path)
+    options = Options()
+    options.stream = options.pipe = options.convert = options.clean = True
+    headers = {'Cookie': processor.cookie_header(server.access_public())}
+    processor.download_replay("out", server.download_list(), headers, "key", options, on_convert=conversions.append)
+
+    ok, errors = conversions[0].result()
+    assert not ok and "Invalid data found" in errors
+    assert (tmp_path / "out.ts").read_bytes() == b"".join(server.chunk(index) for index in range(server.num_chunks))
+    manifest = json.loads((tmp_path / "out.manifest.json").read_text())
+    assert manifest['output'] == "out.ts" and "Invalid data found" in manifest['error']
+    # Not reused as a finished download.
+    assert Manifest.completed_output("out", "key") is None
+
+
+def test_unavailable_replay_is_cached_briefly(server, monkeypatch):
+    monkeypatch.setattr(processor.metadata_cache, 'enabled', True)
+    monkeypatch.setattr(processor.MetadataCache, 'SHORT_TTL', 0)
+    url_parts = processor.dissect_url("https://www.periscope.tv/w/pending1")
+    server.set_broadcast("pending1", "alice", "ENDED")
+    assert not processor.get_broadcast_public(url_parts, {})['broadcast']['available_for_replay']
+
+    # Once the replay is up, the next call sees it and keeps it.
+    server.set_broadcast("pending1", "alice", "ENDED", available_for_replay=True)
+    assert processor.get_broadcast_public(url_parts, {})['broadcast']['available_for_replay']
+    server.set_broadcast("pending1", "alice", "ENDED")
+    assert processor.get_broadcast_public(url_parts, {})['broadcast']['available_for_replay']
+
+
+def test_claim_name(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert processor.claim_name("out") == "out"
+    # Taken by a download that is still running, or already finished.
+    assert processor.claim_name("out") == "out-1"
+    (tmp_path / "out-2.ts").write_bytes(b"")
+    assert processor.claim_name("out") == "out-3"
+    assert processor.claim_name("out", ".live") == "out"
+    assert (tmp_path / ".pyriscope.out.live").is_dir()
+
+
+def test_failed_broadcast_gives_its_name_back(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(processor.metadata_cache, 'enabled', False)
+    server.set_broadcast("pending2", "alice", "ENDED")
+    with pytest.raises(processor.ReplayUnavailable):
+        processor.process_broadcast(processor.dissect_url("https://www.periscope.tv/w/pending2"), Options())
+    assert not list(tmp_path.glob(".pyriscope.*"))
+
+
+def test_reorder_buffer_reports_writes(tmp_path):
+    written = []
+    on_write = lambda index, size: written.append((index, size, (tmp_path / "out.ts").stat().st_size))
+    buffer = ReorderBuffer(str(tmp_path / "out.ts"), str(tmp_path), 1024, on_write)
+    buffer.put(1, b"one")
+    assert written == []
+    buffer.put(0, b"zero")
+    buffer.close()
+    # Each write is on disk by the time it is reported.
+    assert written == [(0, 4, 4), (1, 3, 7)]
+
+
+def test_live_duration_is_checked():
+    for duration in ("90s", "500ms", "00:01:30"):
+        options = Options()
+        options.live_duration = duration
+        processor.check_options(options)
+    for duration in ("-5", "0", "soon", "-90s"):
+        options = Options()
+        options.live_duration = duration
+        with pytest.raises(processor.InvalidOptions):
+            processor.check_options(options)
+
+
+def test_async_engine(server, tmp_path, monkeypatch):
+    pytest.importorskip("aiohttp")
+    for stream in (False, True):
+        complete, data, manifest = download(server, tmp_path, monkeypatch, engine=processor.ENGINE_ASYNC,
+                                            stream=stream)
+        assert complete
+        assert data == b"".join(server.chunk(index) for index in range(server.num_chunks))
+        assert manifest['missing'] == []
+
+
+def test_concurrency_controller(monkeypatch):
+    monkeypatch.setattr(processor.ConcurrencyController, 'WINDOW_SECONDS', 0.0)
+    controller = processor.ConcurrencyController("host", 4, 1, 16)
+    for _ in range(4):
+        controller.record(0.1, 100000)
+    assert controller.limit == 5
+
+    # Throttling halves the limit.
+    throttled = processor.ReplayDeleted("Unable to download chunk.", 503, None)
+    for _ in range(5):
+        controller.record(0.1, 0, throttled)
+    assert controller.limit == 2
+    assert "throttled" in controller.decisions[-1]
+
+    assert controller.try_acquire() and controller.try_acquire()
+    assert not controller.try_acquire()
+    controller.release()
+    assert controller.try_acquire()
+
+    pinned = processor.ConcurrencyController("host", 4, 4, 4, pinned=True)
+    for _ in range(8):
+        pinned.record(0.1, 0, throttled)
+    assert pinned.limit == 4 and not pinned.decisions
+
+
+def test_retry_policy():
+    policy = processor.RetryPolicy(3)
+    unavailable = processor.ReplayDeleted("Unable to download chunk.", 503, None)
+    assert policy.should_retry(unavailable, 1)
+    assert not policy.should_retry(unavailable, 3)
+    assert not policy.should_retry(processor.ReplayDeleted("Unable to download chunk.", 404, None), 1)
+    # Expired cookies are only worth retrying if they can be renewed.
+    assert not policy.should_retry(processor.ReplayDeleted("Unable to download chunk.", 403, None), 1)
+    assert policy.should_retry(processor.ChunkTruncated("Chunk truncated."), 2)
+    assert not policy.should_retry(ValueError(), 1)
+    assert 0 <= policy.prepare_retry(unavailable, 2) <= policy.base_delay * 2
+
+
+def test_failed_chunks_are_retried(server, tmp_path, monkeypatch):
+    server.error_rate = 0.5
+    server.num_chunks = 20
+    monkeypatch.chdir(tmp_path)
+    policy = processor.RetryPolicy(20, base_delay=0.01)
+    headers = {'Cookie': processor.cookie_header(server.access_public())}
+    assert processor.download_replay("out", server.download_list(), headers, "key", Options(), retry_policy=policy)
+    assert (tmp_path / "out.ts").read_bytes() == b"".join(server.chunk(index) for index in range(server.num_chunks))
+    assert policy.num_retries > 0
+
+
+def test_conversion_pool(tmp_path, monkeypatch, fake_ffmpeg):
+    monkeypatch.chdir(tmp_path)
+    names = ["out{}".format(index) for index in range(4)]
+    for name in names:
+        (tmp_path / "{}.ts".format(name)).write_bytes(name.encode())
+    options = Options()
+    options.clean = True
+    pool = processor.ConversionPool(2)
+    futures = [pool.submit(name, options) for name in names]
+    assert [ok for ok, _ in pool.wait()] == [True] * len(names)
+    assert all(future.done() for future in futures)
+    for name in names:
+        assert (tmp_path / "{}.mp4".format(name)).read_bytes() == name.encode()
+        # Only a successful conversion makes the .ts expendable.
+        assert not (tmp_path / "{}.ts".format(name)).exists()
+
+
+def test_failed_conversion_keeps_ts(tmp_path, monkeypatch, failing_ffmpeg):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "out.ts").write_bytes(b"ts")
+    options = Options()
+    options.clean = True
+    pool = processor.ConversionPool()
+    pool.submit("out", options)
+    (ok, errors), = pool.wait()
+    assert not ok and "Invalid data found" in errors
+    assert (tmp_path / "out.ts").exists()
@@ -0,0 +1,55 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import os
+
+from pyriscope import processor
+from pyriscope.processor import Options
+from pyriscope.store import ChunkStore
+
+
+def report(data):
+    return {'size': len(data), 'sha256': None}
+
+
+def test_store_round_trip(tmp_path):
+    store = ChunkStore(str(tmp_path / "chunks"), 1024)
+    stored = store.broadcast("key")
+    assert stored.read("chunk_0.ts") == (None, None)
+    stored.add_data("chunk_0.ts", b"zero", report(b"zero"))
+    assert stored.read("chunk_0.ts") == (b"zero", report(b"zero"))
+
+    target = tmp_path / "chunk_0.ts"
+    assert stored.link("chunk_0.ts", str(target)) == report(b"zero")
+    assert target.read_bytes() == b"zero"
+    assert os.path.samefile(str(target), str(tmp_path / "chunks" / "key" / "chunk_0.ts"))
+    assert store.num_hits == 2 and store.num_added == 1
+
+
+def test_store_evicts_least_recently_used(tmp_path):
+    store = ChunkStore(str(tmp_path / "chunks"), 250)
+    stored = store.broadcast("key")
+    for index, name in enumerate(("a", "b")):
+        stored.add_data(name, bytes(100), report(bytes(100)))
+        os.utime(str(tmp_path / "chunks" / "key" / name), (1000 + index, 1000 + index))
+    # Reading a marks it as used, so b is the one to go.
+    assert stored.read("a")[0] is not None
+    stored.add_data("c", bytes(100), report(bytes(100)))
+    assert sorted(os.listdir(str(tmp_path / "chunks" / "key"))) == ["a", "a.check.json", "c", "c.check.json"]
+
+
+def test_download_reuses_stored_chunks(server, tmp_path, monkeypatch):
+    store = ChunkStore(str(tmp_path / "chunks"), 1024 * 1024)
+    headers = {'Cookie': processor.cookie_header(server.access_public())}
+    for run in ("first", "second"):
+        (tmp_path / run).mkdir()
+        monkeypatch.chdir(tmp_path / run)
+        assert processor.download_replay("out", server.download_list(), headers, "key", Options(),
+                                         stored=store.broadcast("key"))
+        data = (tmp_path / run / "out.ts").read_bytes()
+        assert data == b"".join(server.chunk(index) for index in range(server.num_chunks))
+    assert store.num_added == server.num_chunks
+    assert store.num_hits == server.num_chunks
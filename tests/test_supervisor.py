@@ -0,0 +1,61 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import time
+
+import pytest
+
+from pyriscope import processor, supervisor
+from pyriscope.processor import DEFAULT_UA, RESULT_DOWNLOADED, DownloadFailed, Options
+from pyriscope.supervisor import LiveCapture
+
+
+def capture(server, monkeypatch, broadcast_id):
+    monkeypatch.setattr(processor.metadata_cache, 'enabled', False)
+    monkeypatch.setattr(supervisor, 'MAX_BACKOFF', 0.05)
+    url_parts = processor.dissect_url("https://www.periscope.tv/w/{}".format(broadcast_id))
+    return LiveCapture("{}.live".format(broadcast_id), url_parts, {'User-Agent': DEFAULT_UA},
+                       server.access_public()['hls_url'], Options())
+
+
+def poll_until_finished(capture, on_poll=None, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not capture.poll():
+        assert time.monotonic() < deadline
+        if on_poll is not None:
+            on_poll()
+        time.sleep(0.02)
+
+
+def test_live_capture_restarts_while_live(server, tmp_path, monkeypatch, recording_ffmpeg):
+    monkeypatch.chdir(tmp_path)
+    server.set_broadcast("live1", "alice", "RUNNING")
+    live = capture(server, monkeypatch, "live1")
+    live.start()
+
+    def end_after_second_run():
+        if live.num_runs == 2:
+            server.set_broadcast("live1", "alice", "ENDED", available_for_replay=True)
+
+    poll_until_finished(live, end_after_second_run)
+    assert live.num_runs == 2
+    assert live.future.result() == (RESULT_DOWNLOADED, "live1.live.ts")
+    assert (tmp_path / "live1.live.ts").read_bytes() == b"runrun"
+    assert not list(tmp_path.glob("live1.live.part*")) and not (tmp_path / ".pyriscope.live1.live").exists()
+
+
+def test_live_capture_gives_up_on_quick_exits(server, tmp_path, monkeypatch, refused_ffmpeg):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(supervisor, 'MAX_QUICK_EXITS', 3)
+    server.set_broadcast("live2", "alice", "RUNNING")
+    live = capture(server, monkeypatch, "live2")
+    live.start()
+
+    poll_until_finished(live)
+    assert live.num_runs == 3
+    with pytest.raises(DownloadFailed, match="Connection refused"):
+        live.future.result()
+    assert not (tmp_path / ".pyriscope.live2.live").exists()
@@ -0,0 +1,66 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import json
+from threading import Thread
+
+import pytest
+
+from pyriscope.trace import Tracer
+
+
+def test_spans_are_written_as_chrome_trace(tmp_path):
+    tracer = Tracer(str(tmp_path / "trace.json"))
+    with tracer.span("download", 'phase', broadcast="out"):
+        with tracer.span("chunk_0.ts", 'chunk', url="u0"):
+            tracer.note(status=200, bytes=10)
+        # Notes go to the innermost open span.
+        tracer.note(chunks=1)
+    with pytest.raises(OSError):
+        with tracer.span("chunk_1.ts", 'chunk'):
+            raise OSError("reset")
+    thread = Thread(target=lambda: tracer.span("chunk_2.ts", 'chunk').__enter__().__exit__(None, None, None),
+                    name="worker")
+    thread.start()
+    thread.join()
+    tracer.write()
+
+    events = json.loads((tmp_path / "trace.json").read_text())['traceEvents']
+    spans = {event['name']: event for event in events if event['ph'] == "X"}
+    assert spans['download']['args'] == {'broadcast': "out", 'chunks': 1}
+    assert spans['chunk_0.ts']['args'] == {'url': "u0", 'status': 200, 'bytes': 10}
+    assert spans['chunk_1.ts']['args'] == {'error': "OSError"}
+    # The chunk lies inside its phase.
+    assert spans['download']['ts'] <= spans['chunk_0.ts']['ts']
+    assert spans['chunk_0.ts']['dur'] <= spans['download']['dur']
+    names = {event['tid']: event['args']['name'] for event in events if event['name'] == "thread_name"}
+    assert names[spans['chunk_2.ts']['tid']] == "worker"
+    assert not list(tmp_path.glob("trace.json.*"))
+
+
+def test_virtual_threads_get_timelines_of_their_own(tmp_path):
+    tracer = Tracer(str(tmp_path / "trace.json"))
+    tids = [tracer.virtual_thread("worker {}".format(index)) for index in range(2)]
+    for tid in tids:
+        with tracer.span("chunk.ts", 'chunk', tid=tid):
+            pass
+    assert len(set(tids)) == 2
+    assert [tracer.thread_names[tid] for tid in tids] == ["worker 0", "worker 1"]
+
+
+def test_summary_ranks_phases_and_chunks(tmp_path):
+    tracer = Tracer(str(tmp_path / "trace.json"))
+    tracer.spans = [("download", 'phase', 1, 0.0, 2.0, {}), ("download", 'phase', 1, 3.0, 4.0, {}),
+                    ("convert", 'ffmpeg', 1, 0.0, 1.5, {}),
+                    ("fast.ts", 'chunk', 1, 0.0, 0.1, {'bytes': 10, 'status': 200}),
+                    ("slow.ts", 'chunk', 1, 0.0, 0.9, {'error': "Timeout"})]
+    tracer.thread_names = {1: "main"}
+    lines = tracer.summary(size=1)
+    assert lines[0] == "Slowest phases:"
+    assert lines[2].split() == ["3.000s", "2", "2.000s", "download"]
+    assert len(lines) == 6
+    assert lines[3] == "Slowest chunks:"
+    assert lines[5].split() == ["0.900s", "-", "Timeout", "slow.ts", "(main)"]
@@ -0,0 +1,81 @@
+"""
+Copyright (c) 2017 Russell Harkanson
+
+See the file LICENSE.txt for copying permission.
+"""
+
+import time
+
+from pyriscope.batch import JobQueue
+from pyriscope.watch import BROADCAST_URL, Watcher
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def queued_urls(queue):
+    return sorted(job['url'] for job in queue.snapshot())
+
+
+def test_watch_user(server, tmp_path):
+    server.set_broadcast("live1", "alice", "RUNNING")
+    server.set_broadcast("old1", "alice", "ENDED", available_for_replay=True)
+    queue = JobQueue(str(tmp_path / "queue.json"))
+    watcher = Watcher(queue, ["alice"], [], 0.1, {})
+    watcher.start()
+    try:
+        # The first check only queues what is live.
+        assert wait_for(lambda: watcher.num_queued == 1)
+        assert queued_urls(queue) == [BROADCAST_URL.format("live1")]
+
+        # Unchanged broadcasts are answered with 304s and queue nothing.
+        assert wait_for(lambda: watcher.num_not_modified >= 2)
+        assert watcher.num_queued == 1
+
+        server.set_broadcast("live2", "alice", "RUNNING")
+        server.set_broadcast("live1", "alice", "ENDED", available_for_replay=True)
+        # The replay of a broadcast already queued doesn't get a second job.
+        expected = [BROADCAST_URL.format("live1"), BROADCAST_URL.format("live2")]
+        assert wait_for(lambda: queued_urls(queue) == expected)
+        time.sleep(0.3)
+        assert queued_urls(queue) == expected
+    finally:
+        watcher.stop()
+        watcher.join(5)
+
+
+def test_watch_broadcast_ids(server, tmp_path):
+    server.set_broadcast("soon", "bob", "NOT_STARTED")
+    server.set_broadcast("gone", "bob", "ENDED")
+    queue = JobQueue(str(tmp_path / "queue.json"))
+    watcher = Watcher(queue, [], ["soon", "gone"], 0.1, {})
+    watcher.start()
+    try:
+        # An ended broadcast without a replay is dropped.
+        assert wait_for(lambda: list(watcher.broadcasts) == ["soon"])
+        server.set_broadcast("soon", "bob", "RUNNING")
+        # Once found, nothing is left to watch and the watcher stops.
+        watcher.join(5)
+        assert not watcher.is_alive()
+        assert queued_urls(queue) == [BROADCAST_URL.format("soon")]
+    finally:
+        watcher.stop()
+
+
+def test_watch_checks_users_side_by_side(server, tmp_path):
+    server.latency = 0.5
+    queue = JobQueue(str(tmp_path / "queue.json"))
+    watcher = Watcher(queue, ["user{}".format(index) for index in range(6)], [], 60, {})
+    watcher.start()
+    try:
+        # One after the other, the first checks would take 3 seconds.
+        assert wait_for(lambda: watcher.num_requests == 6, timeout=2.0)
+    finally:
+        watcher.stop()
+        watcher.join(5)